@@ -0,0 +1,225 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import sqlite3
+import time
+
+import admin_tasks.common.git_utilities as git_utils
+from admin_tasks.common.line_counter import add_timing_to_header, summarise_file_counts
+
+
+DEFAULT_STORE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "thiscovery-devops", "blob_counts.sqlite3"
+)
+SQLITE_MAX_VARIABLES = 900
+
+
+class BlobCountStore:
+    """
+    Persistent SQLite store of per-file line counts keyed by git blob SHA,
+    file type (which determines the language) and counting backend. The file
+    type is the extension or, for files without one (e.g. Dockerfile or
+    Makefile), the file name.
+    Files are byte-identical across most sampled revisions, and vendored
+    files are shared by several repos, so a snapshot only needs to count
+    the blobs that were never seen before.
+
+    The store can be shared by several processes. Hit and miss counts are
+    kept for the current instance (hits, misses) and cumulatively in the
+    database (stats()).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("BLOB_COUNT_STORE_PATH", DEFAULT_STORE_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # the extension column holds file types (see _file_type); rows of
+            # extensionless files saved by earlier versions ("") are not read
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS blob_counts ("
+                "blob TEXT, extension TEXT, counter TEXT, "
+                "language TEXT, blank INTEGER, comment INTEGER, code INTEGER, "
+                "PRIMARY KEY (blob, extension, counter))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)"
+            )
+
+    @staticmethod
+    def counter_key(line_counter=None):
+        if line_counter is None:
+            return "\0".join(["cloc", *git_utils.CLOC_OPTIONS])
+        return "\0".join(line_counter.cache_options)
+
+    @staticmethod
+    def _file_type(path):
+        """
+        Returns:
+            Lower case extension of path, or its file name if it has none
+        """
+        name = os.path.basename(path)
+        extension = os.path.splitext(name)[1].lower()
+        return extension or name
+
+    def _lookup(self, keys, counter):
+        """
+        Returns:
+            Dict of (blob, file type) keys found in the store mapped to their
+            counts (None for files the backend does not count)
+        """
+        found = dict()
+        keys = list(keys)
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES // 2):
+            chunk = keys[i : i + SQLITE_MAX_VARIABLES // 2]
+            blob_conditions = " OR ".join(["(blob = ? AND extension = ?)"] * len(chunk))
+            rows = self._connection.execute(
+                "SELECT blob, extension, language, blank, comment, code "
+                f"FROM blob_counts WHERE counter = ? AND ({blob_conditions})",
+                [counter, *[v for key in chunk for v in key]],
+            )
+            for blob, extension, language, blank, comment, code in rows:
+                found[(blob, extension)] = (
+                    None
+                    if language is None
+                    else {
+                        "language": language,
+                        "blank": blank,
+                        "comment": comment,
+                        "code": code,
+                    }
+                )
+        return found
+
+    def _save(self, rows, counter, header, hits, misses):
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO blob_counts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        blob,
+                        extension,
+                        counter,
+                        *(
+                            (None, None, None, None)
+                            if counts is None
+                            else (
+                                counts["language"],
+                                counts["blank"],
+                                counts["comment"],
+                                counts["code"],
+                            )
+                        ),
+                    )
+                    for (blob, extension), counts in rows.items()
+                ],
+            )
+            if header is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (f"cloc_version\0{counter}", str(header.get("cloc_version"))),
+                )
+            for key, value in (("hits", hits), ("misses", misses)):
+                self._connection.execute(
+                    "INSERT INTO meta VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                    (key, value),
+                )
+
+    def _cloc_version(self, counter):
+        row = self._connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (f"cloc_version\0{counter}",)
+        ).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        """
+        Returns:
+            Cumulative hits, misses and hit rate of all users of the store
+        """
+        totals = dict(
+            self._connection.execute(
+                "SELECT key, value FROM meta WHERE key IN ('hits', 'misses')"
+            ).fetchall()
+        )
+        hits, misses = totals.get("hits", 0), totals.get("misses", 0)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "stored_blobs": self._connection.execute(
+                "SELECT COUNT(*) FROM blob_counts"
+            ).fetchone()[0],
+        }
+
+    def count_lines_of_code_for_revision(self, git_repo, revision, line_counter=None):
+        """
+        Counts lines of code of revision of git_repo, only passing blobs that
+        are not in the store yet to line_counter (or cloc if line_counter is
+        None)
+
+        Returns:
+            Dict with the same shape as the output of cloc
+        """
+        start = time.monotonic()
+        counter = self.counter_key(line_counter)
+        blobs = {
+            path: sha
+            for path, sha in git_repo.list_blobs_at_revision(revision).items()
+            if not git_utils.is_excluded_from_cloc(path)
+        }
+        keys = {path: (sha, self._file_type(path)) for path, sha in blobs.items()}
+        known = self._lookup(set(keys.values()), counter)
+
+        to_count = dict()
+        for path, key in keys.items():
+            if key not in known:
+                known[key] = None  # placeholder until counted
+                to_count[path] = key[0]
+        hits = len(set(keys.values())) - len(to_count)
+        misses = len(to_count)
+        self.hits += hits
+        self.misses += misses
+
+        header = None
+        if to_count:
+            if line_counter is None:
+                header, counts = git_repo.count_lines_of_code_by_file(to_count)
+            else:
+                header, counts = line_counter.count_blobs(git_repo, to_count)
+            new_rows = {keys[path]: counts.get(path) for path in to_count}
+            known.update(new_rows)
+        else:
+            new_rows = dict()
+        self._save(new_rows, counter, header, hits, misses)
+
+        if header is None:
+            header = {"cloc_url": "", "cloc_version": self._cloc_version(counter)}
+        file_counts = {
+            path: {"blob": key[0], **known[key]}
+            for path, key in keys.items()
+            if known[key] is not None
+        }
+        summary = summarise_file_counts(file_counts, header)
+        return add_timing_to_header(summary, time.monotonic() - start)
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,123 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import hashlib
+import os
+import tempfile
+
+import admin_tasks.common.git_utilities as git_utils
+
+
+DEFAULT_CACHE_FOLDER = os.path.join(
+    os.path.expanduser("~"), ".cache", "thiscovery-devops", "cloc"
+)
+DEFAULT_MAX_SIZE = 200 * 1024 * 1024  # bytes
+
+
+class ClocCache:
+    """
+    Persistent on-disk cache of cloc outputs, keyed by repo, git revision and
+    cloc options. Entries are stored one file per key; least recently used
+    entries are evicted once the total size of the cache exceeds max_size.
+
+    Writes are atomic, so the same cache folder can be shared by several
+    processes (e.g. update_code_metrics.backfill workers).
+    """
+
+    def __init__(self, folder=None, max_size=DEFAULT_MAX_SIZE):
+        self.folder = folder or os.environ.get(
+            "CLOC_CACHE_FOLDER", DEFAULT_CACHE_FOLDER
+        )
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.folder, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(repo, revision, options=None):
+        if options is None:
+            options = git_utils.CLOC_OPTIONS
+        key_str = "\0".join([repo, revision, *options])
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def _entries(self):
+        """
+        Yields (path, size, last access time) of every cache entry
+        """
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, repo, revision, options=None):
+        path = self._path(self.key(repo, revision, options))
+        try:
+            with open(path) as f:
+                value = f.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, repo, revision, value, options=None):
+        path = self._path(self.key(repo, revision, options))
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        self._size += len(value.encode())
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def count_lines_of_code_for_revision(self, git_repo, revision, line_counter=None):
+        """
+        Cached version of GitRepo.count_lines_of_code_for_revision or, if
+        provided, of line_counter.count_lines_of_code_for_revision. Entries
+        are keyed by the name of git_repo's folder.
+        """
+        options = None if line_counter is None else line_counter.cache_options
+        value = self.get(git_repo.name, revision, options)
+        if value is None:
+            if line_counter is None:
+                value = git_repo.count_lines_of_code_for_revision(revision)
+            else:
+                value = line_counter.count_lines_of_code_for_revision(git_repo, revision)
+            self.put(git_repo.name, revision, value, options)
+        return value
@@ -0,0 +1,153 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Columnar store of code metrics series: a date axis and a repo x date matrix
+of lines of code, saved as .npy files that can be memory-mapped.
+"""
+import json
+import numpy as np
+import os
+
+
+MONDAY_OFFSET = 4  # 1970-01-01 (day 0 of datetime64[D]) was a Thursday
+
+
+class CodeMetricsSeries:
+    def __init__(self, dates, repos, loc):
+        """
+        Args:
+            dates: sorted array-like of dates (converted to datetime64[D])
+            repos: list of repo names (rows of loc)
+            loc: array-like of shape (len(repos), len(dates))
+        """
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.repos = list(repos)
+        self.loc = np.asarray(loc)
+        if self.loc.shape != (len(self.repos), len(self.dates)):
+            raise ValueError(
+                f"loc shape {self.loc.shape} does not match "
+                f"{len(self.repos)} repos x {len(self.dates)} dates"
+            )
+
+    @classmethod
+    def from_series(cls, timestamps, stack_data_series):
+        """
+        Builds a store from the lists used by graph_code_metrics
+        """
+        repos = list(stack_data_series.keys())
+        return cls(
+            dates=timestamps,
+            repos=repos,
+            loc=np.array([stack_data_series[r] for r in repos], dtype=np.int64),
+        )
+
+    def to_series(self):
+        """
+        Returns:
+            Tuple (timestamps, totals, stack_data_series) of lists, as used by
+            graph_code_metrics
+        """
+        return (
+            [str(d) for d in self.dates],
+            self.totals().tolist(),
+            {r: self.loc[i].tolist() for i, r in enumerate(self.repos)},
+        )
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "dates.npy"), self.dates)
+        np.save(os.path.join(folder, "loc.npy"), self.loc)
+        with open(os.path.join(folder, "repos.json"), "w") as f:
+            json.dump(self.repos, f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        """
+        Args:
+            mmap_mode: passed to numpy.load; the default memory-maps the
+                arrays read-only, so loading is instant regardless of size
+        """
+        with open(os.path.join(folder, "repos.json")) as f:
+            repos = json.load(f)
+        return cls(
+            dates=np.load(os.path.join(folder, "dates.npy"), mmap_mode=mmap_mode),
+            repos=repos,
+            loc=np.load(os.path.join(folder, "loc.npy"), mmap_mode=mmap_mode),
+        )
+
+    def totals(self):
+        return self.loc.sum(axis=0)
+
+    def repo_series(self, repo):
+        return self.loc[self.repos.index(repo)]
+
+    def slice(self, start=None, end=None):
+        """
+        Returns:
+            New CodeMetricsSeries restricted to dates in [start, end]; arrays
+            are views of this one's
+        """
+        i = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, "D"))
+        j = (
+            len(self.dates)
+            if end is None
+            else np.searchsorted(self.dates, np.datetime64(end, "D"), side="right")
+        )
+        return CodeMetricsSeries(self.dates[i:j], self.repos, self.loc[:, i:j])
+
+    def sample(self, step_size):
+        """
+        Keeps one date in every step_size
+        """
+        return CodeMetricsSeries(
+            self.dates[::step_size], self.repos, self.loc[:, ::step_size]
+        )
+
+    def _period_keys(self, frequency):
+        days = self.dates.astype(np.int64)
+        if frequency == "W":
+            return (days - MONDAY_OFFSET) // 7
+        if frequency == "M":
+            return self.dates.astype("datetime64[M]").astype(np.int64)
+        raise ValueError(f"Unsupported frequency {frequency}; use 'W' or 'M'")
+
+    def resample(self, frequency, how="last"):
+        """
+        Args:
+            frequency: "W" (weeks starting on Monday) or "M" (calendar months)
+            how: "last" keeps the last data point of each period (lines of
+                code are a level, not a flow); "mean" and "max" aggregate
+
+        Returns:
+            New CodeMetricsSeries with one date per period (the last date in
+            the period for which there is data)
+        """
+        if not len(self.dates):
+            return self
+        keys = self._period_keys(frequency)
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)] - 1
+        if how == "last":
+            loc = self.loc[:, ends]
+        elif how == "mean":
+            loc = np.add.reduceat(self.loc, starts, axis=1) / (ends - starts + 1)
+        elif how == "max":
+            loc = np.maximum.reduceat(self.loc, starts, axis=1)
+        else:
+            raise ValueError(f"Unsupported aggregation {how}")
+        return CodeMetricsSeries(self.dates[ends], self.repos, loc)
@@ -0,0 +1,250 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Scheduled, watermark-driven update of the CodeMetrics table. Each run only
+processes the days since the last successful run of each repo and then
+refreshes weekly and monthly rollups (one item per year) that dashboards can
+read with a single Query. Runs as the UpdateCodeMetrics Lambda function and
+can also be run locally (see update_code_metrics.py --since-watermark).
+"""
+import datetime
+import os
+import subprocess
+import thiscovery_lib.utilities as utils
+from dateutil import parser
+
+import admin_tasks.common.git_utilities as git_utils
+import src.common.constants as const
+from admin_tasks.common.code_metrics_utilities import (
+    NoRevisionAtTimestampError,
+    StackLocCounter,
+)
+from admin_tasks.common.line_counter import GitBlobLineCounter
+
+
+def period_start(date, frequency):
+    if frequency == "weekly":
+        return date - datetime.timedelta(days=date.weekday())
+    if frequency == "monthly":
+        return date.replace(day=1)
+    raise ValueError(f"Unsupported frequency {frequency}")
+
+
+ROLLUP_FREQUENCIES = ["weekly", "monthly"]
+
+
+class CodeMetricsUpdater:
+    def __init__(
+        self,
+        repos,
+        mirrors_folder,
+        metrics_table,
+        remote_url_template=None,
+        line_counter=None,
+        max_days_per_run=31,
+        today=None,
+        change_points=False,
+        compress_detail=False,
+    ):
+        """
+        Args:
+            repos: names of the repos to process
+            mirrors_folder: folder containing (or that will contain) a clone
+                of each repo
+            metrics_table (CodeMetricsTable): destination table
+            remote_url_template: e.g. "https://github.com/org/{repo}.git"; used
+                to clone repos missing from mirrors_folder
+            line_counter: optional alternative to cloc (see StackLocCounter)
+            max_days_per_run (int): upper limit on days processed per repo in
+                a run, so that backfilling a new repo happens over several runs
+            today (datetime.date): defaults to the current date; only days
+                before today are processed
+            change_points (bool): if True, items are only written for days
+                on which the revision of a repo changed
+            compress_detail (bool): if True, detail is stored as compressed
+                binary (see StackLocCounter)
+        """
+        self.repos = repos
+        self.mirrors_folder = mirrors_folder
+        self.metrics_table = metrics_table
+        self.remote_url_template = remote_url_template
+        self.line_counter = line_counter
+        self.max_days_per_run = max_days_per_run
+        self.today = today or datetime.date.today()
+        self.change_points = change_points
+        self.compress_detail = compress_detail
+        self.logger = utils.get_logger()
+
+    def sync_mirror(self, repo):
+        """
+        Returns:
+            GitRepo of the up-to-date mirror of repo
+        """
+        folder = os.path.join(self.mirrors_folder, repo)
+        if not os.path.isdir(folder):
+            if self.remote_url_template is None:
+                raise FileNotFoundError(f"No git mirror of {repo} in {self.mirrors_folder}")
+            return git_utils.GitRepo.clone(
+                self.remote_url_template.format(repo=repo), folder, checkout=False
+            )
+        git_repo = git_utils.get_repo(folder)
+        git_repo.fetch()
+        return git_repo
+
+    def first_date_to_process(self, repo, commit_index):
+        watermark = self.metrics_table.get_watermark(repo)
+        if watermark is not None:
+            last_processed = watermark["last_processed_date"]
+        else:
+            # repos populated by update_code_metrics.py before the first run
+            last_processed = self.metrics_table.get_latest_timestamp(repo)
+        if last_processed is None:
+            return commit_index.first_day_with_revision.date()
+        return parser.parse(last_processed).date() + datetime.timedelta(days=1)
+
+    def update_repo(self, repo, batch_writer):
+        """
+        Returns:
+            List of (date string, loc) data points added for repo
+        """
+        git_repo = self.sync_mirror(repo)
+        commit_index = git_repo.get_commit_index("origin/master", refresh=True)
+        start = self.first_date_to_process(repo, commit_index)
+        end = min(
+            self.today - datetime.timedelta(days=1),
+            start + datetime.timedelta(days=self.max_days_per_run - 1),
+        )
+        new_points = list()
+        previous_snapshot = None
+        # revision and loc of the latest item written, for change points
+        previous_revision, previous_loc = None, None
+        if self.change_points:
+            latest = self.metrics_table.get_change_point(
+                repo, str(start), attributes=("revision", "code")
+            )
+            if latest is not None:
+                previous_revision, previous_loc = latest["revision"], int(latest["code"])
+        date = start
+        while date <= end:
+            ts_str = str(date)
+            counter = StackLocCounter(
+                stack_name=repo,
+                commit_timestamp=ts_str,
+                line_counter=self.line_counter,
+                compress_detail=self.compress_detail,
+                repo=git_repo,
+            )
+            try:
+                counter.get_master_revision_at_timestamp()
+                if counter.git_revision == previous_revision:
+                    new_points.append((ts_str, previous_loc))
+                    date += datetime.timedelta(days=1)
+                    continue
+                if (
+                    previous_snapshot is not None
+                    and counter.git_revision == previous_snapshot.git_revision
+                ):
+                    counter.copy_metrics_from(previous_snapshot)
+                else:
+                    counter.get_metrics_for_revision()
+            except (subprocess.CalledProcessError, NoRevisionAtTimestampError) as err:
+                self.logger.error(
+                    f"Failed to count {repo} on {ts_str}; retrying from that day "
+                    f"in the next run",
+                    extra={"error": str(err)},
+                )
+                # the watermark must not move past a day that was not counted
+                end = date - datetime.timedelta(days=1)
+                break
+            batch_writer.put(counter.get_ddb_item_dict())
+            new_points.append((ts_str, int(counter.loc)))
+            previous_snapshot = counter
+            if self.change_points:
+                previous_revision, previous_loc = counter.git_revision, int(counter.loc)
+            date += datetime.timedelta(days=1)
+
+        if start <= end:
+            # only move the watermark once items are safely in the table
+            batch_writer.flush()
+            self.metrics_table.put_watermark(
+                repo,
+                str(end),
+                None if previous_snapshot is None else previous_snapshot.git_revision,
+            )
+        return new_points
+
+    def update_rollups(self, new_points_by_repo):
+        """
+        Applies new daily data points to the weekly and monthly rollups. Each
+        period keeps the last data point of each repo in that period. Only
+        the rollup items of years with new data points are rewritten.
+        """
+        now = str(utils.now_with_tz())
+        for frequency in ROLLUP_FREQUENCIES:
+            periods_by_year = dict()
+            for repo, points in new_points_by_repo.items():
+                for ts_str, loc in points:
+                    key = str(period_start(parser.parse(ts_str).date(), frequency))
+                    year = key[:4]
+                    if year not in periods_by_year:
+                        rollup = self.metrics_table.get_rollup(frequency, year)
+                        periods_by_year[year] = (
+                            dict() if rollup is None else rollup["periods"]
+                        )
+                    periods_by_year[year].setdefault(key, dict())[repo] = loc
+            for year, periods in periods_by_year.items():
+                self.metrics_table.put_rollup(frequency, year, periods, now)
+
+    def main(self):
+        new_points_by_repo = dict()
+        errors = dict()
+        with self.metrics_table.batch_writer() as batch_writer:
+            for repo in self.repos:
+                try:
+                    new_points_by_repo[repo] = self.update_repo(repo, batch_writer)
+                except (subprocess.CalledProcessError, FileNotFoundError) as err:
+                    self.logger.error(f"Failed to update {repo}", extra={"error": str(err)})
+                    errors[repo] = str(err)
+        if any(new_points_by_repo.values()):
+            self.update_rollups(new_points_by_repo)
+        return {
+            "new_data_points": {r: len(p) for r, p in new_points_by_repo.items()},
+            "errors": errors,
+        }
+
+
+def env_flag(name):
+    return os.environ.get(name, "false").lower() == "true"
+
+
+@utils.lambda_wrapper
+def scheduled_update(event, context):
+    """
+    Triggered on a timer (see template.yaml)
+    """
+    updater = CodeMetricsUpdater(
+        repos=os.environ["CODE_METRICS_REPOS"].split(","),
+        mirrors_folder=os.environ.get("GIT_MIRRORS_FOLDER", "/tmp/git-mirrors"),
+        metrics_table=const.CodeMetricsTable(),
+        remote_url_template=os.environ.get("GIT_REMOTE_URL_TEMPLATE"),
+        line_counter=GitBlobLineCounter(),
+        max_days_per_run=int(os.environ.get("CODE_METRICS_MAX_DAYS_PER_RUN", 31)),
+        change_points=env_flag("CODE_METRICS_CHANGE_POINTS"),
+        compress_detail=env_flag("CODE_METRICS_COMPRESS_DETAIL"),
+    )
+    return updater.main()
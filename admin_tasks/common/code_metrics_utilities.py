@@ -14,13 +14,32 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import collections
 import json
-import subprocess
+import os
+import time
 from thiscovery_lib.dynamodb_utilities import DdbBaseItem
 import thiscovery_lib.utilities as utils
 
 import admin_tasks.common.git_utilities as git_utils
 import src.common.constants as const
+import src.common.detail_encoding as detail_encoding
+from admin_tasks.common.line_counter import (
+    add_timing_to_header,
+    summarise_file_counts,
+)
+
+
+# what incremental counting needs from the snapshot of an earlier revision
+LocSnapshot = collections.namedtuple(
+    "LocSnapshot", ["git_revision", "file_counts", "header"]
+)
+
+
+class NoRevisionAtTimestampError(ValueError):
+    """
+    Raised when a repo had no commits on origin/master at a timestamp
+    """
 
 
 class CodeMetricsItem(DdbBaseItem):
@@ -33,9 +52,49 @@ class CodeMetricsItem(DdbBaseItem):
 
 
 class StackLocCounter:
-    def __init__(self, stack_name, commit_timestamp):
+    def __init__(
+        self,
+        stack_name,
+        commit_timestamp,
+        cloc_cache=None,
+        incremental=False,
+        previous_snapshot=None,
+        line_counter=None,
+        blob_count_store=None,
+        compress_detail=False,
+        repo=None,
+    ):
+        """
+        repo is the GitRepo of the stack's clone; it defaults to the clone at
+        the current working directory.
+
+        line_counter is an optional alternative to the cloc command line tool,
+        such as line_counter.GitBlobLineCounter.
+
+        If a blob_count_store (BlobCountStore) is provided, only files whose
+        blob is not in the store yet are counted. It takes precedence over
+        cloc_cache.
+
+        In incremental mode, previous_snapshot is the LocSnapshot (see
+        snapshot) of an earlier revision of the same stack; only files changed
+        since that revision are passed to cloc and the previous per-file
+        counts are rolled forward. Without a previous_snapshot, an incremental counter
+        counts every file of its revision. Incremental mode always uses cloc.
+
+        If compress_detail is True, the cloc output is stored in CodeMetrics
+        items as compressed binary instead of a map (see
+        src/common/detail_encoding.py).
+        """
         self.commit_timestamp = commit_timestamp
         self.stack_name = stack_name
+        self.cloc_cache = cloc_cache
+        self.incremental = incremental
+        self.previous_snapshot = previous_snapshot
+        self.line_counter = line_counter
+        self.blob_count_store = blob_count_store
+        self.compress_detail = compress_detail
+        self.repo = repo or git_utils.get_repo(os.getcwd())
+        self.file_counts = None  # per-file counts (incremental mode only)
         self.git_revision = None
         self.loc = None
         self.comments = None
@@ -43,54 +102,178 @@ class StackLocCounter:
         self.details = None
         self.sum_dict = None
 
-    def abort_if_already_in_ddb(self, metrics_table):
+    @property
+    def source(self):
+        if self.line_counter is None or self.incremental:
+            return "cloc"
+        return self.line_counter.name
+
+    def is_in_ddb(self, metrics_table):
         r = metrics_table.exact_query(
             partition_value=self.stack_name, sort_value=self.commit_timestamp
         )
-        if r["Count"]:
-            raise subprocess.CalledProcessError(500, "None")  # hack
+        return bool(r["Count"])
 
     def get_master_revision_at_timestamp(self):
-        self.git_revision = git_utils.get_branch_revision_at_timestamp(
-            self.commit_timestamp, "origin/master"
+        self.git_revision = self.repo.get_commit_index("origin/master").revision_at(
+            self.commit_timestamp
         )
+        if self.git_revision is None:
+            raise NoRevisionAtTimestampError(
+                f"{self.stack_name} has no commits before {self.commit_timestamp}"
+            )
+
+    def get_incremental_metrics_for_revision(self):
+        start = time.monotonic()
+        previous = self.previous_snapshot
+        if previous is None or previous.file_counts is None:
+            self.file_counts = dict()
+            to_count = self.repo.list_blobs_at_revision(self.git_revision)
+            header = {"cloc_url": "github.com/AlDanial/cloc", "cloc_version": None}
+        else:
+            self.file_counts = dict(previous.file_counts)
+            if previous.git_revision == self.git_revision:
+                to_count = dict()
+            else:
+                to_count, deleted = self.repo.get_changed_blobs(
+                    previous.git_revision, self.git_revision
+                )
+                for path in [*deleted, *to_count.keys()]:
+                    self.file_counts.pop(path, None)
+            header = previous.header
+
+        to_count = {
+            path: sha
+            for path, sha in to_count.items()
+            if not git_utils.is_excluded_from_cloc(path)
+        }
+        if to_count:
+            header, counts = self.repo.count_lines_of_code_by_file(to_count)
+            for path, file_counts in counts.items():
+                self.file_counts[path] = {"blob": to_count[path], **file_counts}
+
+        summary = summarise_file_counts(self.file_counts, header)
+        return add_timing_to_header(summary, time.monotonic() - start)
 
     def get_metrics_for_revision(self):
-        self.details = json.loads(
-            git_utils.count_lines_of_code_for_revision(self.git_revision)
-        )
+        if self.incremental:
+            self.details = self.get_incremental_metrics_for_revision()
+        elif self.blob_count_store is not None:
+            self.details = self.blob_count_store.count_lines_of_code_for_revision(
+                self.repo, self.git_revision, self.line_counter
+            )
+        else:
+            if self.cloc_cache is not None:
+                cloc_output = self.cloc_cache.count_lines_of_code_for_revision(
+                    self.repo, self.git_revision, self.line_counter
+                )
+            elif self.line_counter is not None:
+                cloc_output = self.line_counter.count_lines_of_code_for_revision(
+                    self.repo, self.git_revision
+                )
+            else:
+                cloc_output = self.repo.count_lines_of_code_for_revision(
+                    self.git_revision
+                )
+            self.details = json.loads(cloc_output)
         self.sum_dict = self.details["SUM"]
         self.loc = self.sum_dict["code"]
         self.comments = self.sum_dict["comment"]
         self.blank = self.sum_dict["blank"]
 
-    def upload_metrics_to_ddb(self):
+    def snapshot(self):
+        """
+        Returns:
+            LocSnapshot of this counter's revision, to pass as previous_snapshot
+            of the counter of a later revision. Unlike the counter, it does not
+            reference earlier snapshots, so callers keeping it do not keep the
+            whole chain of counters in memory.
+        """
+        return LocSnapshot(self.git_revision, self.file_counts, self.details["header"])
+
+    def copy_metrics_from(self, other):
+        """
+        Reuses the metrics of another counter of the same revision
+        """
+        self.details = other.details
+        self.sum_dict = other.sum_dict
+        self.loc = other.loc
+        self.comments = other.comments
+        self.blank = other.blank
+        self.file_counts = other.file_counts
+
+    def get_ddb_attributes(self):
+        """
+        Returns:
+            Non-key attributes of the CodeMetrics item for this snapshot
+        """
+        header = self.details["header"]
+        header["cloc_version"] = str(header["cloc_version"])
+        for k in ["elapsed_seconds", "files_per_second", "lines_per_second"]:
+            header.pop(k, None)
+        if self.compress_detail:
+            detail = {
+                "detail": detail_encoding.encode_detail(self.details),
+                "detail_encoding": detail_encoding.ZLIB_JSON,
+            }
+        else:
+            detail = {"detail": self.details}
+        return {
+            **self.sum_dict,
+            **detail,
+            "source": self.source,
+        }
+
+    def get_ddb_item_dict(self):
+        """
+        Returns:
+            The complete CodeMetrics item for this snapshot, for batch writes
+        """
+        now = str(utils.now_with_tz())
+        return {
+            "repo": self.stack_name,
+            "timestamp": self.commit_timestamp,
+            "revision": self.git_revision,
+            **self.get_ddb_attributes(),
+            "created": now,
+            "modified": now,
+        }
+
+    def upload_metrics_to_ddb(self, batch_writer=None):
+        """
+        Args:
+            batch_writer (DdbBatchWriter): if provided, the item is queued for
+                a batch write instead of being written synchronously
+        """
+        if batch_writer is not None:
+            batch_writer.put(self.get_ddb_item_dict())
+            return
         ddb_item = CodeMetricsItem(
             repo=self.stack_name,
             timestamp=self.commit_timestamp,
             revision=self.git_revision,
         )
-        self.details["header"]["cloc_version"] = str(
-            self.details["header"]["cloc_version"]
-        )
-        del self.details["header"]["elapsed_seconds"]
-        del self.details["header"]["files_per_second"]
-        del self.details["header"]["lines_per_second"]
-
-        ddb_item.from_dict(
-            {
-                **self.sum_dict,
-                "detail": self.details,
-                "source": "cloc",
-            }
-        )
+        ddb_item.from_dict(self.get_ddb_attributes())
         ddb_item.put(update=True)
 
-    def populate_ddb(self, metrics_table):
-        self.abort_if_already_in_ddb(metrics_table)
+    def populate_ddb(self, metrics_table=None, batch_writer=None):
+        """
+        Args:
+            metrics_table: if provided, nothing is done if metrics for this
+                stack and timestamp are already in this table. Callers that
+                check this in bulk (CodeMetricsTable.query_timestamps)
+                should not pass it.
+            batch_writer: see upload_metrics_to_ddb
+
+        Returns:
+            True if metrics were uploaded; False if they were already in the table
+        """
+        if metrics_table is not None and self.is_in_ddb(metrics_table):
+            return False
         self.get_master_revision_at_timestamp()
         self.get_metrics_for_revision()
-        self.upload_metrics_to_ddb()
+        self.upload_metrics_to_ddb(batch_writer)
+        return True
 
     def compute_metrics(self):
         self.get_master_revision_at_timestamp()
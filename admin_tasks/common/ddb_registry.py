@@ -0,0 +1,141 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Process-wide registry of Dynamodb table objects used by admin scripts. Each
+table instance owns a boto3 session and client for its AWS profile, so
+creating one per query repeats credential resolution and opens new HTTP
+connection pools. The registry creates one such instance per (profile,
+namespace, table) and shares its session and client between callers.
+
+boto3 clients are thread-safe but resources are not, so each thread gets its
+own copy of the shared instance, with its own Table resource built on the
+shared client. Sessions are created under a lock of their key only, so
+threads needing other tables are not held up by credential resolution.
+"""
+import collections
+import copy
+import threading
+
+
+class _SharedTable:
+    """
+    Table instance of one (profile, namespace, table) key and the per-thread
+    copies handed out to callers
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._shared = None
+        self._local = threading.local()
+
+    def _get_shared(self):
+        with self._lock:
+            if self._shared is None:
+                self._shared = self._factory()
+            return self._shared
+
+    def get(self):
+        """
+        Returns:
+            Tuple (table instance of the calling thread, whether it was just
+            created)
+        """
+        table = getattr(self._local, "table", None)
+        if table is not None:
+            return table, False
+        # shares the session and client of the shared instance, but not its
+        # Table resource
+        table = copy.copy(self._get_shared())
+        table.table = None
+        table.get_table()
+        self._local.table = table
+        return table, True
+
+
+class TableRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = dict()
+        self.created = collections.Counter()
+        self.thread_tables = collections.Counter()
+        self.reused = collections.Counter()
+
+    def get(self, table_class, profile_name=None, aws_namespace=None):
+        """
+        Args:
+            table_class: DdbBaseTable subclass accepting profile_name and
+                aws_namespace and implementing get_table, e.g. DeploymentsTable
+            profile_name: AWS profile of the table's account
+            aws_namespace: environment whose table should be used (e.g. "dev")
+
+        Returns:
+            table_class instance of the calling thread, sharing its session
+            and client with the instances of other threads
+        """
+        key = (profile_name, aws_namespace, table_class.name)
+
+        def create_table():
+            table = table_class(profile_name=profile_name, aws_namespace=aws_namespace)
+            with self._lock:
+                self.created[key] += 1
+            return table
+
+        with self._lock:
+            shared_table = self._tables.get(key)
+            if shared_table is None:
+                shared_table = self._tables[key] = _SharedTable(create_table)
+        table, is_new = shared_table.get()
+        with self._lock:
+            if is_new:
+                self.thread_tables[key] += 1
+            else:
+                self.reused[key] += 1
+        return table
+
+    def stats(self):
+        """
+        Returns:
+            Dict with the number of boto3 sessions created, of per-thread
+            table instances built on them and of times those were reused
+        """
+        with self._lock:
+            return {
+                "created": sum(self.created.values()),
+                "thread_tables": sum(self.thread_tables.values()),
+                "reused": sum(self.reused.values()),
+                "by_table": {
+                    key: {
+                        "created": self.created[key],
+                        "thread_tables": self.thread_tables[key],
+                        "reused": self.reused[key],
+                    }
+                    for key in self._tables
+                },
+            }
+
+    def clear(self):
+        with self._lock:
+            self._tables = dict()
+            self.created.clear()
+            self.thread_tables.clear()
+            self.reused.clear()
+
+
+registry = TableRegistry()
+get_table = registry.get
@@ -0,0 +1,184 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import decimal
+import json
+import os
+import sqlite3
+import threading
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "thiscovery-devops", "deployments.sqlite3"
+)
+
+
+def _json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class DeploymentCache:
+    """
+    Local SQLite copy of Deployments table items, keyed by (stack_env,
+    timestamp). Syncing only downloads items newer than the latest cached
+    item (high-water mark) of each stack_env, and is skipped altogether for
+    stacks whose entry in the latest deployment index is not newer than that.
+    Questions such as "what was deployed in env X at time T" are then answered
+    locally, without any Dynamodb query.
+
+    Timestamps are the ISO 8601 strings of the table's sort key and are
+    compared as strings. An instance can be shared by several threads.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("DEPLOYMENT_CACHE_PATH", DEFAULT_CACHE_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, check_same_thread=False
+        )
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS deployments ("
+                "stack_env TEXT, timestamp TEXT, environment TEXT, item TEXT, "
+                "PRIMARY KEY (stack_env, timestamp))"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS deployments_by_environment "
+                "ON deployments (environment, stack_env, timestamp)"
+            )
+
+    def high_water_mark(self, stack_env):
+        """
+        Returns:
+            Timestamp of the latest cached deployment of stack_env, or None
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT MAX(timestamp) FROM deployments WHERE stack_env = ?",
+                (stack_env,),
+            ).fetchone()[0]
+
+    def add(self, items):
+        """
+        Args:
+            items: Deployments table items
+
+        Returns:
+            Number of items added
+        """
+        rows = [
+            (
+                item["stack_env"],
+                item["timestamp"],
+                item.get("environment"),
+                json.dumps(item, default=_json_default),
+            )
+            for item in items
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO deployments VALUES (?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def sync(self, deployments_table, stack_env):
+        """
+        Downloads the deployments of stack_env more recent than the high-water
+        mark
+
+        Returns:
+            Number of new items
+        """
+        high_water_mark = self.high_water_mark(stack_env)
+        # read everything before writing, so that the lock is not held while
+        # waiting for Dynamodb
+        items = [
+            item
+            for item in deployments_table.iter_deployments(
+                stack_env, start=high_water_mark, newest_first=False
+            )
+            if high_water_mark is None or item["timestamp"] > high_water_mark
+        ]
+        return self.add(items)
+
+    def sync_environment(self, deployments_table, environment, stack_names):
+        """
+        Syncs the stacks of environment, reading the latest deployment index
+        first so that stacks without new deployments are not queried
+
+        Returns:
+            Dict of stack_env values mapped to their number of new items
+        """
+        snapshot = deployments_table.query_latest_deployments(
+            environment=environment, attributes=("deployment_timestamp",)
+        )
+        new_items = dict()
+        for stack_name in stack_names:
+            stack_env = f"{stack_name}-{environment}"
+            latest = snapshot.get(stack_env)
+            high_water_mark = self.high_water_mark(stack_env)
+            if (
+                latest is not None
+                and high_water_mark is not None
+                and latest["deployment_timestamp"] <= high_water_mark
+            ):
+                new_items[stack_env] = 0
+            else:
+                new_items[stack_env] = self.sync(deployments_table, stack_env)
+        return new_items
+
+    def latest_deployment(self, stack_env, at=None):
+        """
+        Args:
+            at: optional timestamp; defaults to the latest cached deployment
+
+        Returns:
+            The latest cached deployment item of stack_env at or before at, or
+            None
+        """
+        query = "SELECT item FROM deployments WHERE stack_env = ?"
+        params = [stack_env]
+        if at is not None:
+            query += " AND timestamp <= ?"
+            params.append(at)
+        with self._lock:
+            row = self._connection.execute(
+                f"{query} ORDER BY timestamp DESC LIMIT 1", params
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def deployed_at(self, environment, at):
+        """
+        Returns:
+            Dict of the stack_env values of environment mapped to their latest
+            deployment item at or before timestamp at
+        """
+        with self._lock:
+            # SQLite returns the item of the row holding MAX(timestamp)
+            rows = self._connection.execute(
+                "SELECT stack_env, item, MAX(timestamp) FROM deployments "
+                "WHERE environment = ? AND timestamp <= ? GROUP BY stack_env",
+                (environment, at),
+            ).fetchall()
+        return {stack_env: json.loads(item) for stack_env, item, _ in rows}
+
+    def close(self):
+        self._connection.close()
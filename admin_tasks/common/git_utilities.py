@@ -16,11 +16,25 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import bisect
+import datetime
 import functools
+import json
 import os
 import subprocess
+import tempfile
+import threading
 from dateutil import parser
 
+import admin_tasks.common.profiling as profiling
+
+
+CLOC_OPTIONS = [
+    "--exclude-dir=vendors,public",
+    "--exclude-ext=sty",
+]
+REGULAR_FILE_MODES = ["100644", "100755"]
+
 
 class DetailedCalledProcessError(subprocess.CalledProcessError):
     def __init__(self, called_process_error):
@@ -33,10 +47,13 @@ class DetailedCalledProcessError(subprocess.CalledProcessError):
 
 
 def detailed_subprocess_error(func):
+    label = func.__qualname__
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
-            return func(*args, **kwargs)
+            with profiling.span(label, "git"):
+                return func(*args, **kwargs)
         except subprocess.CalledProcessError as called_process_error:
             detailed_error = DetailedCalledProcessError(called_process_error)
             raise detailed_error
@@ -44,147 +61,550 @@ def detailed_subprocess_error(func):
     return wrapper
 
 
-@detailed_subprocess_error
-def get_commit_delta_to_branch(revision, branch="origin/master"):
-    def get_delta():
-        return subprocess.run(
-            [
-                "git",
-                "rev-list",
-                "--left-right",
-                "--count",
-                f"{branch}...{revision}",
-            ],
+def run_subprocess(args, **kwargs):
+    """
+    subprocess.run, recorded as a span labelled with the command (e.g.
+    "git log") when profiling is enabled
+    """
+    with profiling.span(profiling.command_label(args), "subprocess"):
+        return subprocess.run(args, **kwargs)
+
+
+class GitRepo:
+    """
+    Handle on a local clone. Every command runs with cwd set to the clone's
+    folder rather than in the process working directory, so several repos can
+    be worked on concurrently (e.g. one thread per repo). Commands that change
+    the working tree or refs of a clone are serialised per GitRepo instance;
+    use get_repo to share instances (and their commit indexes) between callers.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        self._lock = threading.RLock()
+        self._commit_indexes = dict()
+        self._commit_deltas = dict()
+        self._fetched = False
+
+    def __repr__(self):
+        return f"GitRepo({self.path!r})"
+
+    @classmethod
+    @detailed_subprocess_error
+    def clone(cls, url, path, checkout=True):
+        cmd = ["git", "clone", "--quiet"]
+        if not checkout:
+            cmd.append("--no-checkout")
+        run_subprocess(
+            [*cmd, url, path],
             capture_output=True,
             check=True,
             text=True,
-        ).stdout.strip()
+        )
+        return get_repo(path)
+
+    def run(self, args, **kwargs):
+        """
+        Runs a git command in this repo
+
+        Returns:
+            CompletedProcess; raises CalledProcessError on failure
+        """
+        return run_subprocess(
+            ["git", *args],
+            cwd=self.path,
+            capture_output=True,
+            check=True,
+            text=kwargs.pop("text", True),
+            **kwargs,
+        )
 
-    try:
-        delta = get_delta()
-    except subprocess.CalledProcessError:
-        subprocess.run(["git", "fetch"])
-        delta = get_delta()
-    behind, ahead = delta.split("\t")
-    return behind, ahead
-
-
-@detailed_subprocess_error
-def get_revision_of_earliest_commit():
-    return subprocess.run(
-        [
-            "git",
-            "rev-list",
-            "--max-parents=0",
-            "origin/master",
-        ],
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
-
-
-@detailed_subprocess_error
-def checkout_master():
-    return subprocess.run(
-        ["git", "checkout", "master"],
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
-
-
-@detailed_subprocess_error
-def checkout_revision(revision: str, branch_name=None):
-    cmd = ["git", "checkout", revision]
-    if branch_name:
-        cmd += ["-b", branch_name]
-    return subprocess.run(
-        cmd,
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
-
-
-@detailed_subprocess_error
-def pull():
-    return subprocess.run(
-        ["git", "pull"],
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
-
-
-@detailed_subprocess_error
-def datetime_of_git_revision(revision):
-    return subprocess.run(
-        [
-            "git",
-            "show",
-            "-s",
-            "--format=%ci",
-            revision,
-        ],
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
+    def run_with_fetch_retry(self, args):
+        """
+        Runs a git command, fetching and trying again if it fails (e.g.
+        because a revision is only on the remote)
+        """
+        try:
+            return self.run(args).stdout
+        except subprocess.CalledProcessError:
+            with self._lock:
+                if self._fetched:
+                    # fetching again is unlikely to help
+                    raise
+                run_subprocess(["git", "fetch"], cwd=self.path)
+                self._fetched = True
+            return self.run(args).stdout
 
+    @detailed_subprocess_error
+    def get_commit_delta_to_branch(self, revision, branch="origin/master"):
+        delta = self.run_with_fetch_retry(
+            ["rev-list", "--left-right", "--count", f"{branch}...{revision}"]
+        ).strip()
+        behind, ahead = delta.split("\t")
+        return behind, ahead
 
-def date_earliest_commit_dict(project_folder, repositories):
-    pwd = os.getcwd()
-    earliest_commits = dict()
-    for r in repositories:
-        os.chdir(os.path.join(project_folder, r))
-        dt = datetime_of_git_revision(get_revision_of_earliest_commit())
-        date_earliest_commit = dt.split()[0]
-        earliest_commits[r] = parser.parse(date_earliest_commit)
-    os.chdir(pwd)
-    return earliest_commits
-
-
-@detailed_subprocess_error
-def get_branch_revision_at_timestamp(date_str, branch):
-    def get_revision():
-        return subprocess.run(
+    @detailed_subprocess_error
+    def get_commit_deltas_to_branch(self, revisions, branch="origin/master"):
+        """
+        Batched get_commit_delta_to_branch. The counts of all revisions come
+        from a single walk of the part of the commit graph that is not shared
+        by branch and every revision; results are memoised per (branch tip,
+        revision) for the lifetime of this instance. Fetches (once) if some
+        revisions are not found.
+
+        Returns:
+            Dict of revisions mapped to a (behind, ahead) tuple of ints, or to
+            None if they (or branch) do not name a commit in this clone
+        """
+        revisions = list(dict.fromkeys(revisions))
+        resolved = self.resolve_commits([branch, *revisions])
+        if None in resolved.values() and self.fetch_once():
+            resolved = self.resolve_commits([branch, *revisions])
+        tip = resolved[branch]
+        if tip is None:
+            return {r: None for r in revisions}
+        with self._lock:
+            missing = sorted(
+                {
+                    resolved[r]
+                    for r in revisions
+                    if resolved[r] is not None
+                    and (tip, resolved[r]) not in self._commit_deltas
+                }
+            )
+        if missing:
+            deltas = self._walk_commit_deltas(tip, missing)
+            with self._lock:
+                self._commit_deltas.update(
+                    {(tip, sha): delta for sha, delta in deltas.items()}
+                )
+        return {
+            r: None if resolved[r] is None else self._commit_deltas[(tip, resolved[r])]
+            for r in revisions
+        }
+
+    def _walk_commit_deltas(self, tip, shas):
+        """
+        Commits that are ancestors of tip and of every sha (i.e. of their
+        merge bases) count towards neither behind nor ahead, so only the
+        others are listed (children first). Each listed commit gets a bitmask
+        of the targets (bit 0: tip) it is reachable from, propagated from
+        children to parents.
+
+        Returns:
+            Dict of shas mapped to (behind, ahead) relative to tip
+        """
+        targets = [tip, *shas]
+        try:
+            merge_bases = self.run(["merge-base", "--octopus", *targets]).stdout.split()
+        except subprocess.CalledProcessError:
+            merge_bases = list()  # unrelated histories
+        output = self.run(
             [
-                "git",
                 "rev-list",
-                "-1",
-                "--before",
-                date_str,
-                branch,
+                "--topo-order",
+                "--parents",
+                *targets,
+                *[f"^{merge_base}" for merge_base in merge_bases],
+            ]
+        ).stdout
+        masks = dict()
+        for i, sha in enumerate(targets):
+            masks[sha] = masks.get(sha, 0) | (1 << i)
+        mask_counts = dict()
+        for line in output.splitlines():
+            commit, *parents = line.split()
+            mask = masks.pop(commit, 0)
+            mask_counts[mask] = mask_counts.get(mask, 0) + 1
+            for parent in parents:
+                masks[parent] = masks.get(parent, 0) | mask
+        deltas = dict()
+        for i, sha in enumerate(targets[1:], start=1):
+            behind, ahead = 0, 0
+            for mask, count in mask_counts.items():
+                if mask & 1 and not mask >> i & 1:
+                    behind += count
+                elif mask >> i & 1 and not mask & 1:
+                    ahead += count
+            deltas[sha] = (behind, ahead)
+        return deltas
+
+    @detailed_subprocess_error
+    def get_revision_of_earliest_commit(self):
+        return self.run(["rev-list", "--max-parents=0", "origin/master"]).stdout.strip()
+
+    @detailed_subprocess_error
+    def rev_parse(self, revision):
+        return self.run(["rev-parse", revision]).stdout.strip()
+
+    @detailed_subprocess_error
+    def checkout_master(self):
+        with self._lock:
+            return self.run(["checkout", "master"]).stdout.strip()
+
+    @detailed_subprocess_error
+    def checkout_revision(self, revision: str, branch_name=None):
+        cmd = ["checkout", revision]
+        if branch_name:
+            cmd += ["-b", branch_name]
+        with self._lock:
+            return self.run(cmd).stdout.strip()
+
+    @detailed_subprocess_error
+    def pull(self):
+        with self._lock:
+            return self.run(["pull"]).stdout.strip()
+
+    @detailed_subprocess_error
+    def fetch(self):
+        with self._lock:
+            output = self.run(["fetch", "--quiet"]).stdout.strip()
+            self._fetched = True
+            return output
+
+    def fetch_once(self):
+        """
+        Fetches unless this instance has already fetched. Remote-tracking
+        branches (e.g. origin/master) are updated; the working tree is not.
+
+        Returns:
+            True if a fetch was done
+        """
+        with self._lock:
+            if self._fetched:
+                return False
+            self.fetch()
+            return True
+
+    @detailed_subprocess_error
+    def datetime_of_git_revision(self, revision):
+        return self.run(["show", "-s", "--format=%ci", revision]).stdout.strip()
+
+    @detailed_subprocess_error
+    def resolve_commits(self, revisions):
+        """
+        Resolves several revisions with a single git cat-file --batch-check call
+
+        Returns:
+            Dict of revisions mapped to their full commit SHA, or to None if
+            they do not name a commit in this clone (missing or ambiguous)
+        """
+        revisions = list(dict.fromkeys(revisions))
+        if not revisions:
+            return dict()
+        output = self.run(
+            ["cat-file", "--batch-check=%(objectname) %(objecttype)"],
+            input="".join(f"{r}^{{commit}}\n" for r in revisions),
+        ).stdout
+        resolved = dict()
+        for revision, line in zip(revisions, output.splitlines()):
+            # unresolved revisions are reported as "<revision> missing"
+            sha, _, object_type = line.rpartition(" ")
+            resolved[revision] = sha if object_type == "commit" else None
+        return resolved
+
+    @detailed_subprocess_error
+    def datetimes_of_revisions(self, revisions):
+        """
+        Batched datetime_of_git_revision: two git calls whatever the number of
+        revisions
+
+        Returns:
+            Dict of revisions mapped to their commit date (in git's %ci
+            format), or to None if they do not name a commit in this clone
+        """
+        resolved = self.resolve_commits(revisions)
+        shas = sorted({sha for sha in resolved.values() if sha})
+        dates = dict()
+        if shas:
+            output = self.run(
+                ["log", "--no-walk=unsorted", "--stdin", "--format=%H %ci"],
+                input="".join(f"{sha}\n" for sha in shas),
+            ).stdout
+            for line in output.splitlines():
+                sha, _, date = line.partition(" ")
+                dates[sha] = date
+        return {r: dates.get(sha) if sha else None for r, sha in resolved.items()}
+
+    def get_commit_index(self, branch="origin/master", refresh=False):
+        """
+        Returns the FirstParentCommitIndex of branch, building it on first use
+        or if refresh is True (e.g. after a fetch)
+        """
+        with self._lock:
+            if refresh or branch not in self._commit_indexes:
+                self._commit_indexes[branch] = FirstParentCommitIndex(self, branch)
+            return self._commit_indexes[branch]
+
+    @detailed_subprocess_error
+    def get_branch_revision_at_timestamp(self, date_str, branch):
+        return self.run_with_fetch_retry(
+            ["rev-list", "-1", "--before", date_str, branch]
+        ).strip()
+
+    @detailed_subprocess_error
+    def count_lines_of_code_for_revision(self, revision):
+        """
+        Uses the cloc command line tool (https://github.com/AlDanial/cloc)
+        """
+        return run_subprocess(
+            [
+                "cloc",
+                *CLOC_OPTIONS,
+                "--json",
+                "--git",
+                revision,
             ],
+            cwd=self.path,
             capture_output=True,
             check=True,
             text=True,
         ).stdout.strip()
 
-    try:
-        git_revision = get_revision()
-    except subprocess.CalledProcessError:
-        subprocess.run(["git", "fetch"])
-        git_revision = get_revision()
-    return git_revision
+    @detailed_subprocess_error
+    def list_blobs_at_revision(self, revision):
+        """
+        Returns:
+            Dict of regular file paths in revision mapped to their blob SHA
+        """
+        output = self.run(["ls-tree", "-r", "-z", revision]).stdout
+        blobs = dict()
+        for entry in output.split("\0"):
+            if not entry:
+                continue
+            metadata, path = entry.split("\t", 1)
+            mode, _, sha = metadata.split()
+            if mode in REGULAR_FILE_MODES:
+                blobs[path] = sha
+        return blobs
+
+    @detailed_subprocess_error
+    def get_changed_blobs(self, old_revision, new_revision):
+        """
+        Returns:
+            Tuple (changed, deleted), where changed is a dict of added or
+            modified regular file paths mapped to their new blob SHA and
+            deleted is a list of paths no longer present (as regular files)
+            in new_revision
+        """
+        output = self.run(
+            [
+                "diff",
+                "--raw",
+                "-z",
+                "--no-abbrev",
+                "--no-renames",
+                old_revision,
+                new_revision,
+            ]
+        ).stdout
+        changed, deleted = dict(), list()
+        fields = output.split("\0")
+        for metadata, path in zip(fields[0::2], fields[1::2]):
+            _, new_mode, _, new_sha, _ = metadata[1:].split()
+            if new_mode in REGULAR_FILE_MODES:
+                changed[path] = new_sha
+            else:
+                deleted.append(path)
+        return changed, deleted
+
+    @detailed_subprocess_error
+    def read_blobs(self, blob_shas):
+        """
+        Reads the contents of several blobs with a single git cat-file call
+
+        Returns:
+            Dict of blob SHAs mapped to their contents (bytes)
+        """
+        blob_shas = list(blob_shas)
+        if not blob_shas:
+            return dict()
+        output = self.run(
+            ["cat-file", "--batch"],
+            input="\n".join(blob_shas).encode() + b"\n",
+            text=False,
+        ).stdout
+        blobs = dict()
+        position = 0
+        for _ in blob_shas:
+            header_end = output.index(b"\n", position)
+            sha, _, size = output[position:header_end].decode().split()
+            content_start = header_end + 1
+            content_end = content_start + int(size)
+            blobs[sha] = output[content_start:content_end]
+            position = content_end + 1  # skip trailing newline
+        return blobs
+
+    @detailed_subprocess_error
+    def count_lines_of_code_by_file(self, blobs):
+        """
+        Runs cloc on a subset of the files in a revision
+
+        Args:
+            blobs (dict): file paths mapped to their blob SHA
+
+        Returns:
+            Tuple (header, counts): the cloc header and a dict of file paths
+            mapped to cloc's counts for that file (language, blank, comment,
+            code)
+        """
+        contents = self.read_blobs(set(blobs.values()))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for path, sha in blobs.items():
+                file_path = os.path.join(tmp_dir, path)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "wb") as f:
+                    f.write(contents[sha])
+            output = run_subprocess(
+                [
+                    "cloc",
+                    *CLOC_OPTIONS,
+                    "--skip-uniqueness",  # duplicates are handled by callers using blob SHAs
+                    "--by-file",
+                    "--json",
+                    tmp_dir,
+                ],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout.strip()
+        results = json.loads(output) if output else dict()
+        header = results.pop("header", dict())
+        results.pop("SUM", None)
+        counts = {
+            os.path.relpath(file_path, tmp_dir): file_counts
+            for file_path, file_counts in results.items()
+        }
+        return header, counts
+
+
+_repos = dict()
+_repos_lock = threading.Lock()
+
+
+def get_repo(path):
+    """
+    Returns:
+        The GitRepo of the clone at path, shared by all callers in this process
+    """
+    path = os.path.abspath(path)
+    with _repos_lock:
+        try:
+            return _repos[path]
+        except KeyError:
+            repo = GitRepo(path)
+            _repos[path] = repo
+            return repo
+
+
+class FirstParentCommitIndex:
+    """
+    In-memory index of the first-parent history of a branch, built with a
+    single git log call. Resolves the revision of the branch at any timestamp
+    with a binary search instead of a git rev-list call per timestamp.
+    """
+
+    def __init__(self, repo, branch="origin/master"):
+        self.repo = repo
+        self.branch = branch
+        self.revisions = list()  # oldest first
+        self.commit_timestamps = list()
+        self.earliest_commit_date = None
+        self._suffix_min_timestamps = list()
+        self._build()
+
+    @detailed_subprocess_error
+    def _git_log(self):
+        return self.repo.run_with_fetch_retry(
+            [
+                "log",
+                "--first-parent",
+                "--reverse",
+                "--format=%H %ct %ci",
+                self.branch,
+            ]
+        )
+
+    def _build(self):
+        for line in self._git_log().splitlines():
+            revision, commit_timestamp, commit_datetime = line.split(" ", 2)
+            if self.earliest_commit_date is None:
+                self.earliest_commit_date = parser.parse(commit_datetime.split()[0])
+            self.revisions.append(revision)
+            self.commit_timestamps.append(int(commit_timestamp))
+
+        # commit timestamps are not guaranteed to increase along the history
+        # (e.g. rebased commits), but their suffix minimum is; the last commit
+        # whose suffix minimum is <= t is also the last commit made at or before t
+        suffix_min = float("inf")
+        self._suffix_min_timestamps = [None] * len(self.commit_timestamps)
+        for i in range(len(self.commit_timestamps) - 1, -1, -1):
+            suffix_min = min(suffix_min, self.commit_timestamps[i])
+            self._suffix_min_timestamps[i] = suffix_min
+
+    def revision_at(self, timestamp):
+        """
+        Args:
+            timestamp: datetime or date string; naive values are interpreted
+                in local time, and date-only strings as midnight
+
+        Returns:
+            The revision of the branch at timestamp or None if the branch
+            had no commits then
+        """
+        if isinstance(timestamp, str):
+            timestamp = parser.parse(timestamp)
+        i = bisect.bisect_right(self._suffix_min_timestamps, timestamp.timestamp())
+        if i == 0:
+            return None
+        return self.revisions[i - 1]
+
+    @property
+    def first_day_with_revision(self):
+        """
+        Returns:
+            Midnight (naive, local time) of the first day whose date string
+            revision_at resolves to a revision, i.e. the day after the
+            earliest commit, or None if the branch has no commits
+        """
+        if not self._suffix_min_timestamps:
+            return None
+        earliest = datetime.datetime.fromtimestamp(self._suffix_min_timestamps[0])
+        return datetime.datetime.combine(
+            earliest.date() + datetime.timedelta(days=1), datetime.time()
+        )
+
+
+def date_earliest_commit_dict(project_folder, repositories):
+    """
+    Returns:
+        Dict mapping each repo to the first day its metrics can be computed
+        for (see FirstParentCommitIndex.first_day_with_revision); earlier
+        days have no revision on origin/master
+    """
+    return {
+        r: get_repo(os.path.join(project_folder, r))
+        .get_commit_index("origin/master")
+        .first_day_with_revision
+        for r in repositories
+    }
 
 
-@detailed_subprocess_error
-def count_lines_of_code_for_revision(revision):
+def is_excluded_from_cloc(path, options=None):
     """
-    Uses the cloc command line tool (https://github.com/AlDanial/cloc)
+    Mirrors the --exclude-dir and --exclude-ext handling of cloc for a file path
     """
-    return subprocess.run(
-        [
-            "cloc",
-            "--exclude-dir=vendors,public",
-            "--exclude-ext=sty",
-            "--json",
-            "--git",
-            revision,
-        ],
-        capture_output=True,
-        check=True,
-        text=True,
-    ).stdout.strip()
+    if options is None:
+        options = CLOC_OPTIONS
+    excluded_dirs, excluded_exts = set(), set()
+    for o in options:
+        name, _, value = o.partition("=")
+        if name == "--exclude-dir":
+            excluded_dirs.update(value.split(","))
+        elif name == "--exclude-ext":
+            excluded_exts.update(value.split(","))
+    *dirs, filename = path.split("/")
+    if excluded_dirs.intersection(dirs):
+        return True
+    return filename.rpartition(".")[2] in excluded_exts
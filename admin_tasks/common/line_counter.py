@@ -0,0 +1,318 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+In-process alternative to running the cloc command line tool on each revision.
+Blobs are streamed from a single long-lived git cat-file --batch process per
+repo and lines are classified as code, comment or blank following cloc's
+rules for the languages used in thiscovery repos.
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+
+import admin_tasks.common.git_utilities as git_utils
+import admin_tasks.common.profiling as profiling
+
+
+class Language:
+    def __init__(self, name, line_comments=(), block_comments=()):
+        """
+        Args:
+            name: language name as reported by cloc
+            line_comments: markers that comment out the rest of a line
+            block_comments: (start, end) pairs of block comment markers
+        """
+        self.name = name
+        self.line_comments = line_comments
+        self.block_comments = block_comments
+
+    def _find_first(self, line, markers):
+        positions = [(line.find(m), m) for m in markers if m in line]
+        return min(positions) if positions else (-1, None)
+
+    def count_lines(self, text):
+        """
+        Returns:
+            Dict of blank, comment and code line counts
+        """
+        counts = {"blank": 0, "comment": 0, "code": 0}
+        block_starts = {start: end for start, end in self.block_comments}
+        block_end = None  # end marker of the block comment we are in, if any
+        lines = text.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        for line in lines:
+            if not line.strip():
+                counts["blank"] += 1
+                continue
+            code = ""
+            rest = line
+            while rest:
+                if block_end is not None:
+                    position = rest.find(block_end)
+                    if position == -1:
+                        rest = ""
+                    else:
+                        rest = rest[position + len(block_end) :]
+                        block_end = None
+                    continue
+                block_position, block_start = self._find_first(
+                    rest, block_starts.keys()
+                )
+                line_position, _ = self._find_first(rest, self.line_comments)
+                if line_position != -1 and (
+                    block_position == -1 or line_position < block_position
+                ):
+                    code += rest[:line_position]
+                    rest = ""
+                elif block_position != -1:
+                    code += rest[:block_position]
+                    rest = rest[block_position + len(block_start) :]
+                    block_end = block_starts[block_start]
+                else:
+                    code += rest
+                    rest = ""
+            if code.strip():
+                counts["code"] += 1
+            else:
+                counts["comment"] += 1
+        return counts
+
+
+class PythonLanguage(Language):
+    """
+    cloc treats docstrings (any text between triple quotes) as comments
+    """
+
+    def __init__(self):
+        super().__init__(
+            name="Python",
+            line_comments=("#",),
+            block_comments=(('"""', '"""'), ("'''", "'''")),
+        )
+
+
+HTML_COMMENT = ("<!--", "-->")
+
+LANGUAGES = {
+    ".py": PythonLanguage(),
+    ".yaml": Language("YAML", line_comments=("#",)),
+    ".yml": Language("YAML", line_comments=("#",)),
+    ".json": Language("JSON"),
+    ".js": Language("JavaScript", line_comments=("//",), block_comments=(("/*", "*/"),)),
+    ".mjs": Language("JavaScript", line_comments=("//",), block_comments=(("/*", "*/"),)),
+    ".html": Language("HTML", block_comments=(HTML_COMMENT,)),
+    ".htm": Language("HTML", block_comments=(HTML_COMMENT,)),
+    ".md": Language("Markdown", block_comments=(HTML_COMMENT,)),
+}
+
+
+def summarise_file_counts(file_counts, header):
+    """
+    Aggregates per-file counts into the same shape as the output of
+    GitRepo.count_lines_of_code_for_revision (header, one entry per
+    language and SUM). Like cloc, identical files (same blob) are only
+    counted once.
+    """
+    summary = dict()
+    total = {"nFiles": 0, "blank": 0, "comment": 0, "code": 0}
+    seen_blobs = set()
+    for counts in file_counts.values():
+        if counts["blob"] in seen_blobs:
+            continue
+        seen_blobs.add(counts["blob"])
+        language_total = summary.setdefault(
+            counts["language"], {"nFiles": 0, "blank": 0, "comment": 0, "code": 0}
+        )
+        for t in (language_total, total):
+            t["nFiles"] += 1
+            for k in ("blank", "comment", "code"):
+                t[k] += counts[k]
+    n_lines = total["blank"] + total["comment"] + total["code"]
+    return {
+        "header": {
+            **header,
+            "n_files": total["nFiles"],
+            "n_lines": n_lines,
+        },
+        **summary,
+        "SUM": total,
+    }
+
+
+def add_timing_to_header(summary, elapsed):
+    """
+    Adds the speed fields that cloc includes in its header to the output
+    of summarise_file_counts
+    """
+    elapsed = max(elapsed, 1e-6)
+    summary["header"].update(
+        {
+            "elapsed_seconds": elapsed,
+            "files_per_second": summary["header"]["n_files"] / elapsed,
+            "lines_per_second": summary["header"]["n_lines"] / elapsed,
+        }
+    )
+    return summary
+
+
+def get_language(path):
+    _, ext = os.path.splitext(path)
+    return LANGUAGES.get(ext.lower())
+
+
+class GitBlobReader:
+    """
+    Wraps a long-lived git cat-file --batch process running in repo_folder.
+    Reads from several threads are serialised.
+    """
+
+    def __init__(self, repo_folder):
+        self.repo_folder = repo_folder
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=self.repo_folder,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(self, sha):
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+            self._process.stdin.write(f"{sha}\n".encode())
+            self._process.stdin.flush()
+            header = self._process.stdout.readline().decode().split()
+            if len(header) != 3:
+                raise git_utils.DetailedCalledProcessError(
+                    subprocess.CalledProcessError(
+                        1, "git cat-file --batch", stderr=" ".join(header)
+                    )
+                )
+            size = int(header[2])
+            content = self._process.stdout.read(size)
+            self._process.stdout.read(1)  # trailing newline
+            return content
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process.stdout.close()
+                self._process = None
+
+
+class GitBlobLineCounter:
+    """
+    Line counting backend for StackLocCounter. Its output has the same shape
+    as GitRepo.count_lines_of_code_for_revision (header, one entry per
+    language and SUM). Files in other languages are not counted.
+    """
+
+    name = "git-blob"
+    version = "1.0"
+
+    def __init__(self):
+        self._readers = dict()  # one cat-file process per repo folder
+        self._readers_lock = threading.Lock()
+
+    @property
+    def cache_options(self):
+        return [self.name, self.version, *git_utils.CLOC_OPTIONS]
+
+    def get_reader(self, git_repo):
+        with self._readers_lock:
+            try:
+                return self._readers[git_repo.path]
+            except KeyError:
+                reader = GitBlobReader(git_repo.path)
+                self._readers[git_repo.path] = reader
+                return reader
+
+    def count_blob(self, git_repo, path, sha):
+        """
+        Returns:
+            Dict of language, blank, comment and code counts for a blob, or
+            None if the blob is empty or its language is not supported
+        """
+        language = get_language(path)
+        if language is None:
+            return None
+        content = self.get_reader(git_repo).read(sha)
+        if not content:
+            return None
+        return {
+            "language": language.name,
+            **language.count_lines(content.decode(errors="replace")),
+        }
+
+    @profiling.profiled("git")
+    def count_blobs(self, git_repo, blobs):
+        """
+        Same interface as GitRepo.count_lines_of_code_by_file
+
+        Args:
+            git_repo (GitRepo): repo containing the blobs
+            blobs (dict): file paths mapped to their blob SHA
+
+        Returns:
+            Tuple (header, counts): header and a dict of counted file paths
+            mapped to their counts
+        """
+        counts = dict()
+        for path, sha in blobs.items():
+            blob_counts = self.count_blob(git_repo, path, sha)
+            if blob_counts is not None:
+                counts[path] = blob_counts
+        header = {"cloc_url": "", "cloc_version": f"{self.name} {self.version}"}
+        return header, counts
+
+    @profiling.profiled("git")
+    def count_lines_of_code_for_revision(self, git_repo, revision):
+        start = time.monotonic()
+        blobs = dict()
+        seen_blobs = set()
+        for path, sha in git_repo.list_blobs_at_revision(revision).items():
+            if get_language(path) is None or git_utils.is_excluded_from_cloc(path):
+                continue
+            # only deduplicate counted files, so that an identical file in an
+            # unsupported language does not hide one that would be counted
+            if sha in seen_blobs:
+                continue
+            seen_blobs.add(sha)
+            blobs[path] = sha
+        header, counts = self.count_blobs(git_repo, blobs)
+        file_counts = {
+            path: {"blob": blobs[path], **blob_counts}
+            for path, blob_counts in counts.items()
+        }
+        summary = summarise_file_counts(file_counts, header)
+        return json.dumps(add_timing_to_header(summary, time.monotonic() - start))
+
+    def close(self):
+        with self._readers_lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = dict()
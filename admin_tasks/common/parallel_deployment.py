@@ -0,0 +1,202 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Deploys several stacks concurrently, up to a limit, while respecting
+ordering constraints between them (e.g. a stack that must only be deployed
+once the stacks it depends on have been). Used by sync_environments.py.
+"""
+import collections
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from prettytable import PrettyTable
+from thiscovery_dev_tools.aws_deployer import AwsDeployer
+
+import admin_tasks.common.git_utilities as git_utils
+
+
+DEPLOYED = "deployed"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+StackResult = collections.namedtuple(
+    "StackResult", ["stack_name", "revision", "status", "seconds", "error"]
+)
+
+
+def deploy_stack(stack_name, repo_path, revision):
+    """
+    Checks out revision and deploys it. AwsDeployer builds the stack in the
+    current working directory, so concurrent deployments must each run in
+    their own process (see DeploymentScheduler)
+    """
+    git_utils.get_repo(repo_path).checkout_revision(revision=revision)
+    os.chdir(repo_path)
+    AwsDeployer(stack_name=stack_name).main(skip_confirmation=True)
+
+
+def parse_dependencies(specs):
+    """
+    Args:
+        specs: strings such as "stack-b=stack-a,stack-c" (deploy stack-b after
+            stack-a and stack-c)
+
+    Returns:
+        Dict of stack names mapped to the set of stacks they depend on
+    """
+    dependencies = dict()
+    for spec in specs or list():
+        stack_name, _, depends_on = spec.partition("=")
+        if not depends_on:
+            raise ValueError(f"Invalid dependency {spec}; expected STACK=DEP[,DEP]")
+        dependencies.setdefault(stack_name.strip(), set()).update(
+            d.strip() for d in depends_on.split(",") if d.strip()
+        )
+    return dependencies
+
+
+class DeploymentScheduler:
+    def __init__(
+        self,
+        max_workers=4,
+        dependencies=None,
+        deploy=deploy_stack,
+        executor_class=ProcessPoolExecutor,
+        report=print,
+    ):
+        """
+        Args:
+            max_workers (int): maximum number of concurrent deployments
+            dependencies (dict): stack names mapped to the stacks that must be
+                deployed before them; stacks not being deployed in a run are
+                assumed to be up to date
+            deploy: function deploying a stack, called in a worker with the
+                keyword arguments stack_name, repo_path and revision
+            executor_class: concurrent.futures executor; the default runs each
+                deployment in its own process
+            report: function called with each progress message
+        """
+        self.max_workers = max_workers
+        self.dependencies = dependencies or dict()
+        self.deploy = deploy
+        self.executor_class = executor_class
+        self.report = report
+
+    def _check_for_cycles(self, stack_names):
+        visiting, visited = set(), set()
+
+        def visit(stack_name, path):
+            if stack_name in visiting:
+                raise ValueError(f"Circular dependency: {' -> '.join(path)}")
+            if stack_name in visited:
+                return
+            visiting.add(stack_name)
+            for dependency in self.dependencies.get(stack_name, set()):
+                if dependency in stack_names:
+                    visit(dependency, [*path, dependency])
+            visiting.remove(stack_name)
+            visited.add(stack_name)
+
+        for stack_name in stack_names:
+            visit(stack_name, [stack_name])
+
+    def run(self, jobs):
+        """
+        Args:
+            jobs (dict): stack names mapped to (repo_path, revision) tuples,
+                in the order they should be started when possible
+
+        Returns:
+            Dict of stack names mapped to their StackResult, in jobs order
+        """
+        self._check_for_cycles(jobs.keys())
+        dependencies = {
+            stack_name: self.dependencies.get(stack_name, set()) & jobs.keys()
+            for stack_name in jobs
+        }
+        pending = dict(jobs)
+        running = dict()
+        results = dict()
+        total = len(jobs)
+
+        def finish(stack_name, revision, status, seconds=0.0, error=None):
+            results[stack_name] = StackResult(
+                stack_name, revision, status, seconds, error
+            )
+            message = f"[{len(results)}/{total}] {stack_name} {status}"
+            if status != SKIPPED:
+                message += f" in {seconds:.0f}s"
+            if error:
+                message += f": {error}"
+            self.report(message)
+
+        with self.executor_class(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for stack_name, (repo_path, revision) in list(pending.items()):
+                    failed = [
+                        d
+                        for d in dependencies[stack_name]
+                        if d in results and results[d].status != DEPLOYED
+                    ]
+                    if failed:
+                        del pending[stack_name]
+                        finish(
+                            stack_name,
+                            revision,
+                            SKIPPED,
+                            error=f"not deployed: {', '.join(sorted(failed))}",
+                        )
+                    elif (
+                        len(running) < self.max_workers
+                        and dependencies[stack_name] <= results.keys()
+                    ):
+                        del pending[stack_name]
+                        future = executor.submit(
+                            self.deploy,
+                            stack_name=stack_name,
+                            repo_path=repo_path,
+                            revision=revision,
+                        )
+                        running[future] = (stack_name, revision, time.monotonic())
+                        self.report(f"{stack_name} started (revision {revision})")
+                if not running:
+                    # remaining stacks were skipped in this pass
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stack_name, revision, start = running.pop(future)
+                    error = future.exception()
+                    finish(
+                        stack_name,
+                        revision,
+                        FAILED if error else DEPLOYED,
+                        seconds=time.monotonic() - start,
+                        error=repr(error) if error else None,
+                    )
+        return {stack_name: results[stack_name] for stack_name in jobs}
+
+
+def summary_table(results):
+    table = PrettyTable()
+    table.field_names = ["Stack", "Revision", "Result", "Duration (s)", "Error"]
+    table.align["Error"] = "l"
+    for r in results.values():
+        table.add_row(
+            [r.stack_name, r.revision, r.status, round(r.seconds), r.error or ""]
+        )
+    return table
@@ -0,0 +1,342 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Lightweight profiling of admin scripts. When enabled, git/cloc helpers (see
+git_utilities.detailed_subprocess_error), the subprocesses they start and
+Dynamodb table calls are recorded as nested spans with their latency. A
+summary of the slowest calls and hot paths can be printed, and spans can be
+exported as a Chrome trace (open in chrome://tracing or ui.perfetto.dev).
+
+Disabled by default; spans are then no-ops.
+"""
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import types
+
+
+Span = collections.namedtuple(
+    "Span", ["name", "category", "start", "duration", "thread_id", "path", "args"]
+)
+
+_enabled = False
+_spans = list()
+_local = threading.local()
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    """
+    Starts recording spans and instruments the Dynamodb table classes
+    """
+    global _enabled
+    _enabled = True
+    # imported here so that importing this module has no side effects
+    import src.common.constants as const
+    from src.common.ddb_batch_writer import DdbBatchWriter
+
+    instrument_class(const.DeploymentsTable, "dynamodb")
+    instrument_class(const.CodeMetricsTable, "dynamodb")
+    instrument_class(DdbBatchWriter, "dynamodb", methods=["_write_batch"])
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    _spans.clear()
+
+
+def get_spans():
+    return list(_spans)
+
+
+def command_label(args):
+    """
+    Returns:
+        Short label for a command, e.g. "git log" or "cloc"
+    """
+    if isinstance(args, (str, bytes)):
+        args = [args]
+    args = [str(a) for a in args]
+    program = os.path.basename(args[0])
+    if program != "git":
+        return program
+    rest = args[1:]
+    while rest and rest[0].startswith("-"):
+        # skip global options, including those taking a value (-c, -C)
+        rest = rest[2:] if rest[0] in ["-c", "-C"] else rest[1:]
+    return f"git {rest[0]}" if rest else "git"
+
+
+class _SpanContext:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+        self.path = None
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = list()
+        stack.append(self.name)
+        self.path = tuple(stack)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        _spans.append(
+            Span(
+                self.name,
+                self.category,
+                self.start,
+                duration,
+                threading.get_ident(),
+                self.path,
+                self.args,
+            )
+        )
+
+
+def span(name, category="function", **args):
+    """
+    Context manager recording the latency of the code it wraps, if profiling
+    is enabled
+
+    Args:
+        name: label of the call, e.g. "GitRepo.pull" or "git log"
+        category: e.g. "git", "subprocess" or "dynamodb"
+        args: extra details saved in Chrome traces
+    """
+    if not _enabled:
+        return _NULL_CONTEXT
+    return _SpanContext(name, category, args)
+
+
+def _profiled_generator(func, label, category):
+    """
+    Wraps a generator function so that each iteration is recorded as a span
+    whose duration is the time spent producing items; the time the caller
+    spends between items is not included
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return (yield from func(*args, **kwargs))
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = list()
+        path = (*stack, label)
+        generator = func(*args, **kwargs)
+        start = time.perf_counter()
+        duration = 0.0
+        try:
+            while True:
+                # nested spans recorded while producing an item are attributed
+                # to this generator
+                stack.append(label)
+                resumed = time.perf_counter()
+                try:
+                    value = next(generator)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    duration += time.perf_counter() - resumed
+                    stack.pop()
+                yield value
+        finally:
+            generator.close()
+            _spans.append(
+                Span(label, category, start, duration, threading.get_ident(), path, {})
+            )
+
+    return wrapper
+
+
+def profiled(category="function", name=None):
+    """
+    Decorator recording each call of the decorated function as a span. Calls
+    of generator functions are recorded once iteration ends (see
+    _profiled_generator).
+    """
+
+    def decorator(func):
+        label = name or func.__qualname__
+        if inspect.isgeneratorfunction(func):
+            wrapper = _profiled_generator(func, label, category)
+            wrapper._profiled = True
+            return wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label, category):
+                return func(*args, **kwargs)
+
+        wrapper._profiled = True
+        return wrapper
+
+    return decorator
+
+
+def instrument_class(cls, category, methods=None):
+    """
+    Wraps methods of cls (by default, its public functions) with profiled.
+    Instrumenting a class more than once has no further effect.
+    """
+    if methods is None:
+        methods = [
+            name
+            for name, value in vars(cls).items()
+            if isinstance(value, types.FunctionType) and not name.startswith("_")
+        ]
+    for method_name in methods:
+        method = vars(cls)[method_name]
+        if getattr(method, "_profiled", False):
+            continue
+        setattr(cls, method_name, profiled(category)(method))
+
+
+def summary(top=15):
+    """
+    Returns:
+        Printable tables of the slowest calls, totals by call and hot paths
+        (call stacks ranked by total time)
+    """
+    # imported here because this module is also deployed with the
+    # UpdateCodeMetrics function, which does not ship prettytable
+    from prettytable import PrettyTable
+
+    spans = get_spans()
+    slowest = PrettyTable()
+    slowest.field_names = ["Call", "Category", "ms", "Path"]
+    slowest.align = "l"
+    for s in sorted(spans, key=lambda x: x.duration, reverse=True)[:top]:
+        slowest.add_row(
+            [s.name, s.category, round(s.duration * 1000, 1), " > ".join(s.path[:-1])]
+        )
+
+    by_name = dict()
+    by_path = dict()
+    for s in spans:
+        for key, totals in [(s.name, by_name), (s.path, by_path)]:
+            count, total, maximum = totals.get(key, (0, 0.0, 0.0))
+            totals[key] = (count + 1, total + s.duration, max(maximum, s.duration))
+
+    calls = PrettyTable()
+    calls.field_names = ["Call", "Count", "Total s", "Mean ms", "Max ms"]
+    calls.align = "l"
+    for name, (count, total, maximum) in sorted(
+        by_name.items(), key=lambda x: x[1][1], reverse=True
+    )[:top]:
+        calls.add_row(
+            [
+                name,
+                count,
+                round(total, 3),
+                round(total / count * 1000, 1),
+                round(maximum * 1000, 1),
+            ]
+        )
+
+    paths = PrettyTable()
+    paths.field_names = ["Hot path", "Count", "Total s"]
+    paths.align = "l"
+    for path, (count, total, _) in sorted(
+        by_path.items(), key=lambda x: x[1][1], reverse=True
+    )[:top]:
+        paths.add_row([" > ".join(path), count, round(total, 3)])
+
+    return (
+        f"Slowest calls:\n{slowest}\n\n"
+        f"Totals by call:\n{calls}\n\n"
+        f"Hot paths:\n{paths}"
+    )
+
+
+def export_chrome_trace(filename):
+    """
+    Saves spans in the Chrome trace event format
+    """
+    spans = get_spans()
+    origin = min((s.start for s in spans), default=0)
+    events = [
+        {
+            "name": s.name,
+            "cat": s.category,
+            "ph": "X",
+            "ts": round((s.start - origin) * 1e6, 1),
+            "dur": round(s.duration * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": s.thread_id,
+            "args": {k: str(v) for k, v in s.args.items()},
+        }
+        for s in spans
+    ]
+    with open(filename, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def add_arguments(parser):
+    """
+    Adds --profile and --profile-trace options to an argparse parser
+    """
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the slowest git/cloc and Dynamodb calls and hot paths",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="Also save a Chrome trace of profiled calls to FILE (implies --profile)",
+    )
+
+
+def enable_from_args(args):
+    """
+    Returns:
+        True if profiling was requested (and is now enabled)
+    """
+    if args.profile or args.profile_trace:
+        enable()
+        return True
+    return False
+
+
+def report(trace_file=None, top=15):
+    print(f"\nProfile ({len(_spans)} calls):")
+    print(summary(top=top))
+    if trace_file:
+        export_chrome_trace(trace_file)
+        print(f"Chrome trace saved to {trace_file}")
@@ -25,8 +25,10 @@ from local.dev_config import (
 )
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 import re
 import subprocess
+import threading
 import thiscovery_lib.utilities as utils
 from dateutil import parser
 from highcharts import Highchart
@@ -36,11 +38,17 @@ from thiscovery_lib.dynamodb_utilities import DdbBaseItem, Dynamodb
 import admin_tasks.common.git_utilities as git_utils
 import src.common.constants as const
 
-from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.cloc_cache import ClocCache
+from admin_tasks.common.code_metrics_series import CodeMetricsSeries
+from admin_tasks.common.code_metrics_utilities import (
+    NoRevisionAtTimestampError,
+    StackLocCounter,
+)
 
 
 # init globals
 metrics_table = const.CodeMetricsTable()
+cloc_cache = ClocCache()  # shared on disk with update_code_metrics.py
 thiscovery_loc_data_series = list()  # locs per timestamp
 stack_data_series = dict()  # locs per timestamp in a dict keyed by stack
 timestamps = list()
@@ -54,38 +62,128 @@ def append_stack_data_point(stack_name, data_point):
         stack_data_series[stack_name] = [data_point]
 
 
-def compute_graph_series():
-    pwd = os.getcwd()
+def iter_checkpoint(checkpoint_filename):
+    """
+    Streams the data points of a JSONL checkpoint file, skipping a trailing
+    line that may have been truncated by a crash
+
+    Yields:
+        Dicts with keys date, repo and loc, and error for data points that
+        could not be computed (loc 0)
+    """
+    try:
+        input_file = open(checkpoint_filename)
+    except FileNotFoundError:
+        return
+    with input_file:
+        for line in input_file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def truncate_partial_checkpoint_line(checkpoint_filename):
+    """
+    Removes a trailing line left incomplete by a crash, so that new data
+    points are not appended to it
+    """
+    with open(checkpoint_filename, "rb+") as checkpoint:
+        size = checkpoint.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        checkpoint.seek(size - 1)
+        if checkpoint.read(1) == b"\n":
+            return
+        position = size - 1
+        while position > 0:
+            checkpoint.seek(position - 1)
+            if checkpoint.read(1) == b"\n":
+                break
+            position -= 1
+        checkpoint.truncate(position)
+
+
+def compute_graph_series(
+    incremental=False,
+    line_counter=None,
+    blob_count_store=None,
+    checkpoint_filename=None,
+):
+    """
+    Args:
+        checkpoint_filename: if provided, each (date, repo, loc) data point is
+            appended to this JSONL file as soon as it is computed, and data
+            points already in the file (e.g. from an interrupted run) are
+            reused instead of being computed again. Data points that failed
+            are saved with an error flag and computed again on resume.
+    """
     earliest_commits = git_utils.date_earliest_commit_dict(GITHUB_FOLDER, REPOS)
+    previous_snapshots = dict()
+    checkpoint = None
+    completed_points = dict()
+    if checkpoint_filename is not None:
+        if os.path.exists(checkpoint_filename):
+            truncate_partial_checkpoint_line(checkpoint_filename)
+        completed_points = {
+            (p["date"], p["repo"]): p["loc"]
+            for p in iter_checkpoint(checkpoint_filename)
+            if not p.get("error")
+        }
+        if completed_points:
+            print(f"Resuming from {len(completed_points)} data points in {checkpoint_filename}")
+        checkpoint = open(checkpoint_filename, "a")
     ts = COMMIT_TIMESTAMPS[0]
     ts_end = COMMIT_TIMESTAMPS[1]
 
-    while ts != ts_end:
-        ts_str = str(ts.date())
-        print(f"Working on {ts_str}")
-        timestamps.append(ts_str)
-        thiscovery_loc_data_point = 0
-        for r in REPOS:
-            if ts < earliest_commits[r]:
-                append_stack_data_point(r, 0)
-            else:
-                os.chdir(os.path.join(GITHUB_FOLDER, r))
-                counter = StackLocCounter(stack_name=r, commit_timestamp=ts_str)
-                try:
-                    counter.compute_metrics()
-                except subprocess.CalledProcessError:
+    try:
+        while ts != ts_end:
+            ts_str = str(ts.date())
+            print(f"Working on {ts_str}")
+            timestamps.append(ts_str)
+            thiscovery_loc_data_point = 0
+            for r in REPOS:
+                failed = False
+                if (ts_str, r) in completed_points:
+                    stack_data_point = completed_points[(ts_str, r)]
+                elif ts < earliest_commits[r]:
                     stack_data_point = 0
                 else:
-                    stack_data_point = counter.loc
+                    counter = StackLocCounter(
+                        stack_name=r,
+                        commit_timestamp=ts_str,
+                        cloc_cache=cloc_cache,
+                        incremental=incremental,
+                        previous_snapshot=previous_snapshots.get(r),
+                        line_counter=line_counter,
+                        blob_count_store=blob_count_store,
+                        repo=git_utils.get_repo(os.path.join(GITHUB_FOLDER, r)),
+                    )
+                    try:
+                        counter.compute_metrics()
+                    except (subprocess.CalledProcessError, NoRevisionAtTimestampError):
+                        stack_data_point = 0
+                        failed = True
+                    else:
+                        stack_data_point = counter.loc
+                        previous_snapshots[r] = counter.snapshot()
+                if checkpoint is not None and (ts_str, r) not in completed_points:
+                    point = {"date": ts_str, "repo": r, "loc": stack_data_point}
+                    if failed:
+                        point["error"] = True
+                    checkpoint.write(json.dumps(point) + "\n")
+                    checkpoint.flush()
                 append_stack_data_point(r, stack_data_point)
 
                 # add stack loc to thiscovery total
                 thiscovery_loc_data_point += stack_data_point
 
-        # add timestamp total to thiscovery series
-        thiscovery_loc_data_series.append(thiscovery_loc_data_point)
-        ts = ts + TIMESTAMP_DELTA
-    os.chdir(pwd)
+            # add timestamp total to thiscovery series
+            thiscovery_loc_data_series.append(thiscovery_loc_data_point)
+            ts = ts + TIMESTAMP_DELTA
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
 
 
 def save_globals_to_file(output_filename):
@@ -98,10 +196,126 @@ def save_globals_to_file(output_filename):
         output.write(json.dumps(data))
 
 
+def load_globals_from_checkpoint(checkpoint_filename):
+    """
+    Loads a JSONL checkpoint written by compute_graph_series into the
+    globals. Dates for which some repo has no data point yet (i.e. the date
+    that was being worked on when an interrupted run stopped) are left out.
+    Data points recomputed on resume are appended after later dates and
+    replace the earlier (failed) data point of the same date and repo.
+    """
+    global timestamps
+    global thiscovery_loc_data_series
+    global stack_data_series
+    timestamps = list()
+    thiscovery_loc_data_series = list()
+    stack_data_series = dict()
+
+    def add_date(date, date_points):
+        if set(date_points.keys()) != set(REPOS):
+            print(f"Skipped incomplete data for {date}")
+            return
+        timestamps.append(date)
+        thiscovery_loc_data_series.append(sum(date_points.values()))
+        for r in REPOS:
+            append_stack_data_point(r, date_points[r])
+
+    points_by_date = dict()
+    for point in iter_checkpoint(checkpoint_filename):
+        points_by_date.setdefault(point["date"], dict())[point["repo"]] = point["loc"]
+    for date in sorted(points_by_date):
+        add_date(date, points_by_date[date])
+
+
+_thread_local = threading.local()
+
+
+def _thread_metrics_table():
+    # boto3 resources are not thread-safe, so each worker thread builds its
+    # own table once and reuses it for all the repos it queries
+    table = getattr(_thread_local, "metrics_table", None)
+    if table is None:
+        table = _thread_local.metrics_table = const.CodeMetricsTable()
+    return table
+
+
+def _query_repo_loc(repo, start, end):
+    table = _thread_metrics_table()
+    return {
+        i["timestamp"]: int(i["code"])
+        for i in table.query_daily_series(repo, start=start, end=end)
+    }
+
+
+def load_globals_from_ddb(start=None, end=None, max_workers=8):
+    """
+    Loads globals from the CodeMetrics table populated by update_code_metrics.py
+    instead of computing them from git history. Each repo's partition is
+    queried in a separate thread. Dates follow COMMIT_TIMESTAMPS and
+    TIMESTAMP_DELTA. Repos stored as change points (update_code_metrics.py
+    --change-points) are expanded into daily values; dates before the first
+    item of a repo count as 0 lines.
+
+    Args:
+        start, end: optional date strings restricting the COMMIT_TIMESTAMPS range
+    """
+    global timestamps
+    global thiscovery_loc_data_series
+    global stack_data_series
+    dates = list()
+    ts = COMMIT_TIMESTAMPS[0]
+    while ts != COMMIT_TIMESTAMPS[1]:
+        ts_str = str(ts.date())
+        if (start is None or ts_str >= start) and (end is None or ts_str <= end):
+            dates.append(ts_str)
+        ts = ts + TIMESTAMP_DELTA
+    if not dates:
+        timestamps, thiscovery_loc_data_series, stack_data_series = list(), list(), dict()
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        repo_locs = executor.map(
+            lambda r: _query_repo_loc(r, dates[0], dates[-1]), REPOS
+        )
+        series = CodeMetricsSeries(
+            dates=dates,
+            repos=REPOS,
+            loc=[[locs.get(d, 0) for d in dates] for locs in repo_locs],
+        )
+    timestamps, thiscovery_loc_data_series, stack_data_series = series.to_series()
+
+
+def save_globals_to_series_store(output_folder):
+    CodeMetricsSeries.from_series(timestamps, stack_data_series).save(output_folder)
+
+
+def load_globals_from_series_store(input_folder, start=None, end=None, frequency=None):
+    """
+    Loads globals from a CodeMetricsSeries folder, optionally restricted to
+    a date range and resampled to weekly ("W") or monthly ("M") data points
+    """
+    global timestamps
+    global thiscovery_loc_data_series
+    global stack_data_series
+    series = CodeMetricsSeries.load(input_folder).slice(start, end)
+    if frequency is not None:
+        series = series.resample(frequency)
+    timestamps, thiscovery_loc_data_series, stack_data_series = series.to_series()
+
+
 def load_globals_from_file(input_filename):
+    """
+    Loads a JSON file written by save_globals_to_file, a JSONL checkpoint
+    written by compute_graph_series or a folder written by
+    save_globals_to_series_store
+    """
     global timestamps
     global thiscovery_loc_data_series
     global stack_data_series
+    if os.path.isdir(input_filename):
+        return load_globals_from_series_store(input_filename)
+    if input_filename.endswith(".jsonl"):
+        return load_globals_from_checkpoint(input_filename)
     with open(input_filename) as input_file:
         data = json.loads(input_file.read())
         timestamps = data["timestamps"]
@@ -113,17 +327,10 @@ def sample_globals(step_size):
     global timestamps
     global thiscovery_loc_data_series
     global stack_data_series
-    timestamps = [
-        v for i, v in enumerate(timestamps) if i in range(0, len(timestamps), step_size)
-    ]
-    thiscovery_loc_data_series = [
-        v
-        for i, v in enumerate(thiscovery_loc_data_series)
-        if i in range(0, len(thiscovery_loc_data_series), step_size)
-    ]
+    timestamps = timestamps[::step_size]
+    thiscovery_loc_data_series = thiscovery_loc_data_series[::step_size]
     for key, value in stack_data_series.items():
-        value = [v for i, v in enumerate(value) if i in range(0, len(value), step_size)]
-        stack_data_series[key] = value
+        stack_data_series[key] = value[::step_size]
 
 
 def main():
@@ -180,7 +387,8 @@ def main():
 
 
 if __name__ == "__main__":
-    # compute_graph_series()
+    # compute_graph_series(checkpoint_filename="code_metrics.jsonl")
     # save_globals_to_file("code_metrics.json")
+    # load_globals_from_ddb()
     load_globals_from_file("code_metrics_2018_2021.json")
     main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Rewrites the CodeMetrics items of REPOS whose detail attribute is stored as a
+map so that detail is stored as compressed binary (see
+src/common/detail_encoding.py). Readers decode both formats, so items can be
+migrated while the table is in use and the script can be interrupted and run
+again.
+"""
+import local.secrets
+from local.dev_config import REPOS
+import thiscovery_lib.utilities as utils
+
+import src.common.constants as const
+import src.common.detail_encoding as detail_encoding
+
+
+def iter_map_detail_items(metrics_table, repo):
+    """
+    Yields the full items of repo whose detail attribute is a map
+    """
+    query_kwargs = {
+        "KeyConditionExpression": f"{metrics_table.partition} = :repo",
+        "ExpressionAttributeValues": {":repo": repo},
+    }
+    while True:
+        r = metrics_table.table.query(**query_kwargs)
+        for item in r["Items"]:
+            if isinstance(item.get("detail"), dict):
+                yield item
+        try:
+            query_kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+        except KeyError:
+            return
+
+
+def migrate_repo(metrics_table, repo, batch_writer):
+    """
+    Returns:
+        Number of items rewritten
+    """
+    migrated = 0
+    for item in iter_map_detail_items(metrics_table, repo):
+        detail = detail_encoding.decode_detail(item["detail"])
+        item["detail"] = detail_encoding.encode_detail(detail)
+        item["detail_encoding"] = detail_encoding.ZLIB_JSON
+        item["modified"] = str(utils.now_with_tz())
+        batch_writer.put(item)
+        migrated += 1
+    return migrated
+
+
+def main(metrics_table=None):
+    metrics_table = metrics_table or const.CodeMetricsTable()
+    with metrics_table.batch_writer() as batch_writer:
+        for r in REPOS:
+            print(f"Migrated {migrate_repo(metrics_table, r, batch_writer)} items of {r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,28 @@ from local.dev_config import (
     REPOS,
     DEPLOYMENT_HISTORY_GROUPING,
 )
+import argparse
 import os
 import subprocess
 import thiscovery_lib.utilities as utils
+from concurrent.futures import ThreadPoolExecutor
 from prettytable import PrettyTable
 
+import admin_tasks.common.ddb_registry as ddb_registry
 import admin_tasks.common.git_utilities as git_utils
+import admin_tasks.common.profiling as profiling
+from admin_tasks.common.deployment_cache import DeploymentCache
 from src.common.constants import DeploymentsTable
 
 
 ERROR_STR = "Error"
+# deployment attributes read by get_latest_deployment
+REPORT_ATTRIBUTES = (
+    "revision",
+    "created",
+    "epsagon_layer_version",
+    "thiscovery_lib_revision",
+)
 
 repos_table = PrettyTable()
 if DEPLOYMENT_HISTORY_GROUPING == "stack":
@@ -43,11 +55,19 @@ repos_table.field_names = [
 
 
 class StackDeploymentStatus:
-    def __init__(self, stack_name, env_name=None):
+    def __init__(self, stack_name, env_name=None, deployments_table=None, repo=None):
+        """
+        Args:
+            deployments_table (DeploymentsTable): defaults to the table of
+                env_name's AWS profile, shared through ddb_registry
+            repo (GitRepo): defaults to the clone of stack_name in GITHUB_FOLDER
+        """
         self.stack_name = stack_name
         self.env_name = env_name
         if env_name is None:
             self.env_name = SECRETS_NAMESPACE[1:-1]
+        self.deployments_table = deployments_table
+        self.repo = repo or git_utils.get_repo(os.path.join(GITHUB_FOLDER, stack_name))
 
         self.deployment_history = None
         self.deployed_revision = None
@@ -60,16 +80,18 @@ class StackDeploymentStatus:
         self.latest_deployment = None
         self.logger = utils.get_logger()
 
-    def get_deployment_history(self):
-        deployments_table = DeploymentsTable(
-            profile_name=utils.namespace2profile(utils.name2namespace(self.env_name)),
-            aws_namespace=self.env_name,  # force Dynamodb client to use this instead of the SECRETS_NAMESPACE config
-        )
-        self.deployment_history = deployments_table.query_recent_deployments(
-            stack_env=f"{self.stack_name}-{self.env_name}"
-        )["Items"]
+    def get_deployments_table(self):
+        if self.deployments_table is None:
+            self.deployments_table = ddb_registry.get_table(
+                DeploymentsTable,
+                profile_name=utils.namespace2profile(utils.name2namespace(self.env_name)),
+                aws_namespace=self.env_name,  # force Dynamodb client to use this instead of the SECRETS_NAMESPACE config
+            )
+        return self.deployments_table
+
+    def _set_latest_deployment(self, deployments):
         try:
-            self.latest_deployment = self.deployment_history[0]
+            self.latest_deployment = deployments[0]
         except IndexError:
             raise utils.ObjectDoesNotExistError(
                 f"No deployment found for stack {self.stack_name} in environment {self.env_name}",
@@ -81,30 +103,119 @@ class StackDeploymentStatus:
         self.thiscovery_lib_rev = self.latest_deployment.get(
             "thiscovery_lib_revision", "NA"
         )[:8]
+
+    def get_deployment_history(self):
+        """
+        Reads the complete deployment history of the stack in env_name
+
+        Returns:
+            List of deployment items, newest first
+        """
+        self.deployment_history = list(
+            self.get_deployments_table().iter_deployments(
+                stack_env=f"{self.stack_name}-{self.env_name}"
+            )
+        )
+        self._set_latest_deployment(self.deployment_history)
         return self.deployment_history
 
-    def get_deployed_revision_delta_to_master(self):
-        try:
-            (
-                self.deployed_revision_behind,
-                self.deployed_revision_ahead,
-            ) = git_utils.get_commit_delta_to_branch(self.deployed_revision)
-        except git_utils.DetailedCalledProcessError as err:
-            self.logger.error(err, extra={})
+    def get_latest_deployments_snapshot(self):
+        """
+        Returns:
+            Latest deployment of every stack in env_name, read from the
+            latest deployment index (see DeploymentsTable.put_latest_deployment)
+            in a single query
+        """
+        return self.get_deployments_table().query_latest_deployments(
+            environment=self.env_name, attributes=REPORT_ATTRIBUTES
+        )
+
+    def get_cached_deployment(self, cache, at=None):
+        """
+        Reads the latest deployment of the stack in env_name from a local
+        DeploymentCache, without querying Dynamodb
+
+        Args:
+            at: optional timestamp; if given, the deployment live at that time
+
+        Returns:
+            Latest deployment item
+        """
+        deployment = cache.latest_deployment(
+            f"{self.stack_name}-{self.env_name}", at=at
+        )
+        self._set_latest_deployment([] if deployment is None else [deployment])
+        return self.latest_deployment
+
+    def get_latest_deployment(self, snapshot=None):
+        """
+        Reads only the latest deployment of the stack in env_name, projected
+        to the attributes used in reports
+
+        Args:
+            snapshot (dict): output of get_latest_deployments_snapshot for
+                env_name; if the stack is not in it (e.g. it has not been
+                deployed since the index was introduced), its history is
+                queried instead
+
+        Returns:
+            Latest deployment item
+        """
+        stack_env = f"{self.stack_name}-{self.env_name}"
+        if snapshot and stack_env in snapshot:
+            deployments = [snapshot[stack_env]]
+        else:
+            deployments = self.get_deployments_table().get_latest_deployments(
+                stack_env=stack_env, attributes=REPORT_ATTRIBUTES
+            )
+        self._set_latest_deployment(deployments)
+        return self.latest_deployment
+
+    def set_deployed_revision_delta(self, revision_deltas):
+        """
+        Args:
+            revision_deltas (dict): output of GitRepo.get_commit_deltas_to_branch
+        """
+        delta = revision_deltas.get(self.deployed_revision)
+        if delta is None:
+            self.logger.error(
+                f"Could not compare {self.deployed_revision} with origin/master "
+                f"in {self.repo.path}",
+                extra={},
+            )
             self.deployed_revision_behind = ERROR_STR
             self.deployed_revision_ahead = ERROR_STR
+        else:
+            self.deployed_revision_behind, self.deployed_revision_ahead = delta
 
-    def get_deployed_revision_datetime(self):
-        git_utils.checkout_master()
-        git_utils.pull()
-        try:
-            self.deployed_revision_datetime = git_utils.datetime_of_git_revision(
-                self.deployed_revision
+    def get_deployed_revision_delta_to_master(self):
+        self.set_deployed_revision_delta(
+            self.repo.get_commit_deltas_to_branch([self.deployed_revision])
+        )
+
+    def set_deployed_revision_datetime(self, revision_datetimes):
+        """
+        Args:
+            revision_datetimes (dict): output of GitRepo.datetimes_of_revisions
+        """
+        self.deployed_revision_datetime = revision_datetimes.get(self.deployed_revision)
+        if self.deployed_revision_datetime is None:
+            self.logger.error(
+                f"Revision {self.deployed_revision} not found in {self.repo.path}",
+                extra={},
             )
-        except git_utils.DetailedCalledProcessError as err:
-            self.logger.error(err, extra={})
             self.deployed_revision_datetime = ERROR_STR
 
+    def get_deployed_revision_datetime(self):
+        """
+        Fetches the repo (once per run) and looks up the commit date of the
+        deployed revision, without touching the working tree
+        """
+        self.repo.fetch_once()
+        self.set_deployed_revision_datetime(
+            self.repo.datetimes_of_revisions([self.deployed_revision])
+        )
+
     def append_stack_report_to_repos_table(self):
         try:
             deployed_revision_datetime = self.deployed_revision_datetime[0:19]
@@ -136,30 +247,193 @@ class StackDeploymentStatus:
         )
 
 
-def main(r, e):
-    print(f"Working on {r} {e}")
-    os.chdir(os.path.join(GITHUB_FOLDER, r))
-    sds = StackDeploymentStatus(stack_name=r, env_name=e)
+def get_latest_deployment_or_na(sds, snapshot=None, cache=None, at=None):
+    print(f"Working on {sds.stack_name} {sds.env_name}")
     try:
-        sds.get_deployment_history()
+        if cache is None:
+            sds.get_latest_deployment(snapshot)
+        else:
+            sds.get_cached_deployment(cache, at=at)
     except utils.ObjectDoesNotExistError:
         sds.deployed_revision_behind = "NA"
         sds.deployed_revision_ahead = "NA"
         sds.deployed_revision = "NA"
+    return sds
+
+
+def update_repo_statuses(statuses):
+    """
+    Git work for statuses of the same repo: the repo is fetched once, and the
+    commit dates and ahead/behind counts of all deployed revisions are each
+    looked up in one batch
+    """
+    deployed_statuses = [s for s in statuses if s.latest_deployment is not None]
+    if not deployed_statuses:
+        return
+    repo = deployed_statuses[0].repo
+    repo.fetch_once()
+    revisions = [s.deployed_revision for s in deployed_statuses]
+    revision_datetimes = repo.datetimes_of_revisions(revisions)
+    revision_deltas = repo.get_commit_deltas_to_branch(revisions)
+    for sds in deployed_statuses:
+        sds.set_deployed_revision_datetime(revision_datetimes)
+        sds.set_deployed_revision_delta(revision_deltas)
+
+
+def sync_deployment_cache(cache, statuses, ddb_workers=8):
+    """
+    Brings cache up to date for the stacks and envs of statuses, syncing
+    envs in parallel
+    """
+    statuses_by_env = dict()
+    for sds in statuses:
+        statuses_by_env.setdefault(sds.env_name, list()).append(sds)
+    with ThreadPoolExecutor(max_workers=ddb_workers) as executor:
+        list(
+            executor.map(
+                lambda env_statuses: cache.sync_environment(
+                    env_statuses[0].get_deployments_table(),
+                    env_statuses[0].env_name,
+                    [sds.stack_name for sds in env_statuses],
+                ),
+                statuses_by_env.values(),
+            )
+        )
+
+
+def read_latest_deployments(statuses, ddb_workers=8):
+    """
+    Reads the latest deployment of each status from Dynamodb, in parallel
+    """
+    with ThreadPoolExecutor(max_workers=ddb_workers) as executor:
+        # one index query per env, then history queries only for stacks
+        # missing from the index
+        env_statuses = {sds.env_name: sds for sds in statuses}
+        snapshots = dict(
+            zip(
+                env_statuses,
+                executor.map(
+                    lambda sds: sds.get_latest_deployments_snapshot(),
+                    env_statuses.values(),
+                ),
+            )
+        )
+        # list() so that exceptions raised in threads are raised here
+        list(
+            executor.map(
+                lambda sds: get_latest_deployment_or_na(sds, snapshots[sds.env_name]),
+                statuses,
+            )
+        )
+
+
+def collect_statuses(
+    statuses, ddb_workers=8, git_workers=4, cache=None, sync_cache=True, at=None
+):
+    """
+    Fills in statuses concurrently: Dynamodb queries run in parallel, then git
+    work runs in parallel across repos (see update_repo_statuses). Rows
+    are added to repos_table in the order of statuses once all are done.
+
+    Args:
+        statuses (list): StackDeploymentStatus instances, in report order
+        ddb_workers (int): max number of concurrent Dynamodb queries
+        git_workers (int): max number of repos worked on concurrently
+        cache (DeploymentCache): if given, deployments are read from this
+            local cache, after syncing it unless sync_cache is False
+        at: optional timestamp; report what was deployed at that time (needs
+            cache)
+    """
+    if cache is None:
+        read_latest_deployments(statuses, ddb_workers=ddb_workers)
     else:
-        sds.get_deployed_revision_datetime()
-        sds.get_deployed_revision_delta_to_master()
-    sds.append_stack_report_to_repos_table()
+        if sync_cache:
+            sync_deployment_cache(cache, statuses, ddb_workers=ddb_workers)
+        for sds in statuses:
+            get_latest_deployment_or_na(sds, cache=cache, at=at)
 
+    statuses_by_repo = dict()
+    for sds in statuses:
+        statuses_by_repo.setdefault(sds.repo.path, list()).append(sds)
+    with ThreadPoolExecutor(max_workers=git_workers) as executor:
+        list(executor.map(update_repo_statuses, statuses_by_repo.values()))
 
-if __name__ == "__main__":
+    for sds in statuses:
+        sds.append_stack_report_to_repos_table()
+    return statuses
+
+
+def main(ddb_workers=8, git_workers=4, cache=None, sync_cache=True, at=None):
     if DEPLOYMENT_HISTORY_GROUPING == "stack":
-        for r in REPOS:
-            for e in ENVS:
-                main(r, e)
+        stack_envs = [(r, e) for r in REPOS for e in ENVS]
     else:
-        for e in ENVS:
-            for r in REPOS:
-                main(r, e)
+        stack_envs = [(r, e) for e in ENVS for r in REPOS]
+    # statuses of the same env share a DeploymentsTable (see ddb_registry)
+    statuses = [StackDeploymentStatus(stack_name=r, env_name=e) for r, e in stack_envs]
+    collect_statuses(
+        statuses,
+        ddb_workers=ddb_workers,
+        git_workers=git_workers,
+        cache=cache,
+        sync_cache=sync_cache,
+        at=at,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare deployed revisions of each stack with origin/master"
+    )
+    parser.add_argument(
+        "--ddb-workers",
+        type=int,
+        default=8,
+        help="Maximum number of concurrent Dynamodb queries",
+    )
+    parser.add_argument(
+        "--git-workers",
+        type=int,
+        default=4,
+        help="Maximum number of repos updated concurrently",
+    )
+    parser.add_argument(
+        "--deployment-cache",
+        action="store_true",
+        help="Keep a local copy of deployment histories and only download "
+        "deployments made since the previous run",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Read deployments from the local cache only (implies --deployment-cache)",
+    )
+    parser.add_argument(
+        "--at",
+        metavar="TIMESTAMP",
+        help="Report what was deployed at this ISO 8601 time, e.g. "
+        "2021-06-01T12:00:00 (implies --deployment-cache)",
+    )
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if profiling.enable_from_args(args):
+        profiling.instrument_class(StackDeploymentStatus, "function")
+    deployment_cache = None
+    if args.deployment_cache or args.offline or args.at:
+        deployment_cache = DeploymentCache()
+    main(
+        ddb_workers=args.ddb_workers,
+        git_workers=args.git_workers,
+        cache=deployment_cache,
+        sync_cache=not args.offline,
+        at=args.at,
+    )
     print("\nStack deployment status compared to origin/master:")
     print(repos_table)
+    if profiling.is_enabled():
+        profiling.report(trace_file=args.profile_trace)
+        table_stats = ddb_registry.registry.stats()
+        print(
+            f"Dynamodb sessions created: {table_stats['created']}; "
+            f"per-thread tables: {table_stats['thread_tables']}; "
+            f"reused: {table_stats['reused']}"
+        )
@@ -24,17 +24,28 @@ carry out integration testing.
 """
 import local.secrets
 from local.dev_config import (
-    GITHUB_FOLDER,
     SOURCE_ENV,
     TARGET_ENV,
     REPOS,
 )
+import argparse
 import os
 import sys
 from thiscovery_dev_tools.aws_deployer import AwsDeployer
 
-import admin_tasks.common.git_utilities as git_utils
-from admin_tasks.services_deployment_status import StackDeploymentStatus
+from admin_tasks.common.deployment_cache import DeploymentCache
+from admin_tasks.common.parallel_deployment import (
+    DEPLOYED,
+    DeploymentScheduler,
+    parse_dependencies,
+    summary_table,
+)
+from admin_tasks.services_deployment_status import (
+    StackDeploymentStatus,
+    get_latest_deployment_or_na,
+    read_latest_deployments,
+    sync_deployment_cache,
+)
 
 
 # IMPORTANT! Ensures all deployments can only be made to TARGET_ENV
@@ -53,22 +64,114 @@ class EnvSyncer:
         self.target_sds = StackDeploymentStatus(stack_name=stack_name, env_name=TARGET_ENV)
 
     def deploy_source_rev_to_target_env(self):
-        os.chdir(os.path.join(GITHUB_FOLDER, self.stack_name))
-        git_utils.checkout_revision(revision=self.source_sds.deployed_revision)
+        self.source_sds.repo.checkout_revision(revision=self.source_sds.deployed_revision)
+        # AwsDeployer builds the stack in the current working directory
+        os.chdir(self.source_sds.repo.path)
         deployer = AwsDeployer(stack_name=self.stack_name)
         print(f"\nInitiating deployment of {self.stack_name} to {TARGET_ENV}")
         deployer.main(skip_confirmation=True)
 
+    def needs_deployment(self):
+        return (
+            self.source_sds.latest_deployment is not None
+            and self.source_sds.deployed_revision != self.target_sds.deployed_revision
+        )
+
     def main(self):
-        self.source_sds.get_deployment_history()
-        self.target_sds.get_deployment_history()
-        if self.source_sds.deployed_revision != self.target_sds.deployed_revision:
+        """
+        Expects the latest deployments of source_sds and target_sds to have
+        been read (see read_deployments)
+        """
+        if self.source_sds.latest_deployment is None:
+            print(f"\nStack {self.stack_name} has not been deployed to {SOURCE_ENV}; skipped")
+        elif self.needs_deployment():
             self.deploy_source_rev_to_target_env()
         else:
             print(f"\nStack {self.stack_name} is already in sync in {SOURCE_ENV} and {TARGET_ENV}; skipped")
 
 
+def read_deployments(syncers, cache=None):
+    """
+    Reads the latest deployments of all syncers, from the latest deployment
+    index of each env or from a local DeploymentCache (synced first)
+    """
+    statuses = [sds for s in syncers for sds in (s.source_sds, s.target_sds)]
+    if cache is None:
+        read_latest_deployments(statuses)
+    else:
+        sync_deployment_cache(cache, statuses)
+        for sds in statuses:
+            get_latest_deployment_or_na(sds, cache=cache)
+
+
+def deploy_in_parallel(syncers, max_workers, dependencies=None):
+    """
+    Deploys out of sync stacks concurrently, each in its own process, up to
+    max_workers at a time and respecting dependencies (see
+    DeploymentScheduler)
+
+    Returns:
+        Dict of stack names mapped to their StackResult
+    """
+    jobs = dict()
+    for syncer in syncers:
+        if syncer.needs_deployment():
+            jobs[syncer.stack_name] = (
+                syncer.source_sds.repo.path,
+                syncer.source_sds.deployed_revision,
+            )
+        else:
+            syncer.main()  # reports why the stack is skipped
+    print(
+        f"\nDeploying {len(jobs)} stacks to {TARGET_ENV}, "
+        f"up to {max_workers} at a time"
+    )
+    results = DeploymentScheduler(
+        max_workers=max_workers, dependencies=dependencies
+    ).run(jobs)
+    print(f"\nSync of {TARGET_ENV} with {SOURCE_ENV}:")
+    print(summary_table(results))
+    return results
+
+
 if __name__ == "__main__":
-    for r in REPOS:
-        repo_env_syncer = EnvSyncer(stack_name=r)
-        repo_env_syncer.main()
+    parser = argparse.ArgumentParser(
+        description=f"Deploy the revisions deployed to {SOURCE_ENV} to {TARGET_ENV}"
+    )
+    parser.add_argument(
+        "--deployment-cache",
+        action="store_true",
+        help="Keep a local copy of deployment histories and only download "
+        "deployments made since the previous run",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        metavar="N",
+        help="Deploy up to N stacks at a time instead of one after another",
+    )
+    parser.add_argument(
+        "--depends-on",
+        action="append",
+        metavar="STACK=DEP[,DEP]",
+        help="With --parallel, only deploy STACK once DEP has been deployed "
+        "(can be repeated)",
+    )
+    args = parser.parse_args()
+    if args.depends_on and not args.parallel:
+        parser.error("--depends-on can only be used with --parallel")
+    env_syncers = [EnvSyncer(stack_name=r) for r in REPOS]
+    read_deployments(
+        env_syncers, cache=DeploymentCache() if args.deployment_cache else None
+    )
+    if args.parallel:
+        deployment_results = deploy_in_parallel(
+            env_syncers,
+            max_workers=args.parallel,
+            dependencies=parse_dependencies(args.depends_on),
+        )
+        if any(r.status != DEPLOYED for r in deployment_results.values()):
+            sys.exit(1)
+    else:
+        for repo_env_syncer in env_syncers:
+            repo_env_syncer.main()
@@ -23,37 +23,407 @@ from local.dev_config import (
     COMMIT_TIMESTAMPS,
     TIMESTAMP_DELTA,
 )
+import argparse
+import bisect
+import datetime
 import os
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import admin_tasks.common.git_utilities as git_utils
+import admin_tasks.common.profiling as profiling
 import src.common.constants as const
 
-from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.blob_count_store import BlobCountStore
+from admin_tasks.common.cloc_cache import ClocCache
+from admin_tasks.common.code_metrics_updater import CodeMetricsUpdater
+from admin_tasks.common.code_metrics_utilities import (
+    NoRevisionAtTimestampError,
+    StackLocCounter,
+)
+from admin_tasks.common.line_counter import GitBlobLineCounter
 
 
 metrics_table = const.CodeMetricsTable()
+cloc_cache = ClocCache()
+LINE_COUNTERS = {
+    "cloc": lambda: None,
+    GitBlobLineCounter.name: GitBlobLineCounter,
+}
 
 
-def main():
-    earliest_commits = git_utils.date_earliest_commit_dict(GITHUB_FOLDER, REPOS)
+def get_repo(repo_name):
+    return git_utils.get_repo(os.path.join(GITHUB_FOLDER, repo_name))
+
+
+def commit_timestamps():
+    """
+    Yields every timestamp in the configured COMMIT_TIMESTAMPS range
+    """
     ts = COMMIT_TIMESTAMPS[0]
     ts_end = COMMIT_TIMESTAMPS[1]
-
     while ts != ts_end:
+        yield ts
+        ts = ts + TIMESTAMP_DELTA
+
+
+def plan_work(earliest_commits, existing_timestamps=None):
+    """
+    Lists the (repo, date) pairs that are not in the CodeMetrics table yet,
+    using a single key-only query per repo
+
+    Args:
+        existing_timestamps (dict): timestamps stored for each repo, if
+            already known; queried otherwise
+
+    Returns:
+        Tuple (work, skipped): list of (repo, date string) pairs to process,
+        ordered by date, and the number of pairs already in the table
+    """
+    if existing_timestamps is None:
+        existing_timestamps = {r: metrics_table.query_timestamps(r) for r in REPOS}
+    work = list()
+    skipped = 0
+    for ts in commit_timestamps():
         ts_str = str(ts.date())
-        print(f"Working on {ts_str}")
         for r in REPOS:
             if ts < earliest_commits[r]:
                 continue
+            if ts_str in existing_timestamps[r]:
+                skipped += 1
+            else:
+                work.append((r, ts_str))
+    return work, skipped
+
+
+class StoredRevisions:
+    """
+    Revisions of the items of a repo in the CodeMetrics table, including
+    those written during the current run
+    """
+
+    def __init__(self, items):
+        self.revisions = {i["timestamp"]: i.get("revision") for i in items}
+        self.timestamps = sorted(self.revisions)
+
+    def before(self, ts_str):
+        """
+        Returns:
+            Revision of the latest item before ts_str, or None
+        """
+        index = bisect.bisect_left(self.timestamps, ts_str)
+        if index == 0:
+            return None
+        return self.revisions[self.timestamps[index - 1]]
+
+    def add(self, ts_str, revision):
+        if ts_str not in self.revisions:
+            bisect.insort(self.timestamps, ts_str)
+        self.revisions[ts_str] = revision
+
+
+def plan_change_point_work(earliest_commits):
+    """
+    Change-point alternative to plan_work: items are only written for dates
+    on which the master revision of a repo differs from that of the previous
+    item of the same repo. Resolving revisions only uses each repo's commit
+    index, so dates left out by earlier runs are cheap to check again.
+
+    Returns:
+        Tuple (work, skipped, unchanged): work and skipped as plan_work, and
+        the number of (repo, date) pairs left out because their revision did
+        not change
+    """
+    stored_items = {
+        r: metrics_table.query_repo_series(r, attributes=("revision",)) for r in REPOS
+    }
+    work, skipped = plan_work(
+        earliest_commits,
+        existing_timestamps={
+            r: {i["timestamp"] for i in items} for r, items in stored_items.items()
+        },
+    )
+    stored_revisions = {r: StoredRevisions(items) for r, items in stored_items.items()}
+    change_points = list()
+    unchanged = 0
+    for r, ts_str in work:
+        commit_index = get_repo(r).get_commit_index("origin/master")
+        revision = commit_index.revision_at(ts_str)
+        if revision is not None and revision == stored_revisions[r].before(ts_str):
+            unchanged += 1
+            continue
+        # dates with no revision are kept, so that errors are reported
+        stored_revisions[r].add(ts_str, revision)
+        change_points.append((r, ts_str))
+    return change_points, skipped, unchanged
+
+
+def plan_run(change_points=False):
+    """
+    Plans the work of main or backfill and reports the (repo, date) pairs
+    left out
 
-            os.chdir(os.path.join(GITHUB_FOLDER, r))
-            counter = StackLocCounter(stack_name=r, commit_timestamp=ts_str)
+    Returns:
+        Tuple (work, skipped, unchanged) as plan_change_point_work; unchanged
+        is always 0 unless change_points
+    """
+    earliest_commits = git_utils.date_earliest_commit_dict(GITHUB_FOLDER, REPOS)
+    if change_points:
+        work, skipped, unchanged = plan_change_point_work(earliest_commits)
+    else:
+        work, skipped = plan_work(earliest_commits)
+        unchanged = 0
+    print(f"Skipping {skipped} (repo, date) pairs already in the CodeMetrics table")
+    if change_points:
+        print(f"Skipping {unchanged} (repo, date) pairs whose revision did not change")
+    return work, skipped, unchanged
+
+
+def main(
+    incremental=False,
+    line_counter=None,
+    blob_count_store=None,
+    change_points=False,
+    compress_detail=False,
+):
+    """
+    Args:
+        incremental (bool): if True, each snapshot only runs cloc on the files
+            changed since the previous snapshot of the same repo
+        line_counter: optional alternative to cloc (see StackLocCounter)
+        blob_count_store (BlobCountStore): optional store of per-blob counts
+        change_points (bool): if True, only write items for dates on which
+            the revision of a repo changed (see plan_change_point_work)
+        compress_detail (bool): if True, store detail as compressed binary
+    """
+    work, _, _ = plan_run(change_points)
+    previous_snapshots = dict()
+
+    current_date = None
+    with metrics_table.batch_writer() as batch_writer:
+        for r, ts_str in work:
+            if ts_str != current_date:
+                current_date = ts_str
+                print(f"Working on {ts_str}")
+            counter = StackLocCounter(
+                stack_name=r,
+                commit_timestamp=ts_str,
+                cloc_cache=cloc_cache,
+                incremental=incremental,
+                previous_snapshot=previous_snapshots.get(r),
+                line_counter=line_counter,
+                blob_count_store=blob_count_store,
+                compress_detail=compress_detail,
+                repo=get_repo(r),
+            )
             try:
-                counter.populate_ddb(metrics_table)
-            except subprocess.CalledProcessError:
-                pass
-        ts = ts + TIMESTAMP_DELTA
+                counter.populate_ddb(batch_writer=batch_writer)
+            except (subprocess.CalledProcessError, NoRevisionAtTimestampError) as err:
+                print(f"Error processing {r} {ts_str}: {err}")
+            else:
+                previous_snapshots[r] = counter.snapshot()
+
+    if blob_count_store is not None:
+        print(f"Blob count store: {blob_count_store.stats()}")
+
+
+class BackfillProgress:
+    """
+    Prints progress and an estimated time to completion of a backfill run
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.completed = 0
+        self.errors = 0
+        self.start = time.monotonic()
+
+    def eta(self):
+        if not self.completed:
+            return None
+        elapsed = time.monotonic() - self.start
+        remaining = elapsed / self.completed * (self.total - self.completed)
+        return datetime.timedelta(seconds=round(remaining))
+
+    def update(self, repo, ts_str, error):
+        self.completed += 1
+        if error is None:
+            status = "done"
+        else:
+            self.errors += 1
+            status = f"error: {error}"
+        print(f"[{self.completed}/{self.total}] {repo} {ts_str} {status}; ETA {self.eta()}")
+
+
+_worker_cloc_cache = None
+_worker_line_counter = None
+_worker_blob_count_store = None
+_worker_compress_detail = False
+
+
+def _init_backfill_worker(line_counter_name, use_blob_count_store, compress_detail):
+    # each worker process needs its own git processes and database
+    # connections; cloc cache instances in all workers share the same folder
+    global _worker_cloc_cache, _worker_line_counter, _worker_blob_count_store
+    global _worker_compress_detail
+    _worker_compress_detail = compress_detail
+    _worker_cloc_cache = ClocCache()
+    _worker_line_counter = LINE_COUNTERS[line_counter_name]()
+    if use_blob_count_store:
+        _worker_blob_count_store = BlobCountStore()
+
+
+def _compute_metrics_item(repo, ts_str):
+    """
+    Runs in a worker process. Uploading is left to the parent process.
+
+    Returns:
+        Tuple (repo, ts_str, error, item)
+    """
+    counter = StackLocCounter(
+        stack_name=repo,
+        commit_timestamp=ts_str,
+        cloc_cache=_worker_cloc_cache,
+        line_counter=_worker_line_counter,
+        blob_count_store=_worker_blob_count_store,
+        compress_detail=_worker_compress_detail,
+        repo=get_repo(repo),
+    )
+    try:
+        counter.compute_metrics()
+    except (subprocess.CalledProcessError, NoRevisionAtTimestampError) as err:
+        return repo, ts_str, str(err), None
+    return repo, ts_str, None, counter.get_ddb_item_dict()
+
+
+def backfill(
+    workers=None,
+    line_counter_name="cloc",
+    use_blob_count_store=False,
+    change_points=False,
+    compress_detail=False,
+):
+    """
+    Parallel alternative to main. Spreads (repo, date) pairs across a pool of
+    worker processes and populates the same CodeMetrics items as main.
+
+    Args:
+        workers (int): number of worker processes; defaults to os.cpu_count()
+        line_counter_name (str): key of LINE_COUNTERS to use in workers
+        use_blob_count_store (bool): if True, workers share a BlobCountStore
+        change_points (bool): see main
+        compress_detail (bool): see main
+    """
+    work, skipped, unchanged = plan_run(change_points)
+    progress = BackfillProgress(total=len(work))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_backfill_worker,
+        initargs=(line_counter_name, use_blob_count_store, compress_detail),
+    ) as executor:
+        futures = [
+            executor.submit(_compute_metrics_item, r, ts_str) for r, ts_str in work
+        ]
+        # the batch writer starts a background thread, so it is only created
+        # once workers have been forked (all of them on the first submit with
+        # the fork start method); a worker forked while that thread held a
+        # lock would deadlock
+        with metrics_table.batch_writer() as batch_writer:
+            for future in as_completed(futures):
+                repo, ts_str, error, item = future.result()
+                if item is not None:
+                    batch_writer.put(item)
+                progress.update(repo, ts_str, error)
+    summary = (
+        f"Backfill finished: {progress.completed - progress.errors} populated, "
+        f"{progress.errors} errors, {skipped} skipped"
+    )
+    if change_points:
+        summary += f", {unchanged} unchanged"
+    print(summary)
+    if use_blob_count_store:
+        print(f"Blob count store: {BlobCountStore().stats()}")
 
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(description="Populate the CodeMetrics table")
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        help="Run a parallel backfill using this many worker processes",
+    )
+    arg_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only count files changed since the previous snapshot of each repo "
+        "(not supported in combination with --workers or --since-watermark)",
+    )
+    arg_parser.add_argument(
+        "--line-counter",
+        choices=LINE_COUNTERS.keys(),
+        default="cloc",
+        help="Backend used to count lines of code",
+    )
+    arg_parser.add_argument(
+        "--since-watermark",
+        action="store_true",
+        help="Do what the scheduled UpdateCodeMetrics function does: process days "
+        "since the last run of each repo (ignoring COMMIT_TIMESTAMPS) and "
+        "refresh rollups",
+    )
+    arg_parser.add_argument(
+        "--change-points",
+        action="store_true",
+        help="Only write an item when the master revision of a repo changed; "
+        "readers expand these into daily values (CodeMetricsTable.query_daily_series)",
+    )
+    arg_parser.add_argument(
+        "--compress-detail",
+        action="store_true",
+        help="Store the cloc output of each item as compressed binary instead of a map",
+    )
+    arg_parser.add_argument(
+        "--blob-count-store",
+        action="store_true",
+        help="Only count files whose git blob has not been counted before",
+    )
+    profiling.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    if args.incremental and (args.workers or args.since_watermark):
+        arg_parser.error(
+            "--incremental cannot be combined with --workers or --since-watermark"
+        )
+    if profiling.enable_from_args(args):
+        if args.workers:
+            print("Profiling only covers the parent process when using --workers")
+        profiling.instrument_class(StackLocCounter, "function")
+        profiling.instrument_class(CodeMetricsUpdater, "function")
+    if args.since_watermark:
+        updater = CodeMetricsUpdater(
+            repos=REPOS,
+            mirrors_folder=GITHUB_FOLDER,
+            metrics_table=metrics_table,
+            line_counter=LINE_COUNTERS[args.line_counter](),
+            change_points=args.change_points,
+            compress_detail=args.compress_detail,
+        )
+        print(updater.main())
+    elif args.workers:
+        backfill(
+            workers=args.workers,
+            line_counter_name=args.line_counter,
+            use_blob_count_store=args.blob_count_store,
+            change_points=args.change_points,
+            compress_detail=args.compress_detail,
+        )
+    else:
+        main(
+            incremental=args.incremental,
+            line_counter=LINE_COUNTERS[args.line_counter](),
+            blob_count_store=BlobCountStore() if args.blob_count_store else None,
+            change_points=args.change_points,
+            compress_detail=args.compress_detail,
+        )
+    if profiling.is_enabled():
+        profiling.report(trace_file=args.profile_trace)
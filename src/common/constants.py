@@ -15,25 +15,91 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import datetime
 from thiscovery_lib.dynamodb_utilities import DdbBaseTable
 
+from .ddb_batch_writer import DdbBatchWriter
+from .detail_encoding import decode_item
+
 
 STACK_NAME = "thiscovery-devops"
 
 
+def expand_change_points(items, start, end, sort="timestamp"):
+    """
+    Expands CodeMetrics items stored only when a repo's revision changed into
+    one item per day. Each day repeats the attributes of the latest item at
+    or before it; its original timestamp is kept as change_point.
+
+    Args:
+        items: item dicts sorted by sort key; the first one may predate start
+        start, end: inclusive date strings (e.g. "2021-01-31")
+
+    Returns:
+        List of item dicts, one per day from the first item (or start) to end
+    """
+    dense = list()
+    day = datetime.date.fromisoformat(start)
+    last_day = datetime.date.fromisoformat(end)
+    current = None
+    remaining = iter(items)
+    upcoming = next(remaining, None)
+    while day <= last_day:
+        day_str = str(day)
+        while upcoming is not None and upcoming[sort] <= day_str:
+            current = upcoming
+            upcoming = next(remaining, None)
+        if current is not None:
+            dense.append({**current, sort: day_str, "change_point": current[sort]})
+        day += datetime.timedelta(days=1)
+    return dense
+
+
+def key_condition_in_range(partition, partition_value, start=None, end=None):
+    """
+    Args:
+        partition: name of the partition key
+        start, end: optional inclusive bounds of the sort key, which must be
+            aliased as #ts in ExpressionAttributeNames
+
+    Returns:
+        Tuple (KeyConditionExpression, ExpressionAttributeValues)
+    """
+    key_condition = f"{partition} = :{partition}"
+    values = {f":{partition}": partition_value}
+    if start is not None and end is not None:
+        key_condition += " AND #ts BETWEEN :start AND :end"
+        values.update({":start": start, ":end": end})
+    elif start is not None:
+        key_condition += " AND #ts >= :start"
+        values[":start"] = start
+    elif end is not None:
+        key_condition += " AND #ts <= :end"
+        values[":end"] = end
+    return key_condition, values
+
+
 class DeploymentsTable(DdbBaseTable):
     name = "Deployments"
     partition = "stack_env"
     sort = "timestamp"
+    # reserved partition holding the latest deployment of each stack_env (the
+    # sort key of its items); stack names never start with an underscore
+    latest_partition = "_latest"
 
-    def __init__(self, correlation_id=None, profile_name=None, **kwargs):
+    def __init__(self, correlation_id=None, profile_name=None, table=None, **kwargs):
+        """
+        Args:
+            table: optional boto3 Table resource to use (e.g. a local stand-in)
+                instead of looking up the stack's table
+        """
         super().__init__(
             stack_name=STACK_NAME,
             correlation_id=correlation_id,
             profile_name=profile_name,
             **kwargs,
         )
-        self.table = None
+        self.table = table
 
     def get_table(self):
         if self.table is None:
@@ -47,18 +113,151 @@ class DeploymentsTable(DdbBaseTable):
             ScanIndexForward=False,
         )
 
+    def iter_deployments(
+        self,
+        stack_env,
+        start=None,
+        end=None,
+        attributes=None,
+        newest_first=True,
+        limit=None,
+        page_size=None,
+    ):
+        """
+        Lazily queries the deployment history of a stack_env, one page at a
+        time, following LastEvaluatedKey until all matching items (or limit
+        items) have been read
+
+        Args:
+            start, end: optional inclusive timestamp bounds (ISO 8601 strings)
+            attributes: names of the attributes to fetch besides timestamp;
+                all attributes if None
+            newest_first (bool): order of items
+            limit (int): maximum number of items to return
+            page_size (int): maximum number of items read by each query;
+                defaults to limit
+
+        Yields:
+            Deployment item dicts
+        """
+        self.get_table()
+        key_condition, values = key_condition_in_range(
+            self.partition, stack_env, start, end
+        )
+        query_kwargs = {
+            "KeyConditionExpression": key_condition,
+            "ExpressionAttributeValues": values,
+            "ScanIndexForward": not newest_first,
+        }
+        names = {"#ts": self.sort}
+        if attributes is not None:
+            names.update({f"#a{i}": a for i, a in enumerate(attributes)})
+            query_kwargs["ProjectionExpression"] = ", ".join(names.keys())
+        if attributes is not None or start is not None or end is not None:
+            # Dynamodb rejects unused attribute names
+            query_kwargs["ExpressionAttributeNames"] = names
+        page_size = page_size or limit
+        if page_size is not None:
+            query_kwargs["Limit"] = page_size
+        returned = 0
+        while True:
+            r = self.table.query(**query_kwargs)
+            for item in r["Items"]:
+                yield item
+                returned += 1
+                if returned == limit:
+                    return
+            try:
+                query_kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+            except KeyError:
+                return
+
+    def get_latest_deployments(self, stack_env, n=1, attributes=None):
+        """
+        Returns:
+            List of the n most recent deployments of stack_env, newest first
+        """
+        return list(self.iter_deployments(stack_env, attributes=attributes, limit=n))
+
+    def put_latest_deployment(self, item):
+        """
+        Copies a deployment item to the latest deployment index, unless the
+        index already holds a deployment of the same stack_env at least as
+        recent (e.g. when events are processed out of order)
+
+        Returns:
+            True if the index was updated
+        """
+        self.get_table()
+        try:
+            self.table.put_item(
+                Item={
+                    "created": item[self.sort],
+                    **item,
+                    self.partition: self.latest_partition,
+                    self.sort: item[self.partition],
+                    "deployment_timestamp": item[self.sort],
+                },
+                ConditionExpression="attribute_not_exists(#dt) OR #dt < :dt",
+                ExpressionAttributeNames={"#dt": "deployment_timestamp"},
+                ExpressionAttributeValues={":dt": item[self.sort]},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def query_latest_deployments(self, environment=None, attributes=None):
+        """
+        Reads the latest deployment index with a single (paginated) query
+
+        Args:
+            environment: only return deployments to this environment
+            attributes: names of the attributes to fetch besides stack_env;
+                all attributes if None
+
+        Returns:
+            Dict of stack_env values mapped to their latest deployment item
+        """
+        if attributes is not None:
+            attributes = tuple(dict.fromkeys((*attributes, "environment")))
+        return {
+            item[self.sort]: item
+            for item in self.iter_deployments(
+                self.latest_partition, attributes=attributes
+            )
+            if environment is None or item["environment"] == environment
+        }
+
 
 class CodeMetricsTable(DdbBaseTable):
     name = "CodeMetrics"
     partition = "repo"
     sort = "timestamp"
+    # reserved partitions used by the scheduled updater; repo names never
+    # start with an underscore
+    watermarks_partition = "_watermarks"
+    rollups_partition = "_rollups"
 
-    def __init__(self, correlation_id=None):
+    def __init__(self, correlation_id=None, table=None):
+        """
+        Args:
+            table: optional boto3 Table resource to use (e.g. a local stand-in)
+                instead of looking up the stack's table
+        """
         super().__init__(stack_name=STACK_NAME, correlation_id=correlation_id)
-        self.table = self._ddb_client.get_table(self.name)
+        if table is None:
+            table = self._ddb_client.get_table(self.name)
+        self.table = table
+
+    def batch_writer(self, **kwargs):
+        """
+        Returns:
+            DdbBatchWriter for this table; use as a context manager
+        """
+        return DdbBatchWriter(self.table, key_names=(self.partition, self.sort), **kwargs)
 
     def exact_query(self, partition_value, sort_value):
-        return self.table.query(
+        r = self.table.query(
             KeyConditionExpression=f"{self.partition} = :{self.partition} "
             f"AND #ts = :{self.sort}",
             ExpressionAttributeNames={
@@ -69,3 +268,199 @@ class CodeMetricsTable(DdbBaseTable):
                 f":{self.sort}": sort_value,
             },
         )
+        r["Items"] = [decode_item(i) for i in r["Items"]]
+        return r
+
+    def query_timestamps(self, partition_value):
+        """
+        Key-only, paginated query of all items of a repo
+
+        Returns:
+            Set of timestamps (sort key values) stored for partition_value
+        """
+        timestamps = set()
+        query_kwargs = {
+            "KeyConditionExpression": f"{self.partition} = :{self.partition}",
+            "ProjectionExpression": "#ts",
+            "ExpressionAttributeNames": {"#ts": self.sort},
+            "ExpressionAttributeValues": {f":{self.partition}": partition_value},
+        }
+        while True:
+            r = self.table.query(**query_kwargs)
+            timestamps.update(i[self.sort] for i in r["Items"])
+            try:
+                query_kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+            except KeyError:
+                return timestamps
+
+    def _projection_names(self, attributes):
+        if "detail" in attributes and "detail_encoding" not in attributes:
+            # needed to decode compressed detail (see detail_encoding.py)
+            attributes = (*attributes, "detail_encoding")
+        return {"#ts": self.sort, **{f"#a{i}": a for i, a in enumerate(attributes)}}
+
+    def query_repo_series(self, partition_value, start=None, end=None, attributes=("code",)):
+        """
+        Paginated query of the items of a repo in a timestamp range,
+        projecting only timestamp and the requested attributes
+
+        Args:
+            partition_value: repo name
+            start, end: optional inclusive timestamp bounds (e.g. "2021-01-31")
+            attributes: names of the attributes to fetch besides timestamp
+
+        Returns:
+            List of item dicts sorted by timestamp; detail is decoded whether
+            it is stored as a map or compressed
+        """
+        key_condition, values = key_condition_in_range(
+            self.partition, partition_value, start, end
+        )
+        names = self._projection_names(attributes)
+        query_kwargs = {
+            "KeyConditionExpression": key_condition,
+            "ProjectionExpression": ", ".join(names.keys()),
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        }
+        items = list()
+        while True:
+            r = self.table.query(**query_kwargs)
+            items.extend(decode_item(i) for i in r["Items"])
+            try:
+                query_kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+            except KeyError:
+                return items
+
+    def get_change_point(self, partition_value, timestamp, attributes=("code",)):
+        """
+        Returns:
+            The latest item of a repo at or before timestamp, projecting only
+            timestamp and the requested attributes, or None
+        """
+        names = self._projection_names(attributes)
+        r = self.table.query(
+            KeyConditionExpression=f"{self.partition} = :{self.partition} AND #ts <= :ts",
+            ProjectionExpression=", ".join(names.keys()),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={f":{self.partition}": partition_value, ":ts": timestamp},
+            ScanIndexForward=False,
+            Limit=1,
+        )
+        try:
+            return decode_item(r["Items"][0])
+        except IndexError:
+            return None
+
+    def query_daily_series(self, partition_value, start, end, attributes=("code",)):
+        """
+        Dense daily series of a repo, whether its items were stored daily or
+        only when its revision changed (see expand_change_points)
+
+        Args:
+            start, end: inclusive date strings (e.g. "2021-01-31")
+        """
+        items = self.query_repo_series(partition_value, start, end, attributes)
+        if not items or items[0][self.sort] > start:
+            previous = self.get_change_point(partition_value, start, attributes)
+            if previous is not None:
+                items.insert(0, previous)
+        return expand_change_points(items, start, end, sort=self.sort)
+
+    def get_latest_timestamp(self, partition_value):
+        r = self.table.query(
+            KeyConditionExpression=f"{self.partition} = :{self.partition}",
+            ProjectionExpression="#ts",
+            ExpressionAttributeNames={"#ts": self.sort},
+            ExpressionAttributeValues={f":{self.partition}": partition_value},
+            ScanIndexForward=False,
+            Limit=1,
+        )
+        try:
+            return r["Items"][0][self.sort]
+        except IndexError:
+            return None
+
+    def _get_special_item(self, partition_value, sort_value):
+        return self.table.get_item(
+            Key={self.partition: partition_value, self.sort: sort_value}
+        ).get("Item")
+
+    def get_watermark(self, repo):
+        """
+        Returns:
+            Watermark item of repo (last_processed_date, revision) or None
+        """
+        return self._get_special_item(self.watermarks_partition, repo)
+
+    def put_watermark(self, repo, last_processed_date, revision):
+        self.table.put_item(
+            Item={
+                self.partition: self.watermarks_partition,
+                self.sort: repo,
+                "last_processed_date": last_processed_date,
+                "revision": revision,
+            }
+        )
+
+    @staticmethod
+    def _rollup_key(frequency, year):
+        # one item per frequency and year, so that items do not grow without
+        # bound and a run only rewrites the years it touched
+        return f"{frequency}#{year}"
+
+    def get_rollup(self, frequency, year):
+        """
+        Args:
+            frequency: "weekly" or "monthly"
+            year (int or str): year of the first date of the periods
+
+        Returns:
+            Rollup item, whose periods attribute maps the first date of each
+            period starting in year to a map of repo LOCs, or None
+        """
+        return self._get_special_item(
+            self.rollups_partition, self._rollup_key(frequency, year)
+        )
+
+    def put_rollup(self, frequency, year, periods, modified):
+        self.table.put_item(
+            Item={
+                self.partition: self.rollups_partition,
+                self.sort: self._rollup_key(frequency, year),
+                "periods": periods,
+                "modified": modified,
+            }
+        )
+
+    def query_rollup_periods(self, frequency, first_year=None, last_year=None):
+        """
+        Args:
+            frequency: "weekly" or "monthly"
+            first_year, last_year: optional inclusive bounds
+
+        Returns:
+            Dict mapping the first date of each period to a map of repo LOCs,
+            merged from the rollup items of the requested years
+        """
+        key_condition, values = key_condition_in_range(
+            self.partition,
+            self.rollups_partition,
+            self._rollup_key(frequency, first_year or "0000"),
+            self._rollup_key(frequency, last_year or "9999"),
+        )
+        query_kwargs = {
+            "KeyConditionExpression": key_condition,
+            "ProjectionExpression": "periods",
+            "ExpressionAttributeNames": {"#ts": self.sort},
+            "ExpressionAttributeValues": values,
+        }
+        periods = dict()
+        while True:
+            r = self.table.query(**query_kwargs)
+            for item in r["Items"]:
+                periods.update(item["periods"])
+            try:
+                query_kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+            except KeyError:
+                return periods
@@ -0,0 +1,196 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import queue
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+from decimal import Decimal
+
+
+MAX_BATCH_SIZE = 25  # BatchWriteItem limit
+RETRYABLE_ERROR_CODES = [
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+    "InternalServerError",
+]
+
+_FLUSH = object()
+_STOP = object()
+
+
+def floats_to_decimal(value):
+    """
+    Returns:
+        A copy of value in which floats, including those nested in dicts and
+        lists, are converted to Decimal; other values (e.g. bytes) are kept
+    """
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: floats_to_decimal(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [floats_to_decimal(v) for v in value]
+    return value
+
+
+class BatchWriteError(Exception):
+    pass
+
+
+class DdbBatchWriter:
+    """
+    Buffers items and writes them to a Dynamodb table in BatchWriteItem
+    calls of up to 25 items. Unprocessed items and throttling errors are
+    retried with exponential backoff and full jitter.
+
+    Writes happen on a background thread, so callers can keep producing
+    items while earlier batches are uploaded. Errors raised by the
+    background thread are re-raised by the next call to put, flush or close.
+
+    Usage:
+        with DdbBatchWriter(table, key_names=("repo", "timestamp")) as writer:
+            writer.put(item)
+    """
+
+    def __init__(
+        self,
+        table,
+        key_names=None,
+        max_retries=10,
+        base_delay=0.05,
+        max_delay=10,
+        max_queued_items=1000,
+    ):
+        """
+        Args:
+            table: boto3 Dynamodb Table resource
+            key_names: partition and sort key names; if provided, only the
+                last item put for a given key is kept in each batch
+                (BatchWriteItem rejects batches with duplicate keys)
+            max_retries (int): attempts for a batch before giving up
+            base_delay (float): first retry delay upper bound, in seconds
+            max_delay (float): retry delay upper bound, in seconds
+            max_queued_items (int): put blocks once this many items are waiting
+        """
+        self.table = table
+        self.key_names = key_names
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.items_written = 0
+        self.batches_written = 0
+        self.retries = 0
+        self._client = table.meta.client
+        self._queue = queue.Queue(maxsize=max_queued_items)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _raise_background_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise BatchWriteError("Background batch write failed") from error
+
+    def put(self, item):
+        """
+        Queues an item for writing. Floats are converted to Decimal, as
+        required by boto3.
+        """
+        self._raise_background_error()
+        self._queue.put(floats_to_decimal(item))
+
+    def flush(self):
+        """
+        Blocks until all items put so far have been written
+        """
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._raise_background_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._raise_background_error()
+
+    def _backoff(self, attempt):
+        self.retries += 1
+        if attempt > self.max_retries:
+            raise BatchWriteError(
+                f"Batch write to {self.table.name} failed after {self.max_retries} retries"
+            )
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def _write_batch(self, items):
+        if self.key_names is not None:
+            items = list(
+                {tuple(i[k] for k in self.key_names): i for i in items}.values()
+            )
+        requests = [{"PutRequest": {"Item": i}} for i in items]
+        attempt = 0
+        while requests:
+            try:
+                response = self._client.batch_write_item(
+                    RequestItems={self.table.name: requests}
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] not in RETRYABLE_ERROR_CODES:
+                    raise
+                attempt += 1
+                self._backoff(attempt)
+                continue
+            requests = response.get("UnprocessedItems", dict()).get(self.table.name, [])
+            if requests:
+                attempt += 1
+                self._backoff(attempt)
+        self.items_written += len(items)
+        self.batches_written += 1
+
+    def _run(self):
+        batch = list()
+        while True:
+            message = self._queue.get()
+            try:
+                if message is _FLUSH or message is _STOP:
+                    self._write_batch_or_save_error(batch)
+                    batch = list()
+                    if message is _STOP:
+                        return
+                else:
+                    batch.append(message)
+                    if len(batch) == MAX_BATCH_SIZE:
+                        self._write_batch_or_save_error(batch)
+                        batch = list()
+            finally:
+                self._queue.task_done()
+
+    def _write_batch_or_save_error(self, batch):
+        if not batch:
+            return
+        try:
+            self._write_batch(batch)
+        except Exception as err:
+            self._error = err
@@ -0,0 +1,82 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Encodings of the detail attribute of CodeMetrics items (the full cloc output
+of a snapshot). Items written before compression was introduced store detail
+as a map. Compressed items store it as zlib-compressed JSON in a binary
+attribute and set detail_encoding, so readers can handle both during a
+migration.
+"""
+import json
+import zlib
+from decimal import Decimal
+
+
+ZLIB_JSON = "zlib+json"
+COMPRESSION_LEVEL = 9
+
+
+def encode_detail(detail):
+    """
+    Returns:
+        zlib-compressed, compact JSON of detail, stored as a binary attribute
+    """
+    return zlib.compress(
+        json.dumps(detail, separators=(",", ":")).encode("utf-8"), COMPRESSION_LEVEL
+    )
+
+
+def _from_ddb_numbers(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {k: _from_ddb_numbers(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_ddb_numbers(v) for v in value]
+    return value
+
+
+def decode_detail(value, encoding=None):
+    """
+    Args:
+        value: detail attribute as returned by boto3; a dict for items that
+            store detail as a map, or a Binary/bytes for compressed items
+        encoding: detail_encoding attribute of the item, if any
+
+    Returns:
+        detail as a dict of plain Python types, whichever way it was stored
+    """
+    if isinstance(value, dict):
+        return _from_ddb_numbers(value)
+    encoding = encoding or ZLIB_JSON
+    if encoding != ZLIB_JSON:
+        raise ValueError(f"Unsupported detail encoding {encoding}")
+    data = getattr(value, "value", value)  # boto3 returns Binary objects
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def decode_item(item):
+    """
+    Decodes the detail attribute of a CodeMetrics item in place, if present
+
+    Returns:
+        item
+    """
+    if "detail" in item:
+        item["detail"] = decode_detail(item["detail"], item.pop("detail_encoding", None))
+    return item
@@ -16,6 +16,7 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import thiscovery_lib.utilities as utils
+from botocore.exceptions import ClientError
 from thiscovery_lib.dynamodb_utilities import DdbBaseItem
 
 import common.constants as const
@@ -39,6 +40,18 @@ class Deployment(DdbBaseItem):
             table=const.DeploymentsTable(correlation_id=self._correlation_id)
         )
 
+    def put_latest(self):
+        """
+        Updates the latest deployment index of the Deployments table, unless
+        it already holds a more recent deployment of this stack_env
+        """
+        if not self._table.put_latest_deployment(self.as_dict()):
+            self._logger.info(
+                f"Newer deployment of {self.stack_env} already indexed; "
+                f"index not updated",
+                extra={"timestamp": self.timestamp},
+            )
+
 
 @utils.lambda_wrapper
 def add_deployment(event, context):
@@ -46,4 +59,17 @@ def add_deployment(event, context):
     Parses deployment events posted to the thiscovery event bus.
     """
     deployment = Deployment(event)
-    return deployment.put()
+    try:
+        result = deployment.put()
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # the history item was stored by a previous attempt at processing this
+        # event, which may have failed before updating the index
+        deployment._logger.info(
+            f"Deployment of {deployment.stack_env} already recorded",
+            extra={"timestamp": deployment.timestamp},
+        )
+        result = None
+    deployment.put_latest()
+    return result
@@ -0,0 +1,145 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import os
+import shutil
+import subprocess
+import tempfile
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.common.git_utilities as git_utils
+from admin_tasks.common.blob_count_store import BlobCountStore
+from admin_tasks.common.line_counter import GitBlobLineCounter, Language
+
+
+BUILD_FILE = "# build\nall:\n\techo done\n"
+# each commit maps paths to their new content, or to None if deleted
+COMMITS = [
+    {"Dockerfile": BUILD_FILE, "src/main.py": "import os\n\nx = 1\n"},
+    {"Dockerfile": None, "Makefile": BUILD_FILE},
+]
+
+
+class NamedFileLineCounter(GitBlobLineCounter):
+    """
+    Also counts files recognised by name rather than extension, as cloc does
+    """
+
+    name = "named-files"
+    NAMED_LANGUAGES = {
+        "Dockerfile": Language("Dockerfile", line_comments=("#",)),
+        "Makefile": Language("make", line_comments=("#",)),
+    }
+
+    def count_blob(self, git_repo, path, sha):
+        language = self.NAMED_LANGUAGES.get(os.path.basename(path))
+        if language is None:
+            return super().count_blob(git_repo, path, sha)
+        content = self.get_reader(git_repo).read(sha).decode()
+        return {"language": language.name, **language.count_lines(content)}
+
+
+class BlobCountStoreTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        repo_folder = os.path.join(cls.folder, "repo")
+        os.makedirs(repo_folder)
+        cls.revisions = list()
+        subprocess.run(["git", "init", "-q"], check=True, cwd=repo_folder)
+        for i, files in enumerate(COMMITS):
+            for path, content in files.items():
+                file_path = os.path.join(repo_folder, path)
+                if content is None:
+                    os.remove(file_path)
+                    continue
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+            for cmd in [
+                ["git", "add", "-A"],
+                [
+                    "git",
+                    "-c",
+                    "user.name=test",
+                    "-c",
+                    "user.email=test@example.com",
+                    "commit",
+                    "-q",
+                    "-m",
+                    f"Commit {i}",
+                ],
+            ]:
+                subprocess.run(cmd, check=True, cwd=repo_folder)
+            cls.revisions.append(
+                subprocess.run(
+                    ["git", "rev-parse", "HEAD"],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    cwd=repo_folder,
+                ).stdout.strip()
+            )
+        cls.repo = git_utils.GitRepo(repo_folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.store = BlobCountStore(os.path.join(self.folder, "blob_counts.sqlite3"))
+        self.line_counter = NamedFileLineCounter()
+
+    def tearDown(self):
+        self.line_counter.close()
+        self.store.close()
+        os.remove(self.store.path)
+
+    def count(self, revision):
+        return self.store.count_lines_of_code_for_revision(
+            self.repo, revision, self.line_counter
+        )
+
+    def test_file_type_ok(self):
+        self.assertEqual(".py", BlobCountStore._file_type("src/Main.PY"))
+        self.assertEqual("Dockerfile", BlobCountStore._file_type("docker/Dockerfile"))
+        self.assertEqual(".gitignore", BlobCountStore._file_type(".gitignore"))
+
+    def test_extensionless_files_keyed_by_name_ok(self):
+        first = self.count(self.revisions[0])
+        self.assertEqual({"nFiles": 1, "blank": 0, "comment": 1, "code": 2}, first["Dockerfile"])
+        # same blob as the earlier Dockerfile, but counted as a Makefile
+        second = self.count(self.revisions[1])
+        self.assertNotIn("Dockerfile", second)
+        self.assertEqual({"nFiles": 1, "blank": 0, "comment": 1, "code": 2}, second["make"])
+        self.assertEqual((1, 3), (self.store.hits, self.store.misses))
+
+    def test_recount_served_from_store_ok(self):
+        expected = [self.count(r) for r in self.revisions]
+        misses = self.store.misses
+        results = [self.count(r) for r in self.revisions]
+        for e, r in zip(expected, results):
+            self.assertEqual(
+                {k: v for k, v in e.items() if k != "header"},
+                {k: v for k, v in r.items() if k != "header"},
+            )
+        self.assertEqual(misses, self.store.misses)
+        stats = self.store.stats()
+        self.assertEqual((5, 3), (stats["hits"], stats["misses"]))
@@ -0,0 +1,95 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import json
+import os
+import shutil
+import tempfile
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from admin_tasks.common.cloc_cache import ClocCache
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from tests.benchmarks.call_counter import CallCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+
+
+class ClocCacheTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        cls.repo = create_synthetic_repo(cls.folder, "service-a", n_files=5, n_commits=3)
+        cls.revision = cls.repo.rev_parse("HEAD")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.cache_folder = tempfile.mkdtemp()
+        self.cache = ClocCache(self.cache_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_folder)
+
+    def test_cached_cloc_output_returned_without_running_cloc_ok(self):
+        cloc_output = json.dumps({"header": {}, "SUM": {"code": 1}})
+        self.cache.put(self.repo.name, self.revision, cloc_output)
+        with CallCounter() as calls:
+            result = self.cache.count_lines_of_code_for_revision(self.repo, self.revision)
+        self.assertEqual(cloc_output, result)
+        self.assertEqual(0, calls.subprocess_count)
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_miss_populates_cache_ok(self):
+        line_counter = GitBlobLineCounter()
+        try:
+            expected = line_counter.count_lines_of_code_for_revision(
+                self.repo, self.revision
+            )
+            with CallCounter() as calls:
+                first = self.cache.count_lines_of_code_for_revision(
+                    self.repo, self.revision, line_counter
+                )
+                after_first = calls.subprocess_count
+                second = self.cache.count_lines_of_code_for_revision(
+                    self.repo, self.revision, line_counter
+                )
+        finally:
+            line_counter.close()
+        # the header holds timings, which differ between runs
+        self.assertEqual(json.loads(expected)["SUM"], json.loads(first)["SUM"])
+        self.assertEqual(first, second)
+        self.assertGreater(after_first, 0)
+        self.assertEqual(after_first, calls.subprocess_count)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        # entries of different counters (cloc options) are kept apart
+        self.assertIsNone(self.cache.get(self.repo.name, self.revision))
+
+    def test_least_recently_used_entries_evicted_ok(self):
+        cache = ClocCache(self.cache_folder, max_size=25)
+        for revision in ["a", "b", "c"]:
+            cache.put("repo", revision, "x" * 10)
+            # make access times distinct
+            path = cache._path(cache.key("repo", revision))
+            timestamp = {"a": 1, "b": 2, "c": 3}[revision] * 1000
+            os.utime(path, (timestamp, timestamp))
+        self.assertIsNone(cache.get("repo", "a"))
+        self.assertEqual("x" * 10, cache.get("repo", "b"))
+        self.assertEqual("x" * 10, cache.get("repo", "c"))
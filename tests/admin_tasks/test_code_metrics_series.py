@@ -0,0 +1,101 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import datetime
+import numpy as np
+import shutil
+import tempfile
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from admin_tasks.common.code_metrics_series import CodeMetricsSeries
+
+
+# 2021-02-26 (Friday) to 2021-03-09 (Tuesday): spans two month ends and
+# three weeks starting on Monday
+DATES = [
+    str(datetime.date(2021, 2, 26) + datetime.timedelta(days=i)) for i in range(12)
+]
+STACK_DATA_SERIES = {
+    "repo-a": list(range(10, 22)),
+    "repo-b": list(range(100, 112)),
+}
+
+
+class CodeMetricsSeriesTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        self.series = CodeMetricsSeries.from_series(DATES, STACK_DATA_SERIES)
+
+    def test_series_round_trip_ok(self):
+        timestamps, totals, stack_data_series = self.series.to_series()
+        self.assertEqual(DATES, timestamps)
+        self.assertEqual([a + b for a, b in zip(*STACK_DATA_SERIES.values())], totals)
+        self.assertEqual(STACK_DATA_SERIES, stack_data_series)
+
+    def test_shape_mismatch_rejected(self):
+        with self.assertRaises(ValueError):
+            CodeMetricsSeries(DATES[:-1], ["repo-a"], [STACK_DATA_SERIES["repo-a"]])
+
+    def test_memory_mapped_load_ok(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.series.save(folder)
+        loaded = CodeMetricsSeries.load(folder)
+        # arrays are (read-only) views of the memory-mapped files
+        self.assertIsInstance(loaded.loc.base, np.memmap)
+        self.assertIsInstance(loaded.dates.base, np.memmap)
+        self.assertEqual(self.series.to_series(), loaded.to_series())
+        with self.assertRaises(ValueError):
+            loaded.loc[0, 0] = 1
+
+        in_memory = CodeMetricsSeries.load(folder, mmap_mode=None)
+        self.assertNotIsInstance(in_memory.loc.base, np.memmap)
+        self.assertEqual(self.series.to_series(), in_memory.to_series())
+
+    def test_slice_ok(self):
+        sliced = self.series.slice("2021-03-01", "2021-03-03")
+        self.assertEqual(
+            ["2021-03-01", "2021-03-02", "2021-03-03"], sliced.to_series()[0]
+        )
+        self.assertEqual([13, 14, 15], sliced.repo_series("repo-a").tolist())
+        self.assertTrue(np.shares_memory(sliced.loc, self.series.loc))
+        # bounds need not be in the series
+        for start, end, expected in [
+            ("2021-01-01", "2021-12-31", DATES),
+            (None, "2021-02-28", DATES[:3]),
+            ("2021-03-08", None, DATES[-2:]),
+            ("2021-04-01", None, []),
+        ]:
+            sliced = self.series.slice(start, end)
+            self.assertEqual(expected, [str(d) for d in sliced.dates], (start, end))
+
+    def test_resample_weekly_ok(self):
+        weekly = self.series.resample("W")
+        timestamps, _, stack_data_series = weekly.to_series()
+        self.assertEqual(["2021-02-28", "2021-03-07", "2021-03-09"], timestamps)
+        self.assertEqual([12, 19, 21], stack_data_series["repo-a"])
+        weekly_mean = self.series.resample("W", how="mean")
+        self.assertEqual([11.0, 16.0, 20.5], weekly_mean.repo_series("repo-a").tolist())
+
+    def test_resample_monthly_ok(self):
+        monthly = self.series.resample("M")
+        self.assertEqual(["2021-02-28", "2021-03-09"], monthly.to_series()[0])
+        self.assertEqual([102, 111], monthly.repo_series("repo-b").tolist())
+        monthly_max = self.series.resample("M", how="max")
+        self.assertEqual([102, 111], monthly_max.repo_series("repo-b").tolist())
+        with self.assertRaises(ValueError):
+            self.series.resample("Y")
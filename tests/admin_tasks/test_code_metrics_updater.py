@@ -0,0 +1,184 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from admin_tasks.common.code_metrics_updater import CodeMetricsUpdater
+from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from src.common.constants import CodeMetricsTable
+from tests.local_dynamodb import LocalDynamodb
+
+
+REPO = "test-repo"
+COMMITS = [
+    ("2021-03-01T12:00:00+00:00", {"main.py": "import os\n"}),
+    ("2021-03-03T12:00:00+00:00", {"main.py": "import os\nimport sys\n\nx = 1\n"}),
+]
+
+
+def git(*args, date=None, cwd=None):
+    env = dict(os.environ)
+    if date is not None:
+        env.update({"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date})
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        capture_output=True,
+        check=True,
+        text=True,
+        cwd=cwd,
+        env=env,
+    ).stdout.strip()
+
+
+class CodeMetricsUpdaterTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.remotes_folder = tempfile.mkdtemp()
+        remote = os.path.join(cls.remotes_folder, REPO)
+        os.makedirs(remote)
+        git("init", "-q", "-b", "master", cwd=remote)
+        for date, files in COMMITS:
+            for path, content in files.items():
+                with open(os.path.join(remote, path), "w") as f:
+                    f.write(content)
+            git("add", "-A", cwd=remote)
+            git("commit", "-q", "-m", f"Commit of {date}", date=date, cwd=remote)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.remotes_folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.mirrors_folder = tempfile.mkdtemp()
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.metrics_table = CodeMetricsTable(
+            table=self.local_ddb.create_table("CodeMetrics")
+        )
+        self.line_counter = GitBlobLineCounter()
+
+    def tearDown(self):
+        self.line_counter.close()
+        self.local_ddb.__exit__(None, None, None)
+        shutil.rmtree(self.mirrors_folder)
+
+    def get_updater(self, **kwargs):
+        return CodeMetricsUpdater(
+            repos=[REPO],
+            mirrors_folder=self.mirrors_folder,
+            metrics_table=self.metrics_table,
+            remote_url_template=os.path.join(self.remotes_folder, "{repo}"),
+            line_counter=self.line_counter,
+            today=datetime.date(2021, 3, 6),
+            **kwargs,
+        )
+
+    def test_update_since_watermark_ok(self):
+        result = self.get_updater().main()
+        self.assertEqual({"new_data_points": {REPO: 4}, "errors": {}}, result)
+        items = self.metrics_table.query_repo_series(
+            REPO, "2021-03-01", "2021-03-31", attributes=("code",)
+        )
+        self.assertEqual(
+            [("2021-03-02", 1), ("2021-03-03", 1), ("2021-03-04", 3), ("2021-03-05", 3)],
+            [(i["timestamp"], i["code"]) for i in items],
+        )
+        watermark = self.metrics_table.get_watermark(REPO)
+        self.assertEqual("2021-03-05", watermark["last_processed_date"])
+        weekly = self.metrics_table.get_rollup("weekly", 2021)
+        self.assertEqual({"2021-03-01": {REPO: 3}}, weekly["periods"])
+
+        # nothing left to do until the next day
+        result = self.get_updater().main()
+        self.assertEqual({"new_data_points": {REPO: 0}, "errors": {}}, result)
+
+    def test_update_change_points_ok(self):
+        result = self.get_updater(change_points=True).main()
+        self.assertEqual({"new_data_points": {REPO: 4}, "errors": {}}, result)
+        # only days on which the revision changed are stored
+        self.assertEqual({"2021-03-02", "2021-03-04"}, self.metrics_table.query_timestamps(REPO))
+        weekly = self.metrics_table.get_rollup("weekly", 2021)
+        self.assertEqual({"2021-03-01": {REPO: 3}}, weekly["periods"])
+
+        items = self.metrics_table.query_daily_series(REPO, "2021-03-03", "2021-03-06")
+        self.assertEqual(
+            [
+                ("2021-03-03", "2021-03-02", 1),
+                ("2021-03-04", "2021-03-04", 3),
+                ("2021-03-05", "2021-03-04", 3),
+                ("2021-03-06", "2021-03-04", 3),
+            ],
+            [(i["timestamp"], i["change_point"], i["code"]) for i in items],
+        )
+
+    def test_watermark_stops_before_failed_day(self):
+        get_revision = StackLocCounter.get_master_revision_at_timestamp
+
+        def fail_on_march_4th(counter):
+            if counter.commit_timestamp == "2021-03-04":
+                raise subprocess.CalledProcessError(1, ["git", "rev-list"])
+            return get_revision(counter)
+
+        with mock.patch.object(
+            StackLocCounter, "get_master_revision_at_timestamp", fail_on_march_4th
+        ):
+            result = self.get_updater().main()
+        self.assertEqual({"new_data_points": {REPO: 2}, "errors": {}}, result)
+        watermark = self.metrics_table.get_watermark(REPO)
+        self.assertEqual("2021-03-03", watermark["last_processed_date"])
+
+        # the next run retries the failed day
+        result = self.get_updater().main()
+        self.assertEqual({"new_data_points": {REPO: 2}, "errors": {}}, result)
+        self.assertEqual(
+            {"2021-03-02", "2021-03-03", "2021-03-04", "2021-03-05"},
+            self.metrics_table.query_timestamps(REPO),
+        )
+        watermark = self.metrics_table.get_watermark(REPO)
+        self.assertEqual("2021-03-05", watermark["last_processed_date"])
+
+    def test_rollups_sharded_by_year_ok(self):
+        updater = self.get_updater()
+        updater.update_rollups({REPO: [("2020-12-30", 1), ("2021-01-05", 2)]})
+        updater.update_rollups({"other-repo": [("2021-01-06", 5)]})
+        # the week of 2020-12-30 starts in 2020, so the 2021 item only holds
+        # weeks starting in 2021
+        self.assertEqual(
+            {"2020-12-28": {REPO: 1}},
+            self.metrics_table.get_rollup("weekly", 2020)["periods"],
+        )
+        self.assertEqual(
+            {"2021-01-04": {REPO: 2, "other-repo": 5}},
+            self.metrics_table.get_rollup("weekly", 2021)["periods"],
+        )
+        self.assertEqual(
+            {"2020-12-01": {REPO: 1}, "2021-01-01": {REPO: 2, "other-repo": 5}},
+            self.metrics_table.query_rollup_periods("monthly"),
+        )
+        self.assertEqual(
+            {"2021-01-01": {REPO: 2, "other-repo": 5}},
+            self.metrics_table.query_rollup_periods("monthly", first_year=2021),
+        )
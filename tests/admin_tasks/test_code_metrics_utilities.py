@@ -0,0 +1,134 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.common.git_utilities as git_utils
+from admin_tasks.common.code_metrics_utilities import LocSnapshot, StackLocCounter
+
+
+REPO = "test-repo"
+# each commit maps paths to their new content, or to None if deleted;
+# vendors and .sty files are excluded from counts (see CLOC_OPTIONS)
+COMMITS = [
+    (
+        "2021-03-01T12:00:00+00:00",
+        {
+            "src/a.py": "import os\n\n# comment\nx = 1\n",
+            "src/b.py": "import sys\n",
+            "vendors/lib.py": "y = 2\nz = 3\n",
+            "docs/style.sty": "\\relax\n",
+            "README.md": "# Title\n\nSome text.\n",
+        },
+    ),
+    (
+        "2021-03-02T12:00:00+00:00",
+        {
+            "src/a.py": "import os\nimport sys\n\nx = 1\ny = 2\n",
+            "src/b.py": None,
+            "vendors/other.py": "w = 4\n",
+            "static/app.js": "// comment\nconst a = 1;\n",
+        },
+    ),
+    (
+        "2021-03-03T12:00:00+00:00",
+        {
+            "README.md": None,
+            "vendors/lib.py": "y = 3\n",
+            "src/b.py": "import json\n\n\nprint(json)\n",
+        },
+    ),
+]
+
+
+def git(*args, date=None, cwd=None):
+    env = dict(os.environ)
+    if date is not None:
+        env.update({"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date})
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        capture_output=True,
+        check=True,
+        text=True,
+        cwd=cwd,
+        env=env,
+    ).stdout.strip()
+
+
+@unittest.skipIf(shutil.which("cloc") is None, "cloc is not installed")
+class IncrementalCountTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        remote = os.path.join(cls.folder, "remote")
+        os.makedirs(remote)
+        git("init", "-q", "-b", "master", cwd=remote)
+        for date, files in COMMITS:
+            for path, content in files.items():
+                file_path = os.path.join(remote, path)
+                if content is None:
+                    os.remove(file_path)
+                    continue
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(content)
+            git("add", "-A", cwd=remote)
+            git("commit", "-q", "-m", f"Commit of {date}", date=date, cwd=remote)
+        cls.repo = git_utils.GitRepo.clone(remote, os.path.join(cls.folder, REPO))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    @staticmethod
+    def without_header(details):
+        return {k: v for k, v in details.items() if k != "header"}
+
+    def test_incremental_counts_match_full_counts_ok(self):
+        previous_snapshot = None
+        for ts_str in ["2021-03-02", "2021-03-03", "2021-03-04", "2021-03-05"]:
+            counter = StackLocCounter(
+                stack_name=REPO,
+                commit_timestamp=ts_str,
+                incremental=True,
+                previous_snapshot=previous_snapshot,
+                repo=self.repo,
+            )
+            counter.compute_metrics()
+            full_counter = StackLocCounter(
+                stack_name=REPO, commit_timestamp=ts_str, repo=self.repo
+            )
+            full_counter.compute_metrics()
+            self.assertEqual(
+                self.without_header(full_counter.details),
+                self.without_header(counter.details),
+                ts_str,
+            )
+            self.assertFalse(
+                any(p.startswith("vendors/") for p in counter.file_counts), ts_str
+            )
+            previous_snapshot = counter.snapshot()
+            self.assertIsInstance(previous_snapshot, LocSnapshot)
+        self.assertEqual({"src/a.py", "src/b.py", "static/app.js"}, set(counter.file_counts))
@@ -0,0 +1,95 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import threading
+import thiscovery_dev_tools.testing_tools as test_tools
+from concurrent.futures import ThreadPoolExecutor
+
+from admin_tasks.common.ddb_registry import TableRegistry
+
+
+class FakeTable:
+    name = "Deployments"
+
+    def __init__(self, profile_name=None, aws_namespace=None):
+        self.profile_name = profile_name
+        self.aws_namespace = aws_namespace
+        # stands in for the boto3 session and client
+        self._ddb_client = object()
+        self.table = None
+
+    def get_table(self):
+        self.table = [f"{self.aws_namespace}-{self.name}"]
+
+
+class TableRegistryTestCase(test_tools.BaseTestCase):
+    def test_sessions_shared_between_threads_ok(self):
+        registry = TableRegistry()
+        keys = [("dev-profile", "dev"), ("prod-profile", "prod")] * 20
+        barrier = threading.Barrier(4)
+
+        def get_tables(thread_keys):
+            barrier.wait()
+            return [
+                registry.get(FakeTable, profile_name=p, aws_namespace=n)
+                for p, n in thread_keys
+            ]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            tables_by_thread = list(
+                executor.map(get_tables, [keys[i::4] for i in range(4)])
+            )
+
+        tables = [t for thread_tables in tables_by_thread for t in thread_tables]
+        # one session per key...
+        self.assertEqual(2, len({id(t._ddb_client) for t in tables}))
+        # ...and one table resource per key and thread
+        self.assertEqual(4, len({id(t.table) for t in tables}))
+        for thread_tables in tables_by_thread:
+            self.assertEqual(1, len({id(t) for t in thread_tables}))
+        self.assertEqual(["dev-Deployments"], tables_by_thread[0][0].table)
+
+        stats = registry.stats()
+        self.assertEqual(2, stats["created"])
+        self.assertEqual(4, stats["thread_tables"])
+        self.assertEqual(36, stats["reused"])
+        self.assertEqual(
+            {"created": 1, "thread_tables": 2, "reused": 18},
+            stats["by_table"][("prod-profile", "prod", "Deployments")],
+        )
+
+    def test_slow_session_does_not_block_other_tables(self):
+        registry = TableRegistry()
+        prod_started = threading.Event()
+        dev_done = threading.Event()
+
+        class SlowProdTable(FakeTable):
+            def __init__(self, profile_name=None, aws_namespace=None):
+                if aws_namespace == "prod":
+                    prod_started.set()
+                    self.waited_for_dev = dev_done.wait(timeout=5)
+                super().__init__(profile_name, aws_namespace)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                registry.get, SlowProdTable, profile_name="p", aws_namespace="prod"
+            )
+            prod_started.wait(timeout=5)
+            registry.get(SlowProdTable, profile_name="d", aws_namespace="dev")
+            dev_done.set()
+            self.assertTrue(future.result().waited_for_dev)
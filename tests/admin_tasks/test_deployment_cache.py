@@ -0,0 +1,124 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import decimal
+import os
+import shutil
+import tempfile
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from admin_tasks.common.deployment_cache import DeploymentCache
+from src.common.constants import DeploymentsTable
+from tests.benchmarks.call_counter import CallCounter
+from tests.local_dynamodb import LocalDynamodb
+
+
+def deployment(stack, env, day, revision):
+    ts = f"2021-01-{day:02d}T12:00:00+00:00"
+    return {
+        "stack_env": f"{stack}-{env}",
+        "timestamp": ts,
+        "stack": stack,
+        "environment": env,
+        "revision": revision,
+        "created": ts,
+        "epsagon_layer_version": decimal.Decimal(3),
+    }
+
+
+class DeploymentCacheTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.folder = tempfile.mkdtemp()
+        self.cache = DeploymentCache(os.path.join(self.folder, "deployments.sqlite3"))
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.deployments_table = DeploymentsTable(
+            table=self.local_ddb.create_table("Deployments")
+        )
+
+    def tearDown(self):
+        self.cache.close()
+        self.local_ddb.__exit__(None, None, None)
+        shutil.rmtree(self.folder)
+        super().tearDown()
+
+    def deploy(self, item, index=True):
+        self.deployments_table.table.put_item(Item=item)
+        if index:
+            self.deployments_table.put_latest_deployment(item)
+
+    def test_delta_sync_ok(self):
+        for day in range(1, 11):
+            self.deploy(deployment("stack-a", "dev", day, f"a{day}"))
+        # stack-b is not in the latest deployment index
+        self.deploy(deployment("stack-b", "dev", 5, "b5"), index=False)
+        self.deploy(deployment("stack-a", "prod", 2, "a2"))
+
+        self.assertEqual(
+            {"stack-a-dev": 10, "stack-b-dev": 1},
+            self.cache.sync_environment(
+                self.deployments_table, "dev", ["stack-a", "stack-b"]
+            ),
+        )
+        with CallCounter() as calls:
+            self.assertEqual(
+                {"stack-a-dev": 0, "stack-b-dev": 0},
+                self.cache.sync_environment(
+                    self.deployments_table, "dev", ["stack-a", "stack-b"]
+                ),
+            )
+        # the index query, and a history query for stack-b
+        self.assertEqual(2, calls.ddb_call_count)
+
+        self.deploy(deployment("stack-a", "dev", 12, "a12"))
+        self.assertEqual(
+            {"stack-a-dev": 1},
+            self.cache.sync_environment(self.deployments_table, "dev", ["stack-a"]),
+        )
+        self.assertEqual(
+            "2021-01-12T12:00:00+00:00", self.cache.high_water_mark("stack-a-dev")
+        )
+
+    def test_offline_queries_ok(self):
+        for item in [
+            deployment("stack-a", "dev", 1, "a1"),
+            deployment("stack-a", "dev", 8, "a8"),
+            deployment("stack-b", "dev", 3, "b3"),
+            deployment("stack-a", "prod", 2, "a2"),
+        ]:
+            self.deploy(item)
+        for env, stacks in [("dev", ["stack-a", "stack-b"]), ("prod", ["stack-a"])]:
+            self.cache.sync_environment(self.deployments_table, env, stacks)
+
+        latest = self.cache.latest_deployment("stack-a-dev")
+        self.assertEqual("a8", latest["revision"])
+        self.assertEqual(3, latest["epsagon_layer_version"])
+        self.assertEqual(
+            "a1",
+            self.cache.latest_deployment("stack-a-dev", at="2021-01-05")["revision"],
+        )
+        self.assertIsNone(self.cache.latest_deployment("stack-a-dev", at="2020-12-31"))
+        self.assertEqual(
+            {"stack-a-dev": "a1", "stack-b-dev": "b3"},
+            {
+                stack_env: item["revision"]
+                for stack_env, item in self.cache.deployed_at(
+                    "dev", "2021-01-05"
+                ).items()
+            },
+        )
@@ -0,0 +1,182 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import thiscovery_dev_tools.testing_tools as test_tools
+from concurrent.futures import ThreadPoolExecutor
+
+import admin_tasks.common.git_utilities as git_utils
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+
+
+REPO_FILES = {
+    "repo-a": {"main.py": "import os\n", "README.md": "# A\n"},
+    "repo-b": {"main.py": "import os\nimport sys\n\nx = 1\n"},
+}
+
+
+class GitRepoTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        for repo_name, files in REPO_FILES.items():
+            repo_folder = os.path.join(cls.folder, repo_name)
+            os.makedirs(repo_folder)
+            for path, content in files.items():
+                with open(os.path.join(repo_folder, path), "w") as f:
+                    f.write(content)
+            for cmd in [
+                ["git", "init", "-q", "-b", "master"],
+                ["git", "add", "-A"],
+                [
+                    "git",
+                    "-c",
+                    "user.name=test",
+                    "-c",
+                    "user.email=test@example.com",
+                    "commit",
+                    "-q",
+                    "-m",
+                    "Initial commit",
+                ],
+                ["git", "update-ref", "refs/remotes/origin/master", "HEAD"],
+            ]:
+                subprocess.run(cmd, check=True, capture_output=True, cwd=repo_folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def test_concurrent_repos_ok(self):
+        line_counter = GitBlobLineCounter()
+
+        def count(repo_name):
+            repo = git_utils.get_repo(os.path.join(self.folder, repo_name))
+            revision = repo.get_commit_index().revisions[-1]
+            result = line_counter.count_lines_of_code_for_revision(repo, revision)
+            return json.loads(result)["SUM"]["code"]
+
+        pwd = os.getcwd()
+        expected = [count(r) for r in REPO_FILES]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(count, [*REPO_FILES] * 10))
+        line_counter.close()
+        self.assertEqual([2, 3], expected)
+        self.assertEqual(expected * 10, results)
+        self.assertEqual(pwd, os.getcwd())
+        self.assertIs(
+            git_utils.get_repo(os.path.join(self.folder, "repo-a")),
+            git_utils.get_repo(os.path.join(self.folder, "repo-a", "")),
+        )
+
+    def test_datetimes_of_revisions_ok(self):
+        repo = git_utils.get_repo(os.path.join(self.folder, "repo-b"))
+        revision = repo.rev_parse("HEAD")
+        datetimes = repo.datetimes_of_revisions(
+            [revision[:8], revision, "0123456789abcdef", "HEAD"]
+        )
+        expected_datetime = repo.datetime_of_git_revision(revision)
+        self.assertEqual(
+            {
+                revision[:8]: expected_datetime,
+                revision: expected_datetime,
+                "0123456789abcdef": None,
+                "HEAD": expected_datetime,
+            },
+            datetimes,
+        )
+
+    def test_commit_deltas_match_rev_list_ok(self):
+        repo = create_synthetic_repo(self.folder, "graph", n_files=5, n_commits=12)
+        master = repo.get_commit_index().revisions
+        tree = repo.rev_parse(f"{master[-1]}^{{tree}}")
+
+        def commit(*parents):
+            cmd = ["commit-tree", tree, "-m", "test"]
+            for parent in parents:
+                cmd += ["-p", parent]
+            return repo.run(
+                ["-c", "user.name=test", "-c", "user.email=test@example.com", *cmd]
+            ).stdout.strip()
+
+        # a branch off an old master commit, a merge of master into it and an
+        # unrelated root commit
+        branch = commit(commit(master[3]))
+        merge = commit(branch, master[8])
+        revisions = [*master[::3], branch, merge, commit(), master[-1][:10], "bad"]
+
+        deltas = repo.get_commit_deltas_to_branch(revisions)
+        for revision in revisions[:-1]:
+            behind, ahead = repo.get_commit_delta_to_branch(revision)
+            self.assertEqual((int(behind), int(ahead)), deltas[revision])
+        self.assertIsNone(deltas["bad"])
+        self.assertEqual((len(master) - 1, 0), deltas[master[0]])
+        self.assertEqual(deltas, repo.get_commit_deltas_to_branch(revisions))
+
+    def test_commit_index_matches_rev_list_ok(self):
+        repo = create_synthetic_repo(
+            self.folder, "index", n_files=5, n_commits=10, days_between_commits=0.5
+        )
+        # a tip commit dated before its parent, as left by some rebases
+        parent = repo.rev_parse("origin/master")
+        rebased_date = "2020-01-03T18:00:00+00:00"
+        tip = repo.run(
+            [
+                "-c",
+                "user.name=test",
+                "-c",
+                "user.email=test@example.com",
+                "commit-tree",
+                f"{parent}^{{tree}}",
+                "-p",
+                parent,
+                "-m",
+                "Rebased",
+            ],
+            env={
+                **os.environ,
+                "GIT_AUTHOR_DATE": rebased_date,
+                "GIT_COMMITTER_DATE": rebased_date,
+            },
+        ).stdout.strip()
+        repo.run(["update-ref", "refs/remotes/origin/master", tip])
+        commit_index = git_utils.GitRepo(repo.path).get_commit_index("origin/master")
+
+        # date-only strings are not compared: git reads them as the current
+        # time of day, whereas the index reads them as midnight
+        timestamps = list()
+        for commit_timestamp in commit_index.commit_timestamps:
+            for offset in [-1, 0, 1]:
+                timestamps.append(
+                    datetime.datetime.fromtimestamp(
+                        commit_timestamp + offset, tz=datetime.timezone.utc
+                    ).isoformat()
+                )
+        for ts in timestamps:
+            expected = repo.get_branch_revision_at_timestamp(ts, "origin/master")
+            self.assertEqual(expected or None, commit_index.revision_at(ts), ts)
+        self.assertIsNone(commit_index.revision_at(timestamps[0]))
+        self.assertEqual(tip, commit_index.revision_at(rebased_date))
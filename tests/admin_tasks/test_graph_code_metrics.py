@@ -0,0 +1,239 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.graph_code_metrics as graph_code_metrics
+from admin_tasks.common.cloc_cache import ClocCache
+from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from src.common.constants import CodeMetricsTable
+from tests.benchmarks.call_counter import CallCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+from tests.local_dynamodb import LocalDynamodb
+
+
+REPOS = ["service-a", "service-b"]
+
+
+class GraphCodeMetricsTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        for i, repo in enumerate(REPOS):
+            create_synthetic_repo(
+                cls.folder, repo, n_files=5, n_commits=6, churn=0.4, seed=i
+            )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_folder)
+        self.checkpoint_filename = os.path.join(self.output_folder, "points.jsonl")
+        self.line_counter = GitBlobLineCounter()
+        self.addCleanup(self.line_counter.close)
+        patcher = mock.patch.multiple(
+            graph_code_metrics,
+            GITHUB_FOLDER=self.folder,
+            REPOS=REPOS,
+            COMMIT_TIMESTAMPS=(
+                datetime.datetime(2020, 1, 1),
+                datetime.datetime(2020, 1, 9),
+            ),
+            TIMESTAMP_DELTA=datetime.timedelta(days=1),
+            cloc_cache=ClocCache(os.path.join(self.output_folder, "cloc")),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def current_globals():
+        return (
+            graph_code_metrics.timestamps,
+            graph_code_metrics.thiscovery_loc_data_series,
+            graph_code_metrics.stack_data_series,
+        )
+
+    def compute(self, **kwargs):
+        """
+        Returns:
+            Globals set by compute_graph_series, starting from empty series
+        """
+        with mock.patch.multiple(
+            graph_code_metrics,
+            timestamps=list(),
+            thiscovery_loc_data_series=list(),
+            stack_data_series=dict(),
+        ), contextlib.redirect_stdout(io.StringIO()):
+            graph_code_metrics.compute_graph_series(
+                line_counter=self.line_counter, **kwargs
+            )
+            return self.current_globals()
+
+    def load_checkpoint(self):
+        with mock.patch.multiple(
+            graph_code_metrics,
+            timestamps=list(),
+            thiscovery_loc_data_series=list(),
+            stack_data_series=dict(),
+        ), contextlib.redirect_stdout(io.StringIO()):
+            graph_code_metrics.load_globals_from_checkpoint(self.checkpoint_filename)
+            return self.current_globals()
+
+    def read_checkpoint(self):
+        with open(self.checkpoint_filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_resume_from_checkpoint_ok(self):
+        expected = self.compute()
+        self.assertEqual(8, len(expected[0]))
+        self.compute(checkpoint_filename=self.checkpoint_filename)
+        with open(self.checkpoint_filename) as f:
+            lines = f.readlines()
+        self.assertEqual(16, len(lines))
+        # simulate a crash while writing the 6th data point
+        with open(self.checkpoint_filename, "w") as f:
+            f.writelines(lines[:5])
+            f.write(lines[5][:10])
+
+        self.assertEqual(
+            expected, self.compute(checkpoint_filename=self.checkpoint_filename)
+        )
+        points = self.read_checkpoint()
+        # the first day precedes the first revision of each repo, so its data
+        # points are zero rather than failures
+        self.assertEqual([], [p for p in points if p.get("error")])
+        self.assertEqual(
+            {r: 0 for r in REPOS},
+            {p["repo"]: p["loc"] for p in points if p["date"] == "2020-01-01"},
+        )
+        self.assertEqual(16, len(points))
+        self.assertEqual(expected, self.load_checkpoint())
+
+    def test_failed_points_recomputed_on_resume_ok(self):
+        expected = self.compute()
+        compute_metrics = StackLocCounter.compute_metrics
+
+        def fail_once(counter):
+            if counter.stack_name == REPOS[1] and counter.commit_timestamp == "2020-01-04":
+                raise subprocess.CalledProcessError(1, "git")
+            return compute_metrics(counter)
+
+        with mock.patch.object(StackLocCounter, "compute_metrics", fail_once):
+            failed_run = self.compute(checkpoint_filename=self.checkpoint_filename)
+        self.assertEqual(0, failed_run[2][REPOS[1]][3])
+        self.assertIn(
+            {"date": "2020-01-04", "repo": REPOS[1], "loc": 0, "error": True},
+            self.read_checkpoint(),
+        )
+
+        self.assertEqual(
+            expected, self.compute(checkpoint_filename=self.checkpoint_filename)
+        )
+        # the recomputed data point replaces the failed one
+        self.assertEqual(expected, self.load_checkpoint())
+        self.assertNotEqual(0, expected[2][REPOS[1]][3])
+
+
+class LoadFromDdbTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.addCleanup(self.local_ddb.__exit__, None, None, None)
+        # graph_code_metrics reads the table of the current environment
+        table_name = CodeMetricsTable().table.name
+        metrics_table = CodeMetricsTable(
+            table=self.local_ddb.create_table("CodeMetrics", table_name=table_name)
+        )
+        with metrics_table.batch_writer() as batch_writer:
+            # service-a is stored daily from 2021-03-02, service-b as change
+            # points from before the requested range
+            for day, code in [(2, 10), (3, 11), (4, 12), (5, 13), (6, 14)]:
+                batch_writer.put(
+                    {"repo": REPOS[0], "timestamp": f"2021-03-0{day}", "code": code}
+                )
+            for ts_str, code in [("2021-02-20", 100), ("2021-03-04", 105)]:
+                batch_writer.put({"repo": REPOS[1], "timestamp": ts_str, "code": code})
+        patcher = mock.patch.multiple(
+            graph_code_metrics,
+            REPOS=REPOS,
+            COMMIT_TIMESTAMPS=(
+                datetime.datetime(2021, 3, 1),
+                datetime.datetime(2021, 3, 7),
+            ),
+            TIMESTAMP_DELTA=datetime.timedelta(days=1),
+            timestamps=list(),
+            thiscovery_loc_data_series=list(),
+            stack_data_series=dict(),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load_globals_from_ddb_ok(self):
+        with CallCounter() as calls:
+            graph_code_metrics.load_globals_from_ddb(max_workers=2)
+        self.assertEqual(
+            [f"2021-03-0{day}" for day in range(1, 7)], graph_code_metrics.timestamps
+        )
+        self.assertEqual(
+            {
+                REPOS[0]: [0, 10, 11, 12, 13, 14],
+                REPOS[1]: [100, 100, 100, 105, 105, 105],
+            },
+            graph_code_metrics.stack_data_series,
+        )
+        self.assertEqual(
+            [100, 110, 111, 117, 118, 119],
+            graph_code_metrics.thiscovery_loc_data_series,
+        )
+        # a range query per repo, plus a query of the change point before the
+        # range for repos without an item on its first day
+        self.assertEqual({"Query": 4}, dict(calls.ddb_operations))
+
+    def test_one_table_per_worker_thread(self):
+        repos = [*REPOS, "service-c", "service-d", "service-e"]
+        with mock.patch.object(graph_code_metrics, "REPOS", repos), mock.patch.object(
+            graph_code_metrics.const, "CodeMetricsTable", side_effect=CodeMetricsTable
+        ) as table_class:
+            graph_code_metrics.load_globals_from_ddb(max_workers=2)
+        self.assertLessEqual(table_class.call_count, 2)
+        self.assertEqual([0] * 6, graph_code_metrics.stack_data_series["service-e"])
+
+    def test_load_globals_from_ddb_range_ok(self):
+        graph_code_metrics.load_globals_from_ddb(start="2021-03-05", end="2021-03-05")
+        self.assertEqual(["2021-03-05"], graph_code_metrics.timestamps)
+        self.assertEqual(
+            {REPOS[0]: [13], REPOS[1]: [105]}, graph_code_metrics.stack_data_series
+        )
+
+        graph_code_metrics.load_globals_from_ddb(start="2021-04-01")
+        self.assertEqual([], graph_code_metrics.timestamps)
+        self.assertEqual({}, graph_code_metrics.stack_data_series)
@@ -0,0 +1,147 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.common.git_utilities as git_utils
+from admin_tasks.common.line_counter import GitBlobLineCounter, get_language
+
+
+SAMPLE_FILES = {
+    "src/module.py": '#!/usr/bin/env python3\n'
+    "# a comment\n"
+    '"""\n'
+    "Module docstring\n"
+    '"""\n'
+    "import os\n"
+    "\n"
+    "\n"
+    "def f(x):\n"
+    '    """Docstring."""\n'
+    "    return x  # inline comment\n",
+    "template.yaml": "# comment\n"
+    "key: value  # inline\n"
+    "list:\n"
+    "  - a\n"
+    "\n",
+    "src/data.json": '{\n  "a": 1,\n\n  "b": [1, 2]\n}\n',
+    "static/script.js": "// comment\n"
+    "/* block\n"
+    "   comment */\n"
+    "const a = 1; // inline\n"
+    "function f() {\n"
+    "\n"
+    "  return a;\n"
+    "}\n",
+    "static/index.html": "<!DOCTYPE html>\n"
+    "<!-- comment -->\n"
+    "<html>\n"
+    "<body>\n"
+    "<!--\n"
+    "multi\n"
+    "-->\n"
+    "<p>Hello</p>\n"
+    "</body>\n"
+    "</html>\n",
+    "README.md": "# Title\n\nSome text.\n<!-- hidden -->\n- item\n",
+    "vendors/excluded.py": "x = 1\n",
+    "src/duplicate.py": "import os\n",
+    "src/duplicate_copy.py": "import os\n",
+    # same blob as the duplicates, listed first but in an unsupported language
+    "notes.unknown": "import os\n",
+}
+
+
+class LineCounterTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.repo_folder = tempfile.mkdtemp()
+        for path, content in SAMPLE_FILES.items():
+            file_path = os.path.join(cls.repo_folder, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as f:
+                f.write(content)
+        for cmd in [
+            ["git", "init", "-q"],
+            ["git", "add", "-A"],
+            [
+                "git",
+                "-c",
+                "user.name=test",
+                "-c",
+                "user.email=test@example.com",
+                "commit",
+                "-q",
+                "-m",
+                "Sample files",
+            ],
+        ]:
+            subprocess.run(cmd, check=True, cwd=cls.repo_folder)
+        cls.repo = git_utils.GitRepo(cls.repo_folder)
+        cls.revision = cls.repo.rev_parse("HEAD")
+        cls.line_counter = GitBlobLineCounter()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.line_counter.close()
+        shutil.rmtree(cls.repo_folder)
+        super().tearDownClass()
+
+    def test_count_python_lines_ok(self):
+        counts = get_language("module.py").count_lines(SAMPLE_FILES["src/module.py"])
+        self.assertEqual({"blank": 2, "comment": 6, "code": 3}, counts)
+
+    def test_output_shape_ok(self):
+        result = json.loads(
+            self.line_counter.count_lines_of_code_for_revision(self.repo, self.revision)
+        )
+        self.assertIn("cloc_version", result["header"])
+        self.assertEqual(
+            {"Python", "YAML", "JSON", "JavaScript", "HTML", "Markdown"},
+            set(result.keys()) - {"header", "SUM"},
+        )
+        # excluded and duplicate files are not counted
+        self.assertEqual(2, result["Python"]["nFiles"])
+        self.assertEqual(7, result["SUM"]["nFiles"])
+
+    def test_duplicates_of_unsupported_files_counted_ok(self):
+        blobs = self.repo.list_blobs_at_revision(self.revision)
+        self.assertEqual(blobs["notes.unknown"], blobs["src/duplicate.py"])
+        result = json.loads(
+            self.line_counter.count_lines_of_code_for_revision(self.repo, self.revision)
+        )
+        # src/module.py and one of the two duplicates
+        self.assertEqual({"nFiles": 2, "blank": 2, "comment": 6, "code": 4}, result["Python"])
+
+    @unittest.skipIf(shutil.which("cloc") is None, "cloc is not installed")
+    def test_parity_with_cloc_ok(self):
+        cloc_result = json.loads(
+            self.repo.count_lines_of_code_for_revision(self.revision)
+        )
+        result = json.loads(
+            self.line_counter.count_lines_of_code_for_revision(self.repo, self.revision)
+        )
+        for key in set(cloc_result.keys()) - {"header"}:
+            self.assertEqual(cloc_result[key], result.get(key), key)
@@ -0,0 +1,102 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import contextlib
+import io
+from unittest import mock
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.migrate_code_metrics_detail as migrate_code_metrics_detail
+import src.common.detail_encoding as detail_encoding
+from src.common.constants import CodeMetricsTable
+from tests.local_dynamodb import LocalDynamodb
+
+
+REPO = "service-a"
+OTHER_REPO = "service-b"
+MAP_DETAIL = {"Python": {"nFiles": 2, "code": 30, "comment": 4, "blank": 5}}
+ENCODED_DETAIL = {"Python": {"nFiles": 3, "code": 40, "comment": 6, "blank": 7}}
+
+
+class MigrateCodeMetricsDetailTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.addCleanup(self.local_ddb.__exit__, None, None, None)
+        self.metrics_table = CodeMetricsTable(
+            table=self.local_ddb.create_table("CodeMetrics")
+        )
+        with self.metrics_table.batch_writer() as batch_writer:
+            for repo in [REPO, OTHER_REPO]:
+                batch_writer.put(
+                    {
+                        "repo": repo,
+                        "timestamp": "2021-01-01",
+                        "code": 30,
+                        "detail": MAP_DETAIL,
+                        "modified": "before migration",
+                    }
+                )
+            batch_writer.put(
+                {
+                    "repo": REPO,
+                    "timestamp": "2021-01-02",
+                    "code": 40,
+                    "detail": detail_encoding.encode_detail(ENCODED_DETAIL),
+                    "detail_encoding": detail_encoding.ZLIB_JSON,
+                    "modified": "before migration",
+                }
+            )
+        patcher = mock.patch.object(migrate_code_metrics_detail, "REPOS", [REPO])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_raw_item(self, repo, timestamp):
+        return self.metrics_table.table.get_item(
+            Key={"repo": repo, "timestamp": timestamp}
+        )["Item"]
+
+    def migrate(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            migrate_code_metrics_detail.main(metrics_table=self.metrics_table)
+        return output.getvalue()
+
+    def test_migrate_map_detail_ok(self):
+        self.assertIn(f"Migrated 1 items of {REPO}", self.migrate())
+
+        migrated = self.get_raw_item(REPO, "2021-01-01")
+        self.assertEqual(detail_encoding.ZLIB_JSON, migrated["detail_encoding"])
+        self.assertNotIsInstance(migrated["detail"], dict)
+        self.assertNotEqual("before migration", migrated["modified"])
+        self.assertEqual(30, migrated["code"])
+        # already encoded items and repos not in REPOS are left alone
+        encoded = self.get_raw_item(REPO, "2021-01-02")
+        self.assertEqual("before migration", encoded["modified"])
+        self.assertIsInstance(self.get_raw_item(OTHER_REPO, "2021-01-01")["detail"], dict)
+
+        self.assertEqual(
+            [MAP_DETAIL, ENCODED_DETAIL],
+            [
+                i["detail"]
+                for i in self.metrics_table.query_repo_series(
+                    REPO, attributes=("detail", "detail_encoding")
+                )
+            ],
+        )
+
+        # running again finds nothing left to migrate
+        self.assertIn(f"Migrated 0 items of {REPO}", self.migrate())
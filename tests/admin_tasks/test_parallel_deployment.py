@@ -0,0 +1,127 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import os
+import tempfile
+import threading
+import time
+import thiscovery_dev_tools.testing_tools as test_tools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from admin_tasks.common.parallel_deployment import (
+    DEPLOYED,
+    FAILED,
+    SKIPPED,
+    DeploymentScheduler,
+    parse_dependencies,
+    summary_table,
+)
+
+
+class StubDeployer:
+    """
+    Records the order and concurrency of deployments instead of deploying
+    """
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.started = list()
+        self.finished = list()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, stack_name, repo_path, revision):
+        with self.lock:
+            self.started.append(stack_name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.finished.append(stack_name)
+        if stack_name in self.fail:
+            raise RuntimeError(f"{stack_name} stack creation failed")
+
+
+def stub_deploy_in_process(stack_name, repo_path, revision):
+    # deployments change their working directory (see deploy_stack)
+    os.chdir(repo_path)
+
+
+def jobs(*stack_names):
+    return {s: (tempfile.gettempdir(), f"rev-{s}") for s in stack_names}
+
+
+class DeploymentSchedulerTestCase(test_tools.BaseTestCase):
+    def test_concurrency_and_order_ok(self):
+        deployer = StubDeployer()
+        messages = list()
+        results = DeploymentScheduler(
+            max_workers=2,
+            dependencies=parse_dependencies(["c=a,b", "d=c", "e=not-deployed"]),
+            deploy=deployer,
+            executor_class=ThreadPoolExecutor,
+            report=messages.append,
+        ).run(jobs("a", "b", "c", "d", "e"))
+
+        self.assertEqual(["a", "b", "c", "d", "e"], list(results))
+        self.assertEqual({DEPLOYED}, {r.status for r in results.values()})
+        self.assertEqual(2, deployer.max_running)
+        self.assertEqual(["a", "b"], sorted(deployer.started[:2]))
+        for stack_name, dependencies in [("c", ["a", "b"]), ("d", ["c"])]:
+            for dependency in dependencies:
+                self.assertLess(
+                    deployer.finished.index(dependency),
+                    deployer.started.index(stack_name),
+                )
+        self.assertIn("[5/5]", messages[-1])
+        self.assertIn("rev-c", str(summary_table(results)))
+
+    def test_failed_dependency_skips_dependents_ok(self):
+        deployer = StubDeployer(fail=["a"])
+        results = DeploymentScheduler(
+            max_workers=4,
+            dependencies={"b": {"a"}, "c": {"b"}},
+            deploy=deployer,
+            executor_class=ThreadPoolExecutor,
+            report=lambda message: None,
+        ).run(jobs("a", "b", "c", "d"))
+
+        self.assertEqual(
+            {"a": FAILED, "b": SKIPPED, "c": SKIPPED, "d": DEPLOYED},
+            {s: r.status for s, r in results.items()},
+        )
+        self.assertIn("stack creation failed", results["a"].error)
+        self.assertEqual(["a", "d"], sorted(deployer.started))
+
+    def test_circular_dependencies_rejected(self):
+        scheduler = DeploymentScheduler(dependencies={"a": {"b"}, "b": {"a"}})
+        with self.assertRaises(ValueError):
+            scheduler.run(jobs("a", "b"))
+
+    def test_process_workers_ok(self):
+        cwd = os.getcwd()
+        results = DeploymentScheduler(
+            max_workers=2,
+            deploy=stub_deploy_in_process,
+            executor_class=ProcessPoolExecutor,
+            report=lambda message: None,
+        ).run(jobs("a", "b", "c"))
+        self.assertEqual({DEPLOYED}, {r.status for r in results.values()})
+        self.assertEqual(cwd, os.getcwd())
@@ -0,0 +1,125 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.common.git_utilities as git_utils
+import admin_tasks.common.profiling as profiling
+from src.common.constants import CodeMetricsTable
+from tests.local_dynamodb import LocalDynamodb
+
+
+class PagedSource:
+    def iter_items(self):
+        for i in range(3):
+            with profiling.span("fetch page"):
+                time.sleep(0.02)
+            yield i
+
+
+class ProfilingTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        with open(os.path.join(cls.folder, "main.py"), "w") as f:
+            f.write("import os\n")
+        for cmd in [
+            ["git", "init", "-q", "-b", "master"],
+            ["git", "add", "-A"],
+            [
+                "git",
+                "-c",
+                "user.name=test",
+                "-c",
+                "user.email=test@example.com",
+                "commit",
+                "-q",
+                "-m",
+                "Initial commit",
+            ],
+        ]:
+            subprocess.run(cmd, check=True, capture_output=True, cwd=cls.folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def tearDown(self):
+        profiling.disable()
+        profiling.reset()
+        super().tearDown()
+
+    def test_disabled_records_nothing(self):
+        git_utils.GitRepo(self.folder).rev_parse("HEAD")
+        self.assertEqual([], profiling.get_spans())
+
+    def test_git_and_dynamodb_calls_ok(self):
+        profiling.enable()
+        repo = git_utils.GitRepo(self.folder)
+        revision = repo.rev_parse("HEAD")
+        with LocalDynamodb() as local_ddb:
+            metrics_table = CodeMetricsTable(
+                table=local_ddb.create_table("CodeMetrics")
+            )
+            metrics_table.query_timestamps("repo-a")
+
+        spans = {s.name: s for s in profiling.get_spans()}
+        self.assertEqual(
+            ("GitRepo.rev_parse", "git rev-parse"), spans["git rev-parse"].path
+        )
+        self.assertEqual(
+            "dynamodb", spans["CodeMetricsTable.query_timestamps"].category
+        )
+        self.assertIn("Hot paths", profiling.summary())
+
+        trace_file = os.path.join(self.folder, "trace.json")
+        profiling.export_chrome_trace(trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(
+            {"GitRepo.rev_parse", "git rev-parse", "CodeMetricsTable.query_timestamps"},
+            {e["name"] for e in events},
+        )
+        self.assertEqual(40, len(revision))
+
+    def test_generator_span_covers_iteration(self):
+        profiling.instrument_class(PagedSource, "dynamodb")
+        profiling.enable()
+        items = list()
+        for i in PagedSource().iter_items():
+            items.append(i)
+            time.sleep(0.05)
+        self.assertEqual([0, 1, 2], items)
+
+        spans = profiling.get_spans()
+        generator_span = [s for s in spans if s.name == "PagedSource.iter_items"][0]
+        # time spent fetching pages is included, time spent by the caller is not
+        self.assertGreaterEqual(generator_span.duration, 0.06)
+        self.assertLess(generator_span.duration, 0.15)
+        self.assertEqual(
+            [("PagedSource.iter_items", "fetch page")] * 3,
+            [s.path for s in spans if s.name == "fetch page"],
+        )
@@ -19,14 +19,20 @@ import local.dev_config as conf  # sets env variable 'TEST_ON_AWS'
 import local.secrets  # sets AWS profile as env variable
 import json
 import os
+import shutil
+import tempfile
 import unittest
 import requests
 import thiscovery_dev_tools.testing_tools as test_tools
 from pprint import pprint
 
-from src.common.constants import STACK_NAME
+import admin_tasks.services_deployment_status as sds_module
+from src.common.constants import STACK_NAME, DeploymentsTable
 from thiscovery_lib.lambda_utilities import Lambda
 from admin_tasks.services_deployment_status import StackDeploymentStatus
+from tests.benchmarks.call_counter import CallCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+from tests.local_dynamodb import LocalDynamodb
 
 
 class StackDeploymentStatusTestCase(test_tools.BaseTestCase):
@@ -41,3 +47,93 @@ class StackDeploymentStatusTestCase(test_tools.BaseTestCase):
         self.assertIn("branch", keys)
         self.assertIn("revision", keys)
         self.assertEqual(most_recent_deployment["revision"], sds.deployed_revision)
+
+
+class CollectStatusesTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        cls.repos = [
+            create_synthetic_repo(cls.folder, name, n_files=5, n_commits=10, seed=i)
+            for i, name in enumerate(["repo-a", "repo-b", "repo-c"])
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.table = self.local_ddb.create_table("Deployments")
+        sds_module.repos_table.clear_rows()
+
+    def tearDown(self):
+        self.local_ddb.__exit__(None, None, None)
+        super().tearDown()
+
+    def test_collect_statuses_ok(self):
+        envs = ["dev", "prod"]
+        deployments_table = DeploymentsTable(table=self.table)
+        # deploy the revision n commits behind master to env n; repo-a is in
+        # the latest deployment index, repo-b only in the history and repo-c
+        # has never been deployed
+        for repo in self.repos[:2]:
+            revisions = repo.get_commit_index().revisions
+            for n, env in enumerate(envs):
+                item = {
+                    "stack_env": f"{repo.name}-{env}",
+                    "timestamp": "2021-01-01T00:00:00+00:00",
+                    "environment": env,
+                    "revision": revisions[-1 - n],
+                    "created": "2021-01-01T00:00:00+00:00",
+                }
+                self.table.put_item(Item=item)
+                if repo.name == "repo-a":
+                    deployments_table.put_latest_deployment(item)
+        statuses = [
+            StackDeploymentStatus(
+                stack_name=repo.name,
+                env_name=env,
+                deployments_table=deployments_table,
+                repo=repo,
+            )
+            for env in envs
+            for repo in self.repos
+        ]
+
+        with CallCounter() as calls:
+            sds_module.collect_statuses(statuses, ddb_workers=4, git_workers=2)
+
+        # one fetch and one graph walk per deployed repo, whatever the number
+        # of envs, and no working tree changes
+        self.assertEqual(2, calls.subprocesses["git fetch"])
+        self.assertEqual(2, calls.subprocesses["git rev-list"])
+        self.assertEqual(0, calls.subprocesses["git checkout"])
+        self.assertEqual(0, calls.subprocesses["git pull"])
+        # one index query per env, then history queries for repo-b and repo-c
+        self.assertEqual(6, calls.ddb_call_count)
+
+        rows = [(s.stack_name, s.env_name) for s in statuses]
+        self.assertEqual(
+            [0, 0, "NA", 1, 1, "NA"],
+            [s.deployed_revision_behind for s in statuses],
+        )
+        for sds in statuses:
+            if sds.stack_name == "repo-c":
+                self.assertIsNone(sds.deployed_revision_datetime)
+            else:
+                self.assertEqual(
+                    sds.repo.datetime_of_git_revision(sds.deployed_revision),
+                    sds.deployed_revision_datetime,
+                )
+        self.assertEqual(len(statuses), len(sds_module.repos_table.rows))
+        stack_env_columns = [
+            (row[0], row[1])
+            if sds_module.DEPLOYMENT_HISTORY_GROUPING == "stack"
+            else (row[1], row[0])
+            for row in sds_module.repos_table.rows
+        ]
+        self.assertEqual(rows, stack_env_columns)
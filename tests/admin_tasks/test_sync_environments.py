@@ -0,0 +1,43 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import os
+import subprocess
+import sys
+import thiscovery_dev_tools.testing_tools as test_tools
+
+
+ROOT_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..")
+
+
+class SyncEnvironmentsArgumentsTestCase(test_tools.BaseTestCase):
+    def test_depends_on_rejected_without_parallel(self):
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "admin_tasks.sync_environments",
+                "--depends-on",
+                "stack-b=stack-a",
+            ],
+            capture_output=True,
+            text=True,
+            cwd=ROOT_FOLDER,
+        )
+        self.assertEqual(2, result.returncode)
+        self.assertIn("--depends-on can only be used with --parallel", result.stderr)
@@ -0,0 +1,264 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import contextlib
+import datetime
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import admin_tasks.common.git_utilities as git_utils
+import admin_tasks.update_code_metrics as update_code_metrics
+from admin_tasks.common.cloc_cache import ClocCache
+from admin_tasks.common.code_metrics_utilities import (
+    NoRevisionAtTimestampError,
+    StackLocCounter,
+)
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from src.common.constants import CodeMetricsTable
+from tests.benchmarks.call_counter import CallCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+from tests.local_dynamodb import LocalDynamodb
+
+
+REPO = "service-a"
+# commits every three days, so its revision does not change on most days
+SPARSE_REPO = "service-b"
+ROOT_FOLDER = os.path.join(os.path.dirname(__file__), "..", "..")
+ATTRIBUTES = ("revision", "code", "comment", "blank", "source", "detail")
+
+
+class UpdateCodeMetricsTestCase(test_tools.BaseTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.folder = tempfile.mkdtemp()
+        create_synthetic_repo(cls.folder, REPO, n_files=10, n_commits=8, churn=0.3)
+        create_synthetic_repo(
+            cls.folder,
+            SPARSE_REPO,
+            n_files=10,
+            n_commits=3,
+            churn=0.3,
+            days_between_commits=3,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.addCleanup(self.local_ddb.__exit__, None, None, None)
+        self.cloc_cache_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cloc_cache_folder)
+        for patcher in [
+            mock.patch.dict(os.environ, {"CLOC_CACHE_FOLDER": self.cloc_cache_folder}),
+            mock.patch.multiple(
+                update_code_metrics,
+                GITHUB_FOLDER=self.folder,
+                REPOS=[REPO],
+                COMMIT_TIMESTAMPS=(
+                    datetime.datetime(2020, 1, 2),
+                    datetime.datetime(2020, 1, 10),
+                ),
+                TIMESTAMP_DELTA=datetime.timedelta(days=1),
+                cloc_cache=ClocCache(self.cloc_cache_folder),
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_metrics_table(self, table_name):
+        metrics_table = CodeMetricsTable(
+            table=self.local_ddb.create_table("CodeMetrics", table_name=table_name)
+        )
+        patcher = mock.patch.object(update_code_metrics, "metrics_table", metrics_table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return metrics_table
+
+    @staticmethod
+    def stored_items(metrics_table, repo=REPO):
+        return [
+            {k: i.get(k) for k in ("timestamp", *ATTRIBUTES)}
+            for i in metrics_table.query_repo_series(repo, attributes=ATTRIBUTES)
+        ]
+
+    def test_backfill_matches_serial_run_ok(self):
+        serial_table = self.use_metrics_table("CodeMetricsSerial")
+        line_counter = GitBlobLineCounter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            update_code_metrics.main(line_counter=line_counter)
+        line_counter.close()
+        expected = self.stored_items(serial_table)
+        self.assertEqual(
+            [f"2020-01-{d:02d}" for d in range(2, 10)],
+            [i["timestamp"] for i in expected],
+        )
+
+        backfill_table = self.use_metrics_table("CodeMetricsBackfill")
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            update_code_metrics.backfill(
+                workers=2, line_counter_name=GitBlobLineCounter.name
+            )
+        self.assertEqual(expected, self.stored_items(backfill_table))
+        self.assertIn("8 populated, 0 errors, 0 skipped", output.getvalue())
+
+        # a second run finds every (repo, date) pair in the table
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            update_code_metrics.backfill(
+                workers=2, line_counter_name=GitBlobLineCounter.name
+            )
+        self.assertIn("0 populated, 0 errors, 8 skipped", output.getvalue())
+
+    def test_runs_from_earliest_commit_day_without_errors(self):
+        # the fixture's first commit is on 2020-01-01, which has no revision
+        # at midnight, so work starts the day after
+        metrics_table = self.use_metrics_table("CodeMetrics")
+        with mock.patch.object(
+            update_code_metrics,
+            "COMMIT_TIMESTAMPS",
+            (datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 5)),
+        ):
+            earliest_commits = git_utils.date_earliest_commit_dict(self.folder, [REPO])
+            work, skipped = update_code_metrics.plan_work(earliest_commits)
+            self.assertEqual([(REPO, f"2020-01-{d:02d}") for d in [2, 3, 4]], work)
+
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                update_code_metrics.backfill(
+                    workers=2, line_counter_name=GitBlobLineCounter.name
+                )
+            self.assertIn("3 populated, 0 errors, 0 skipped", output.getvalue())
+
+            metrics_table.table.delete_item(Key={"repo": REPO, "timestamp": "2020-01-03"})
+            line_counter = GitBlobLineCounter()
+            self.addCleanup(line_counter.close)
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                update_code_metrics.main(line_counter=line_counter)
+            self.assertNotIn("Error processing", output.getvalue())
+        self.assertEqual(
+            ["2020-01-02", "2020-01-03", "2020-01-04"],
+            [i["timestamp"] for i in self.stored_items(metrics_table)],
+        )
+
+    def test_no_revision_error_carries_reason(self):
+        counter = StackLocCounter(
+            stack_name=REPO,
+            commit_timestamp="2020-01-01",
+            repo=update_code_metrics.get_repo(REPO),
+        )
+        with self.assertRaises(NoRevisionAtTimestampError) as context:
+            counter.get_master_revision_at_timestamp()
+        self.assertEqual(f"{REPO} has no commits before 2020-01-01", str(context.exception))
+
+    def test_change_points_ok(self):
+        serial_table = self.use_metrics_table("CodeMetricsSerial")
+        line_counter = GitBlobLineCounter()
+        self.addCleanup(line_counter.close)
+        with mock.patch.object(update_code_metrics, "REPOS", [SPARSE_REPO]):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                update_code_metrics.main(line_counter=line_counter, change_points=True)
+            self.assertIn(
+                "Skipping 0 (repo, date) pairs already in the CodeMetrics table",
+                output.getvalue(),
+            )
+            self.assertIn(
+                "Skipping 5 (repo, date) pairs whose revision did not change",
+                output.getvalue(),
+            )
+            expected = self.stored_items(serial_table, SPARSE_REPO)
+            # commits were made on 2020-01-01, 2020-01-04 and 2020-01-07
+            self.assertEqual(
+                ["2020-01-02", "2020-01-05", "2020-01-08"],
+                [i["timestamp"] for i in expected],
+            )
+            self.assertEqual(3, len({i["revision"] for i in expected}))
+            daily = serial_table.query_daily_series(
+                SPARSE_REPO, "2020-01-02", "2020-01-09", attributes=("revision",)
+            )
+            self.assertEqual(
+                [expected[0]["revision"]] * 3
+                + [expected[1]["revision"]] * 3
+                + [expected[2]["revision"]] * 2,
+                [i["revision"] for i in daily],
+            )
+
+            backfill_table = self.use_metrics_table("CodeMetricsBackfill")
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                update_code_metrics.backfill(
+                    workers=2,
+                    line_counter_name=GitBlobLineCounter.name,
+                    change_points=True,
+                )
+            self.assertEqual(expected, self.stored_items(backfill_table, SPARSE_REPO))
+            self.assertIn(
+                "3 populated, 0 errors, 0 skipped, 5 unchanged", output.getvalue()
+            )
+
+            # a second run skips stored change points and unchanged days alike
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                update_code_metrics.backfill(
+                    workers=2,
+                    line_counter_name=GitBlobLineCounter.name,
+                    change_points=True,
+                )
+            self.assertIn(
+                "0 populated, 0 errors, 3 skipped, 5 unchanged", output.getvalue()
+            )
+
+    def test_plan_work_ok(self):
+        metrics_table = self.use_metrics_table("CodeMetrics")
+        with metrics_table.batch_writer() as batch_writer:
+            for ts_str in ["2020-01-03", "2020-01-05", "2020-01-20"]:
+                batch_writer.put({"repo": REPO, "timestamp": ts_str, "code": 1})
+        earliest_commits = {REPO: datetime.datetime(2020, 1, 1)}
+        with CallCounter() as calls:
+            work, skipped = update_code_metrics.plan_work(earliest_commits)
+        self.assertEqual({"Query": 1}, dict(calls.ddb_operations))
+        self.assertEqual([(REPO, f"2020-01-{d:02d}") for d in [2, 4, 6, 7, 8, 9]], work)
+        self.assertEqual(2, skipped)
+
+        # dates before the earliest commit of a repo are neither work nor skipped
+        earliest_commits = {REPO: datetime.datetime(2020, 1, 5)}
+        work, skipped = update_code_metrics.plan_work(earliest_commits)
+        self.assertEqual([(REPO, f"2020-01-{d:02d}") for d in [6, 7, 8, 9]], work)
+        self.assertEqual(1, skipped)
+
+    def test_incremental_rejected_with_workers_or_since_watermark(self):
+        for option in [["--workers", "2"], ["--since-watermark"]]:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "admin_tasks.update_code_metrics",
+                    "--incremental",
+                    *option,
+                ],
+                capture_output=True,
+                text=True,
+                cwd=ROOT_FOLDER,
+            )
+            self.assertEqual(2, result.returncode, option)
+            self.assertIn("--incremental cannot be combined", result.stderr)
@@ -0,0 +1,136 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Compares CodeMetrics items whose detail is stored as a map with items whose
+detail is compressed (see src/common/detail_encoding.py): item size, write and
+read capacity units and read throughput (including decoding) against a local
+moto stand-in of the table. Absolute throughput against moto is not
+representative of DynamoDB, but relative sizes and decoding costs are.
+
+Usage:
+    python -m tests.benchmarks.benchmark_detail_encoding [repo folder] [--items N]
+"""
+import argparse
+import math
+import os
+import time
+from decimal import Decimal
+
+import src.common.constants as const
+from admin_tasks.common.git_utilities import GitRepo
+from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from tests.local_dynamodb import LocalDynamodb
+
+
+def ddb_value_size(value):
+    """
+    Approximate stored size in bytes of an attribute value, following
+    https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+    """
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        digits = len(str(value).lstrip("-").replace(".", "").strip("0")) or 1
+        return math.ceil(digits / 2) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 3 + sum(
+            1 + len(k.encode("utf-8")) + ddb_value_size(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(1 + ddb_value_size(v) for v in value)
+    raise TypeError(f"Unsupported attribute type {type(value)}")
+
+
+def ddb_item_size(item):
+    return sum(len(k.encode("utf-8")) + ddb_value_size(v) for k, v in item.items())
+
+
+def build_items(repo, revision, n_items, compress_detail):
+    """
+    Returns:
+        Tuple (items, encoding_seconds): n_items CodeMetrics items of
+        revision for consecutive days, and the time spent building them
+    """
+    line_counter = GitBlobLineCounter()
+    counter = StackLocCounter(
+        stack_name="compressed" if compress_detail else "map",
+        commit_timestamp="2021-01-01",
+        line_counter=line_counter,
+        compress_detail=compress_detail,
+        repo=repo,
+    )
+    counter.git_revision = revision
+    counter.get_metrics_for_revision()
+    line_counter.close()
+    items = list()
+    start = time.perf_counter()
+    for day in range(n_items):
+        counter.commit_timestamp = f"2021-{1 + day // 28:02d}-{1 + day % 28:02d}"
+        items.append(counter.get_ddb_item_dict())
+    return items, time.perf_counter() - start
+
+
+def benchmark(repo, revision, n_items):
+    results = dict()
+    with LocalDynamodb() as local_ddb:
+        metrics_table = const.CodeMetricsTable(
+            table=local_ddb.create_table("CodeMetrics")
+        )
+        for compress_detail in [False, True]:
+            items, encoding_seconds = build_items(repo, revision, n_items, compress_detail)
+            with metrics_table.batch_writer() as batch_writer:
+                for item in items:
+                    batch_writer.put(item)
+            start = time.perf_counter()
+            read_items = metrics_table.query_repo_series(
+                items[0]["repo"], attributes=("code", "detail")
+            )
+            read_seconds = time.perf_counter() - start
+            assert len(read_items) == n_items
+            size = ddb_item_size(items[0])
+            results["compressed" if compress_detail else "map"] = {
+                "item_bytes": size,
+                "wcu_per_write": math.ceil(size / 1024),
+                "rcu_per_4kb_read": round(size / 4096, 3),
+                "build_items_per_second": round(n_items / encoding_seconds),
+                "read_items_per_second": round(n_items / read_seconds),
+            }
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("repo_folder", nargs="?", default=os.getcwd())
+    arg_parser.add_argument("--items", type=int, default=300)
+    arg_parser.add_argument("--revision", default="HEAD")
+    args = arg_parser.parse_args()
+    repo = GitRepo(args.repo_folder)
+    results = benchmark(repo, repo.rev_parse(args.revision), args.items)
+    metrics = list(results["map"].keys())
+    print(f"{'':<24}{'map':>12}{'compressed':>12}")
+    for m in metrics:
+        print(f"{m:<24}{results['map'][m]:>12}{results['compressed'][m]:>12}")
+
+
+if __name__ == "__main__":
+    main()
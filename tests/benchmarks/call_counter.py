@@ -0,0 +1,75 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Counts subprocesses and DynamoDB API calls made by the current process, by
+patching subprocess.Popen and botocore's API call method while active.
+"""
+import collections
+import subprocess
+import threading
+from botocore.client import BaseClient
+
+from admin_tasks.common.profiling import command_label
+
+
+class CallCounter:
+    """
+    Usage:
+        with CallCounter() as calls:
+            ...
+        calls.subprocesses.most_common(), calls.ddb_operations
+    """
+
+    def __init__(self):
+        self.subprocesses = collections.Counter()
+        self.ddb_operations = collections.Counter()
+        self._lock = threading.Lock()
+        self._original_popen_init = None
+        self._original_make_api_call = None
+
+    @property
+    def subprocess_count(self):
+        return sum(self.subprocesses.values())
+
+    @property
+    def ddb_call_count(self):
+        return sum(self.ddb_operations.values())
+
+    def __enter__(self):
+        counter = self
+        original_popen_init = self._original_popen_init = subprocess.Popen.__init__
+        original_make_api_call = self._original_make_api_call = BaseClient._make_api_call
+
+        def popen_init(popen, args, *a, **kw):
+            with counter._lock:
+                counter.subprocesses[command_label(args)] += 1
+            return original_popen_init(popen, args, *a, **kw)
+
+        def make_api_call(client, operation_name, api_params):
+            if client.meta.service_model.service_name == "dynamodb":
+                with counter._lock:
+                    counter.ddb_operations[operation_name] += 1
+            return original_make_api_call(client, operation_name, api_params)
+
+        subprocess.Popen.__init__ = popen_init
+        BaseClient._make_api_call = make_api_call
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        subprocess.Popen.__init__ = self._original_popen_init
+        BaseClient._make_api_call = self._original_make_api_call
@@ -0,0 +1,368 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Benchmarks of code metrics and deployment status work against synthetic git
+repos (synthetic_repo.py) and a local DynamoDB stand-in (local_dynamodb.py).
+Each scenario records wall time, the number of subprocesses started and the
+number of DynamoDB calls. Results can be saved as JSON and compared with a
+baseline, to report speedups and catch regressions.
+
+Usage:
+    python -m tests.benchmarks.run_benchmarks --commits 365 --output before.json
+    python -m tests.benchmarks.run_benchmarks --commits 365 --baseline before.json
+"""
+import local.dev_config  # sets env variables
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from prettytable import PrettyTable
+
+from admin_tasks.common.code_metrics_utilities import StackLocCounter
+from admin_tasks.common.git_utilities import GitRepo
+from admin_tasks.common.line_counter import GitBlobLineCounter
+from admin_tasks.services_deployment_status import StackDeploymentStatus
+from src.common.constants import CodeMetricsTable, DeploymentsTable
+from src.common.ddb_batch_writer import DdbBatchWriter
+from tests.benchmarks.call_counter import CallCounter
+from tests.benchmarks.synthetic_repo import create_synthetic_repo
+from tests.local_dynamodb import LocalDynamodb
+
+# Lambda code imports common.constants, so src needs to be on the path
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "src"))
+import deployment_history  # noqa: E402
+
+
+ENVS = ["dev", "prod"]
+LINE_COUNTERS = {
+    "cloc": lambda: None,
+    GitBlobLineCounter.name: GitBlobLineCounter,
+}
+
+
+def daily_timestamps(repo):
+    """
+    Returns:
+        Date strings of every day from the day after the first commit of repo
+        to the day after its last commit
+    """
+    commit_index = repo.get_commit_index()
+    day = commit_index.earliest_commit_date.date()
+    last_day = datetime.datetime.fromtimestamp(commit_index.commit_timestamps[-1]).date()
+    timestamps = list()
+    while day <= last_day:
+        day += datetime.timedelta(days=1)
+        timestamps.append(str(day))
+    return timestamps
+
+
+def deployment_item(repo, env, revision, created):
+    return {
+        "stack_env": f"{repo.name}-{env}",
+        "timestamp": created,
+        "stack": repo.name,
+        "environment": env,
+        "revision": revision,
+        "branch": "master",
+        "created": created,
+        "modified": created,
+    }
+
+
+def seed_deployments(deployments_table, repos, n_deployments):
+    """
+    Writes n_deployments past deployments of evenly spaced revisions of
+    each repo to each environment
+    """
+    with DdbBatchWriter(
+        deployments_table.table,
+        key_names=(deployments_table.partition, deployments_table.sort),
+    ) as batch_writer:
+        for repo in repos:
+            commit_index = repo.get_commit_index()
+            step = max(1, len(commit_index.revisions) // n_deployments)
+            for env in ENVS:
+                for i in range(0, len(commit_index.revisions), step)[-n_deployments:]:
+                    created = datetime.datetime.fromtimestamp(
+                        commit_index.commit_timestamps[i], tz=datetime.timezone.utc
+                    ).isoformat()
+                    batch_writer.put(
+                        deployment_item(repo, env, commit_index.revisions[i], created)
+                    )
+
+
+def bench_stack_loc_counter(repos, metrics_table, line_counter_name):
+    """
+    Daily code metrics of every repo, as update_code_metrics.main
+    """
+    line_counter = LINE_COUNTERS[line_counter_name]()
+    with metrics_table.batch_writer() as batch_writer:
+        for repo in repos:
+            for ts_str in daily_timestamps(repo):
+                StackLocCounter(
+                    stack_name=repo.name,
+                    commit_timestamp=ts_str,
+                    line_counter=line_counter,
+                    repo=repo,
+                ).populate_ddb(batch_writer=batch_writer)
+    if line_counter is not None:
+        line_counter.close()
+
+
+def bench_revision_lookup(repos):
+    """
+    One git rev-list call per repo and day (get_branch_revision_at_timestamp)
+    """
+    for repo in repos:
+        for ts_str in daily_timestamps(repo):
+            repo.get_branch_revision_at_timestamp(ts_str, "origin/master")
+
+
+def bench_commit_index_lookup(repos):
+    """
+    Same lookups as bench_revision_lookup, using a newly built commit index
+    """
+    for repo in repos:
+        commit_index = GitRepo(repo.path).get_commit_index("origin/master")
+        for ts_str in daily_timestamps(repo):
+            commit_index.revision_at(ts_str)
+
+
+def bench_deployment_status(repos, deployments_table):
+    """
+    Work done by services_deployment_status.main for every repo and env
+    """
+    for repo in repos:
+        for env in ENVS:
+            sds = StackDeploymentStatus(
+                stack_name=repo.name,
+                env_name=env,
+                deployments_table=deployments_table,
+                repo=repo,
+            )
+            sds.get_latest_deployment()
+            sds.get_deployed_revision_datetime()
+            sds.get_deployed_revision_delta_to_master()
+
+
+def bench_add_deployment(repos, n_events):
+    """
+    n_events deployment events per repo processed by the AddDeployment function
+    """
+    for repo in repos:
+        revisions = repo.get_commit_index().revisions
+        for i in range(n_events):
+            event = {
+                "id": str(uuid.uuid4()),
+                "time": f"2021-01-01T00:00:{i % 60:02d}.{i:06d}Z",
+                "source": "benchmark",
+                "detail": {
+                    "stack": repo.name,
+                    "environment": ENVS[i % len(ENVS)],
+                    "revision": revisions[i % len(revisions)],
+                    "branch": "master",
+                },
+            }
+            deployment_history.add_deployment(event, None)
+
+
+def add_deployment_table_name():
+    """
+    Returns:
+        Name of the table used by the AddDeployment function, as resolved by
+        thiscovery_lib for the current environment
+    """
+    table = deployment_history.const.DeploymentsTable()
+    table.get_table()
+    return table.table.name
+
+
+def measure(func, *args):
+    with CallCounter() as calls:
+        start = time.perf_counter()
+        func(*args)
+        wall_seconds = time.perf_counter() - start
+    return {
+        "wall_seconds": round(wall_seconds, 3),
+        "subprocesses": calls.subprocess_count,
+        "ddb_calls": calls.ddb_call_count,
+        "subprocesses_by_command": dict(calls.subprocesses.most_common()),
+        "ddb_calls_by_operation": dict(calls.ddb_operations.most_common()),
+    }
+
+
+def run_benchmarks(
+    n_repos=2,
+    n_files=100,
+    n_commits=90,
+    churn=0.05,
+    n_deployments=20,
+    n_events=20,
+    line_counter_name=GitBlobLineCounter.name,
+    scenarios=None,
+    seed=0,
+):
+    """
+    Returns:
+        Dict with the benchmark configuration and the measurements of each
+        scenario
+    """
+    config = {
+        "n_repos": n_repos,
+        "n_files": n_files,
+        "n_commits": n_commits,
+        "churn": churn,
+        "n_deployments": n_deployments,
+        "n_events": n_events,
+        "line_counter": line_counter_name,
+        "seed": seed,
+    }
+    folder = tempfile.mkdtemp()
+    try:
+        with LocalDynamodb() as local_ddb:
+            repos = [
+                create_synthetic_repo(
+                    folder,
+                    f"service-{i}",
+                    n_files=n_files,
+                    n_commits=n_commits,
+                    churn=churn,
+                    seed=seed + i,
+                )
+                for i in range(n_repos)
+            ]
+            metrics_table = CodeMetricsTable(
+                table=local_ddb.create_table("CodeMetrics")
+            )
+            deployments_table = DeploymentsTable(
+                table=local_ddb.create_table("Deployments")
+            )
+            local_ddb.create_table("Deployments", table_name=add_deployment_table_name())
+            seed_deployments(deployments_table, repos, n_deployments)
+            all_scenarios = {
+                "stack_loc_counter": (
+                    bench_stack_loc_counter,
+                    repos,
+                    metrics_table,
+                    line_counter_name,
+                ),
+                "revision_lookup": (bench_revision_lookup, repos),
+                "commit_index_lookup": (bench_commit_index_lookup, repos),
+                "deployment_status": (bench_deployment_status, repos, deployments_table),
+                "add_deployment": (bench_add_deployment, repos, n_events),
+            }
+            results = dict()
+            for name, (func, *args) in all_scenarios.items():
+                if scenarios is None or name in scenarios:
+                    print(f"Running {name}")
+                    results[name] = measure(func, *args)
+    finally:
+        shutil.rmtree(folder)
+    return {"config": config, "scenarios": results}
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """
+    Returns:
+        List of (scenario, metric, baseline value, value) regressions: wall
+        time more than tolerance above baseline, or more subprocesses or
+        DynamoDB calls than baseline
+    """
+    regressions = list()
+    for name, measurements in results["scenarios"].items():
+        try:
+            base = baseline["scenarios"][name]
+        except KeyError:
+            continue
+        if measurements["wall_seconds"] > base["wall_seconds"] * (1 + tolerance):
+            regressions.append(
+                (name, "wall_seconds", base["wall_seconds"], measurements["wall_seconds"])
+            )
+        for metric in ["subprocesses", "ddb_calls"]:
+            if measurements[metric] > base[metric]:
+                regressions.append((name, metric, base[metric], measurements[metric]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    table = PrettyTable()
+    table.field_names = ["Scenario", "Wall (s)", "Subprocesses", "DDB calls", "Speedup"]
+    for name, m in results["scenarios"].items():
+        speedup = "NA"
+        if baseline is not None and name in baseline["scenarios"]:
+            base_wall = baseline["scenarios"][name]["wall_seconds"]
+            speedup = f"{base_wall / m['wall_seconds']:.2f}x" if m["wall_seconds"] else "NA"
+        table.add_row(
+            [name, m["wall_seconds"], m["subprocesses"], m["ddb_calls"], speedup]
+        )
+    print(table)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Run benchmarks")
+    arg_parser.add_argument("--repos", type=int, default=2)
+    arg_parser.add_argument("--files", type=int, default=100, help="Files per repo")
+    arg_parser.add_argument("--commits", type=int, default=90, help="One commit per day")
+    arg_parser.add_argument(
+        "--churn", type=float, default=0.05, help="Fraction of files changed per commit"
+    )
+    arg_parser.add_argument(
+        "--deployments", type=int, default=20, help="Past deployments per stack and env"
+    )
+    arg_parser.add_argument("--events", type=int, default=20, help="Deployment events per repo")
+    arg_parser.add_argument(
+        "--line-counter", choices=LINE_COUNTERS.keys(), default=GitBlobLineCounter.name
+    )
+    arg_parser.add_argument("--scenario", action="append", help="Only run these scenarios")
+    arg_parser.add_argument("--output", help="Save results to this JSON file")
+    arg_parser.add_argument("--baseline", help="Compare results with this JSON file")
+    arg_parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="Allowed wall time increase over baseline"
+    )
+    args = arg_parser.parse_args()
+    benchmark_results = run_benchmarks(
+        n_repos=args.repos,
+        n_files=args.files,
+        n_commits=args.commits,
+        churn=args.churn,
+        n_deployments=args.deployments,
+        n_events=args.events,
+        line_counter_name=args.line_counter,
+        scenarios=args.scenario,
+    )
+    baseline_results = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+    print_results(benchmark_results, baseline_results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(benchmark_results, f, indent=2)
+    if baseline_results is not None:
+        found_regressions = compare_with_baseline(
+            benchmark_results, baseline_results, args.tolerance
+        )
+        for regression in found_regressions:
+            print("Regression in {}: {} was {}, now {}".format(*regression))
+        if found_regressions:
+            sys.exit(1)
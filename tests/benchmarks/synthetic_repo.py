@@ -0,0 +1,123 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Generates git repos of configurable size, history length and churn for
+benchmarks. History is written with a single git fast-import call into a
+bare "remote" repo, which is then cloned, so that the clone has an
+origin/master branch to fetch and pull from like the repos in GITHUB_FOLDER.
+"""
+import datetime
+import os
+import random
+import subprocess
+
+from admin_tasks.common.git_utilities import get_repo
+
+
+def python_module(rng, n_lines):
+    """
+    Returns:
+        Source of a Python module with a mix of code, comment and blank lines
+    """
+    lines = ['"""', "Synthetic module", '"""', "import os", ""]
+    while len(lines) < n_lines:
+        kind = rng.random()
+        if kind < 0.15:
+            lines.append(f"# comment {rng.randrange(10 ** 6)}")
+        elif kind < 0.25:
+            lines.append("")
+        else:
+            lines.append(f"value_{len(lines)} = {rng.randrange(10 ** 6)}")
+    return "\n".join(lines) + "\n"
+
+
+def _fast_import_data(data):
+    return f"data {len(data)}\n".encode() + data + b"\n"
+
+
+def create_synthetic_repo(
+    folder,
+    name,
+    n_files=100,
+    n_commits=100,
+    churn=0.05,
+    start_date=datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc),
+    days_between_commits=1,
+    lines_per_file=100,
+    seed=0,
+):
+    """
+    Args:
+        folder: parent folder of the clone (folder/name) and of its remote
+            (folder/remotes/name.git)
+        n_files (int): number of files in the first commit
+        n_commits (int): length of the first-parent history of master
+        churn (float): fraction of files modified by each commit after the
+            first; each commit also adds a file with probability churn
+        days_between_commits (float): spacing of commit timestamps
+
+    Returns:
+        GitRepo of the clone
+    """
+    rng = random.Random(seed)
+    remote_path = os.path.join(folder, "remotes", f"{name}.git")
+    clone_path = os.path.join(folder, name)
+    subprocess.run(
+        ["git", "init", "-q", "--bare", "-b", "master", remote_path],
+        check=True,
+        capture_output=True,
+    )
+
+    stream = bytearray()
+    paths = list()
+    for i in range(n_commits):
+        if i == 0:
+            changed = [f"src/module_{n}.py" for n in range(n_files)]
+            paths.extend(changed)
+        else:
+            changed = rng.sample(paths, max(1, round(churn * len(paths))))
+            if rng.random() < churn:
+                paths.append(f"src/module_{len(paths)}.py")
+                changed.append(paths[-1])
+        timestamp = int(
+            (start_date + datetime.timedelta(days=i * days_between_commits)).timestamp()
+        )
+        stream += b"commit refs/heads/master\n"
+        stream += f"mark :{i + 1}\n".encode()
+        stream += f"committer Benchmark <benchmark@example.com> {timestamp} +0000\n".encode()
+        stream += _fast_import_data(f"Commit {i}".encode())
+        if i > 0:
+            stream += f"from :{i}\n".encode()
+        for path in changed:
+            content = python_module(rng, rng.randint(lines_per_file // 2, lines_per_file * 2))
+            stream += f"M 100644 inline {path}\n".encode()
+            stream += _fast_import_data(content.encode())
+        stream += b"\n"
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        input=bytes(stream),
+        cwd=remote_path,
+        check=True,
+        capture_output=True,
+    )
+    subprocess.run(
+        ["git", "clone", "--quiet", remote_path, clone_path],
+        check=True,
+        capture_output=True,
+    )
+    return get_repo(clone_path)
@@ -0,0 +1,61 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import copy
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from tests.benchmarks.run_benchmarks import compare_with_baseline, run_benchmarks
+
+
+class RunBenchmarksTestCase(test_tools.BaseTestCase):
+    """
+    Runs the benchmarks on tiny repos, so that the harness is kept working
+    """
+
+    def test_run_benchmarks_ok(self):
+        results = run_benchmarks(
+            n_repos=1, n_files=5, n_commits=5, n_deployments=2, n_events=2
+        )
+        scenarios = results["scenarios"]
+        self.assertEqual(
+            {
+                "stack_loc_counter",
+                "revision_lookup",
+                "commit_index_lookup",
+                "deployment_status",
+                "add_deployment",
+            },
+            set(scenarios.keys()),
+        )
+        # one rev-list call per day; the commit index needs a single git log
+        self.assertEqual(
+            {"git rev-list": 5}, scenarios["revision_lookup"]["subprocesses_by_command"]
+        )
+        self.assertEqual(
+            {"git log": 1}, scenarios["commit_index_lookup"]["subprocesses_by_command"]
+        )
+        # a history item and a conditional latest deployment index write per event
+        self.assertEqual(4, scenarios["add_deployment"]["ddb_calls"])
+        self.assertEqual([], compare_with_baseline(results, results))
+
+        baseline = copy.deepcopy(results)
+        baseline["scenarios"]["revision_lookup"]["subprocesses"] = 1
+        self.assertEqual(
+            [("revision_lookup", "subprocesses", 1, 5)],
+            compare_with_baseline(results, baseline),
+        )
@@ -0,0 +1,77 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Local stand-in for the Dynamodb tables defined in template.yaml, backed by
+moto, so that table code can be tested without an AWS account.
+"""
+import boto3
+import os
+from moto import mock_aws
+
+
+TABLE_KEYS = {
+    "Deployments": ("stack_env", "timestamp"),
+    "CodeMetrics": ("repo", "timestamp"),
+}
+
+
+class LocalDynamodb:
+    """
+    Usage:
+        with LocalDynamodb() as local_ddb:
+            table = local_ddb.create_table("CodeMetrics")
+    """
+
+    def __init__(self, region_name="eu-west-1"):
+        self.region_name = region_name
+        self._mock = mock_aws()
+        self._env_backup = None
+        self.resource = None
+
+    def __enter__(self):
+        self._env_backup = dict(os.environ)
+        os.environ.update(
+            {
+                "AWS_ACCESS_KEY_ID": "testing",
+                "AWS_SECRET_ACCESS_KEY": "testing",
+                "AWS_DEFAULT_REGION": self.region_name,
+            }
+        )
+        self._mock.start()
+        self.resource = boto3.resource("dynamodb", region_name=self.region_name)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._mock.stop()
+        os.environ.clear()
+        os.environ.update(self._env_backup)
+
+    def create_table(self, name, table_name=None):
+        partition, sort = TABLE_KEYS[name]
+        return self.resource.create_table(
+            TableName=table_name or name,
+            KeySchema=[
+                {"AttributeName": partition, "KeyType": "HASH"},
+                {"AttributeName": sort, "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": partition, "AttributeType": "S"},
+                {"AttributeName": sort, "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
@@ -0,0 +1,85 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import thiscovery_dev_tools.testing_tools as test_tools
+from decimal import Decimal
+
+from src.common.ddb_batch_writer import DdbBatchWriter
+from tests.local_dynamodb import LocalDynamodb
+
+
+class ThrottlingClient:
+    """
+    Wraps a Dynamodb client so that the first throttled_calls batch writes
+    only process half of their items and return the rest as UnprocessedItems
+    """
+
+    def __init__(self, client, throttled_calls):
+        self.client = client
+        self.throttled_calls = throttled_calls
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        if self.calls > self.throttled_calls:
+            return self.client.batch_write_item(RequestItems=RequestItems)
+        ((table_name, requests),) = RequestItems.items()
+        half = len(requests) // 2
+        self.client.batch_write_item(RequestItems={table_name: requests[:half]})
+        return {"UnprocessedItems": {table_name: requests[half:]}}
+
+
+class ThrottledTable:
+    def __init__(self, table, throttled_calls):
+        self.name = table.name
+        self.meta = type("Meta", (), {})()
+        self.meta.client = ThrottlingClient(table.meta.client, throttled_calls)
+
+
+class DdbBatchWriterTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        self.local_ddb = LocalDynamodb().__enter__()
+        self.table = self.local_ddb.create_table("CodeMetrics")
+
+    def tearDown(self):
+        self.local_ddb.__exit__(None, None, None)
+
+    def stored_items(self):
+        return self.table.scan()["Items"]
+
+    def test_batch_write_ok(self):
+        with DdbBatchWriter(self.table, key_names=("repo", "timestamp")) as writer:
+            for i in range(60):
+                writer.put({"repo": "r", "timestamp": f"2021-01-{i:02}", "code": i})
+            # duplicate key in the same batch; last one wins
+            writer.put({"repo": "r", "timestamp": "2021-01-59", "code": 0.5})
+        self.assertEqual(60, writer.items_written)
+        self.assertEqual(3, writer.batches_written)
+        items = {i["timestamp"]: i["code"] for i in self.stored_items()}
+        self.assertEqual(60, len(items))
+        self.assertEqual(Decimal("0.5"), items["2021-01-59"])
+
+    def test_unprocessed_items_retried_ok(self):
+        throttled_table = ThrottledTable(self.table, throttled_calls=3)
+        writer = DdbBatchWriter(throttled_table, base_delay=0.001)
+        for i in range(25):
+            writer.put({"repo": "r", "timestamp": f"2021-01-{i:02}"})
+        writer.flush()
+        self.assertEqual(3, writer.retries)
+        self.assertEqual(25, len(self.stored_items()))
+        writer.close()
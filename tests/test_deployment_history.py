@@ -0,0 +1,85 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import os
+import sys
+from unittest import mock
+import thiscovery_dev_tools.testing_tools as test_tools
+from botocore.exceptions import ClientError
+
+from src.common.constants import DeploymentsTable
+from tests.local_dynamodb import LocalDynamodb
+
+# deployment_history imports constants the way the AddDeployment function does
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+import deployment_history  # noqa: E402
+
+
+def deployment_event(timestamp="2021-01-01T12:00:00Z"):
+    return {
+        "id": "8a8b0d0e-7b1f-4b0c-9e2a-0c6a3d1f6e11",
+        "time": timestamp,
+        "source": "test",
+        "detail": {
+            "stack": "stack",
+            "environment": "dev",
+            "revision": "abc123",
+            "branch": "master",
+        },
+    }
+
+
+class AddDeploymentTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.local_ddb = LocalDynamodb().__enter__()
+        function_table = deployment_history.const.DeploymentsTable()
+        function_table.get_table()
+        self.deployments_table = DeploymentsTable(
+            table=self.local_ddb.create_table(
+                "Deployments", table_name=function_table.table.name
+            )
+        )
+
+    def tearDown(self):
+        self.local_ddb.__exit__(None, None, None)
+        super().tearDown()
+
+    def test_retry_updates_latest_deployment_index(self):
+        throttled = ClientError(
+            {"Error": {"Code": "ProvisionedThroughputExceededException"}}, "PutItem"
+        )
+        with mock.patch.object(
+            deployment_history.Deployment, "put_latest", side_effect=throttled
+        ), self.assertRaises(ClientError):
+            deployment_history.add_deployment(deployment_event(), None)
+        self.assertEqual({}, self.deployments_table.query_latest_deployments())
+
+        # the history item already exists when the event is retried
+        deployment_history.add_deployment(deployment_event(), None)
+        self.assertEqual(
+            ["2021-01-01T12:00:00Z"],
+            [
+                i["timestamp"]
+                for i in self.deployments_table.iter_deployments("stack-dev")
+            ],
+        )
+        latest = self.deployments_table.query_latest_deployments()
+        self.assertEqual(
+            "2021-01-01T12:00:00Z", latest["stack-dev"]["deployment_timestamp"]
+        )
@@ -0,0 +1,120 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from src.common.constants import DeploymentsTable
+from tests.local_dynamodb import LocalDynamodb
+
+
+TIMESTAMPS = [f"2021-01-{day:02d}T12:00:00+00:00" for day in range(1, 26)]
+
+
+class DeploymentsTableTestCase(test_tools.BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.local_ddb = LocalDynamodb().__enter__()
+        table = self.local_ddb.create_table("Deployments")
+        for i, ts in enumerate(TIMESTAMPS):
+            table.put_item(
+                Item={
+                    "stack_env": "stack-dev",
+                    "timestamp": ts,
+                    "revision": f"rev{i}",
+                    "branch": "master",
+                    "created": ts,
+                }
+            )
+        self.deployments_table = DeploymentsTable(table=table)
+
+    def tearDown(self):
+        self.local_ddb.__exit__(None, None, None)
+        super().tearDown()
+
+    def test_iter_all_pages_ok(self):
+        items = list(
+            self.deployments_table.iter_deployments("stack-dev", page_size=10)
+        )
+        self.assertEqual(list(reversed(TIMESTAMPS)), [i["timestamp"] for i in items])
+        self.assertEqual("master", items[0]["branch"])
+
+    def test_latest_with_projection_ok(self):
+        self.assertEqual(
+            [
+                {"timestamp": TIMESTAMPS[-1], "revision": "rev24"},
+                {"timestamp": TIMESTAMPS[-2], "revision": "rev23"},
+            ],
+            self.deployments_table.get_latest_deployments(
+                "stack-dev", n=2, attributes=("revision",)
+            ),
+        )
+
+    def test_time_range_oldest_first_ok(self):
+        items = self.deployments_table.iter_deployments(
+            "stack-dev",
+            start="2021-01-10",
+            end="2021-01-20",
+            attributes=("revision",),
+            newest_first=False,
+            page_size=4,
+        )
+        self.assertEqual(
+            [f"rev{i}" for i in range(9, 19)], [i["revision"] for i in items]
+        )
+
+    def test_no_deployments_ok(self):
+        self.assertEqual(
+            [], self.deployments_table.get_latest_deployments("other-stack-dev")
+        )
+
+    def test_latest_deployment_index_ok(self):
+        def item(stack_env, ts, revision):
+            return {
+                "stack_env": stack_env,
+                "timestamp": ts,
+                "environment": stack_env.split("-")[-1],
+                "revision": revision,
+            }
+
+        put_latest = self.deployments_table.put_latest_deployment
+        self.assertTrue(put_latest(item("stack-dev", TIMESTAMPS[1], "rev1")))
+        # older event processed after a newer one
+        self.assertFalse(put_latest(item("stack-dev", TIMESTAMPS[0], "rev0")))
+        self.assertTrue(put_latest(item("stack-dev", TIMESTAMPS[2], "rev2")))
+        self.assertTrue(put_latest(item("stack-prod", TIMESTAMPS[0], "rev0")))
+        self.assertEqual(
+            {
+                "stack-dev": {
+                    "timestamp": "stack-dev",
+                    "environment": "dev",
+                    "revision": "rev2",
+                    "created": TIMESTAMPS[2],
+                }
+            },
+            self.deployments_table.query_latest_deployments(
+                environment="dev", attributes=("revision", "created")
+            ),
+        )
+        self.assertEqual(
+            ["stack-dev", "stack-prod"],
+            sorted(self.deployments_table.query_latest_deployments()),
+        )
+        # the index does not show up in deployment histories
+        self.assertEqual(
+            25, len(list(self.deployments_table.iter_deployments("stack-dev")))
+        )
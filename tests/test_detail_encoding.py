@@ -0,0 +1,59 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import src.common.detail_encoding as detail_encoding
+from src.common.constants import CodeMetricsTable
+from tests.local_dynamodb import LocalDynamodb
+
+
+DETAIL = {
+    "header": {"cloc_url": "github.com/AlDanial/cloc", "cloc_version": "1.90"},
+    "Python": {"nFiles": 3, "blank": 10, "comment": 5, "code": 120},
+    "SUM": {"blank": 10, "comment": 5, "code": 120, "nFiles": 3},
+}
+
+
+class DetailEncodingTestCase(test_tools.BaseTestCase):
+    def test_read_both_encodings_ok(self):
+        with LocalDynamodb() as local_ddb:
+            metrics_table = CodeMetricsTable(
+                table=local_ddb.create_table("CodeMetrics")
+            )
+            with metrics_table.batch_writer() as batch_writer:
+                batch_writer.put(
+                    {"repo": "repo", "timestamp": "2021-01-01", "code": 120, "detail": DETAIL}
+                )
+                batch_writer.put(
+                    {
+                        "repo": "repo",
+                        "timestamp": "2021-01-02",
+                        "code": 120,
+                        "detail": detail_encoding.encode_detail(DETAIL),
+                        "detail_encoding": detail_encoding.ZLIB_JSON,
+                    }
+                )
+            items = metrics_table.query_repo_series("repo", attributes=("detail",))
+        self.assertEqual(
+            [
+                {"timestamp": "2021-01-01", "detail": DETAIL},
+                {"timestamp": "2021-01-02", "detail": DETAIL},
+            ],
+            items,
+        )